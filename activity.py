@@ -0,0 +1,124 @@
+import heapq
+import time
+
+DAY = 24 * 60 * 60
+# Rolling windows, in days, whose counts are kept up to date as events come in and expire
+WINDOWS = (7, 30)
+# Days kept a bucket each, after which they're merged into a bucket per week
+DAILY = max(WINDOWS)
+# Weeks kept in all, counting the one today is in. Older ones are dropped
+WEEKLY = 53
+# Longest window that can be asked for, always within what's kept
+MAX_DAYS = 365
+
+def today () -> int :
+    return int(time.time()) // DAY
+
+def kept_from (day:int) -> int :
+    ''' The oldest day whose events are still kept as of day '''
+    return (day // 7 - WEEKLY + 1) * 7
+
+def add (counts:dict, isbn:str, events:int):
+    counts[isbn] = counts.get(isbn, 0) + events
+    if counts[isbn] == 0:
+        del counts[isbn]
+
+class Activity:
+    '''
+    When books were finished and rated, as counts per book per day (UTC) for the last DAILY days and per week for WEEKLY weeks before that.
+    Every window in WINDOWS has its counts kept up to date, adding events as they come in and taking away whole days as they fall out of it,
+    so the most active books in them are found without adding anything up. Windows count today plus the days before it
+    '''
+
+    def __init__ (self):
+        # day number -> isbn -> events that day
+        self.days:dict = {}
+        # week number (days // 7) -> isbn -> events that week, for days older than DAILY
+        self.weeks:dict = {}
+        # window -> isbn -> events in it
+        self.windows:dict = {window: {} for window in WINDOWS}
+        # Day the windows end on, None until the first event
+        self.today = None
+
+    def record (self, isbn:str, at:int, events:int = 1):
+        ''' Counts an event at unix time at. Ones from before the oldest day kept go in their week, or nowhere if that's gone too '''
+        day = at // DAY
+        if self.today == None or day > self.today:
+            self.advance(day)
+        if day > self.today - DAILY:
+            add(self.days.setdefault(day, {}), isbn, events)
+            for window, counts in self.windows.items():
+                if day > self.today - window:
+                    add(counts, isbn, events)
+        elif day >= kept_from(self.today):
+            add(self.weeks.setdefault(day // 7, {}), isbn, events)
+
+    def advance (self, day:int):
+        ''' Moves the windows on to end on day, taking away the days that fell out of them and merging days into weeks as they get old '''
+        if self.today != None and day <= self.today:
+            return
+        if self.today != None:
+            for window, counts in self.windows.items():
+                for old in self.days:
+                    if self.today - window < old <= day - window:
+                        for isbn, events in self.days[old].items():
+                            add(counts, isbn, -events)
+        self.today = day
+
+        for old in [old for old in self.days if old <= day - DAILY]:
+            week = self.weeks.setdefault(old // 7, {})
+            for isbn, events in self.days.pop(old).items():
+                add(week, isbn, events)
+        for old in [old for old in self.weeks if old * 7 < kept_from(day)]:
+            del self.weeks[old]
+
+    def counts (self, days:int) -> dict :
+        ''' isbn -> events in the last days days. Kept up to date for WINDOWS, added up from the buckets for anything else '''
+        if days in self.windows:
+            return self.windows[days]
+        counts:dict = {}
+        for day, bucket in self.days.items():
+            if day > self.today - days:
+                for isbn, events in bucket.items():
+                    add(counts, isbn, events)
+        # Weeks only count whole, so windows reaching back past DAILY days are rounded to the week
+        for week, bucket in self.weeks.items():
+            if week * 7 + 6 > self.today - days:
+                for isbn, events in bucket.items():
+                    add(counts, isbn, events)
+        return counts
+
+    def top (self, days:int, count:int, now:int, allowed=None) -> list :
+        ''' Up to count (isbn, events) with the most events in the last days days as of unix time now, only isbns allowed(isbn) is true for if given '''
+        self.advance(now // DAY)
+        counts = self.counts(days)
+        books = counts.items() if allowed == None else ((isbn, events) for isbn, events in counts.items() if allowed(isbn))
+        return heapq.nlargest(count, books, key=lambda book: (book[1], book[0]))
+
+    def buckets (self) -> int :
+        ''' How many (bucket, book) counts are kept, which stays bounded by the books active in the last DAILY days and WEEKLY weeks '''
+        return sum(len(bucket) for buckets in (self.days, self.weeks) for bucket in buckets.values())
+
+    def to_dict (self) -> dict :
+        ''' A copy of the buckets to save with a snapshot, the windows are worked out again from them '''
+        return {
+            'days': {day: dict(bucket) for day, bucket in self.days.items()},
+            'weeks': {week: dict(bucket) for week, bucket in self.weeks.items()},
+        }
+
+    def load (self, data:dict):
+        ''' Takes buckets saved by to_dict, then brings the windows up to today '''
+        self.days, self.weeks = data.get('days', {}), data.get('weeks', {})
+        self.windows = {window: {} for window in WINDOWS}
+        self.today = None
+        if self.days != {}:
+            self.today = max(self.days)
+            for window, counts in self.windows.items():
+                for day, bucket in self.days.items():
+                    if day > self.today - window:
+                        for isbn, events in bucket.items():
+                            add(counts, isbn, events)
+        elif self.weeks != {}:
+            self.today = max(self.weeks) * 7 + 6
+        if self.today != None:
+            self.advance(today())
@@ -0,0 +1,818 @@
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import random
+import resource
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import discord
+
+import activity
+import bot
+import catalog
+from book import Book
+import db
+import docs
+import export
+import fakediscord
+import offload
+import recommend
+import storage
+import synthetic
+from perf import metrics
+from isbn import LengthError, ValidationError, canonical, canonical_many, convert
+# None when canonical_many falls back to plain Python
+from isbn import numpy
+
+SCALES = {'1k': 1_000, '100k': 100_000, '1m': 1_000_000}
+# Generated libraries are kept here between runs since the big ones take a while to make
+DATA_PATH = 'bench_data'
+BASELINES_PATH = 'bench_baselines.json'
+# How many times each hot path is timed, the median is reported
+REPEAT = 200
+
+class FakeGuild:
+    def __init__ (self, id:int):
+        self.id = id
+
+class FakeUser:
+    def __init__ (self, id:int):
+        self.id = id
+        self.display_name = str(id)
+
+class FakeMessage:
+    def __init__ (self, author:FakeUser, attachments:list = []):
+        self.author = author
+        self.attachments = attachments
+
+    async def delete (self, delay=None):
+        pass
+
+    async def edit (self, **kwargs):
+        pass
+
+class FakeContext:
+    ''' Just enough of a discord.py Context to call a command's callback directly '''
+
+    # Sent as a message rather than a slash command
+    interaction = None
+
+    def __init__ (self, guild:FakeGuild, user:int = 1):
+        self.guild = guild
+        self.message = FakeMessage(FakeUser(user))
+        self.sent:list = []
+
+    async def send (self, content=None, embed=None, file=None, view=None):
+        self.sent.append(embed if embed != None else content)
+        return FakeMessage(self.message.author)
+
+    def working (self, embed):
+        pass
+
+def library_file (books:int) -> str :
+    ''' Path to a generated db.json with this many books, generating it the first time '''
+    path = os.path.join(DATA_PATH, f'{books}.json')
+    if not os.path.exists(path):
+        os.makedirs(DATA_PATH, exist_ok=True)
+        print(f'Generating {books} books...')
+        synthetic.save(synthetic.generate(books), path)
+    return path
+
+def median_time (call, repeat:int = REPEAT) -> float :
+    times = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        call()
+        times.append(time.perf_counter() - started)
+    return statistics.median(times)
+
+async def median_time_async (call, repeat:int = REPEAT) -> float :
+    times = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        await call()
+        times.append(time.perf_counter() - started)
+    return statistics.median(times)
+
+async def validate (guild, id:str):
+    ''' validate_book_id, with not found counted as a result rather than a failure '''
+    try:
+        return await bot.validate_book_id(FakeContext(guild), id)
+    except ValueError:
+        return None
+
+def run_scale (books:int, workdir:str) -> dict :
+    ''' Times every hot path against a fresh copy of a generated library, returning seconds per call '''
+    rng = random.Random(books)
+    guild = FakeGuild(books)
+    shutil.copy(library_file(books), os.path.join(workdir, f'{books}.json'))
+    if db.BACKEND == 'sqlite':
+        from sqlite_db import migrate
+        migrate(os.path.join(workdir, f'{books}.json'), os.path.join(workdir, f'{books}.sqlite'))
+
+    results = {}
+    started = time.perf_counter()
+    library = db.libraries.get(guild.id)
+    results['load'] = time.perf_counter() - started
+
+    isbns = rng.sample(list(library.books), min(REPEAT, len(library.books)))
+    titles = [library.books[isbn].title for isbn in isbns]
+    picks = iter(range(10**9))
+    # A busy month for lib!trending, a finish or rating a minute spread over every book
+    everything = list(library.books)
+    now = int(time.time())
+    for minute in range(30 * 24 * 60):
+        library.activity.record(everything[rng.randrange(len(everything))], now - minute * 60)
+
+    async def commands ():
+        results['validate isbn'] = await median_time_async(lambda: validate(guild, isbns[next(picks) % len(isbns)]))
+        results['validate title'] = await median_time_async(lambda: validate(guild, titles[next(picks) % len(titles)]))
+        # Swapping the number on the end for a letter means there's no exact match, so this goes through the suggestions
+        results['validate fuzzy'] = await median_time_async(lambda: validate(guild, titles[next(picks) % len(titles)].rsplit(' ', 1)[0] + ' x'), REPEAT // 10)
+
+        ctx = FakeContext(guild)
+        results['stats'] = await median_time_async(lambda: bot.stats.callback(ctx))
+        results['hot'] = await median_time_async(lambda: bot.hot.callback(ctx, '10', ''))
+        results['favorites'] = await median_time_async(lambda: bot.favorites.callback(ctx, '10', 'tag 1'))
+        results['trending'] = await median_time_async(lambda: bot.trending.callback(ctx, '7', ''))
+        # Windows that aren't kept up to date get added up from the daily buckets
+        results['trending 10 days tag'] = await median_time_async(lambda: bot.trending.callback(ctx, '10', 'tag 1'))
+        results['random'] = await median_time_async(lambda: bot.random_book.callback(ctx, '', 'loose'))
+        results['random strict'] = await median_time_async(lambda: bot.random_book.callback(ctx, 'tag 1,tag 2', 'strict'))
+        results['random expression'] = await median_time_async(lambda: bot.random_book.callback(ctx, 'tag 1 OR tag 2 AND NOT tag 3', 'loose'))
+        results['profile'] = await median_time_async(lambda: bot.profile.callback(ctx, FakeUser(10**17 + next(picks) % 1000), '1'))
+        started = time.perf_counter()
+        await bot.recommend.callback(FakeContext(guild, 10**17), '5', '')
+        results['recommend build'] = time.perf_counter() - started
+        results['recommend'] = await median_time_async(lambda: bot.recommend.callback(FakeContext(guild, 10**17 + next(picks) % 1000), '5', ''))
+        results['view'] = await median_time_async(lambda: bot.view.callback(ctx, isbns[next(picks) % len(isbns)]))
+        started = time.perf_counter()
+        await bot.list_books.callback(ctx, 'title')
+        results['list build'] = time.perf_counter() - started
+        # Turning to pages all through the library from their cursors, the way the buttons do
+        shelf = library.shelves.by_title
+        cursors = shelf[::max(len(shelf) // REPEAT, 1)]
+        results['list page'] = await median_time_async(lambda: library.browse('title', bot.LIST_PAGE, after=cursors[next(picks) % len(cursors)]))
+        results['list page rating'] = await median_time_async(lambda: library.browse('rating', bot.LIST_PAGE, before=library.rankings.favorite[None][-1]))
+        results['search'] = await median_time_async(lambda: bot.search_books.callback(ctx, titles[next(picks) % len(titles)][:8], 'title'))
+        # Slash command suggestions have to come back within Discord's deadline however little has been typed
+        results['autocomplete'] = await median_time_async(lambda: bot.suggest_books(ctx, titles[next(picks) % len(titles)][:3]))
+        # Everything matching, a title matching only itself so authors get searched too, and nothing matching at all
+        worst = ['', titles[0][0], titles[0], library.books[isbns[0]].author, '\uffff']
+        results['autocomplete worst'] = max([await median_time_async(lambda: bot.suggest_books(ctx, prefix)) for prefix in worst])
+        results['autocomplete tag'] = max([await median_time_async(lambda: bot.suggest_tags(ctx, prefix)) for prefix in ('', 'tag 1, t', 'zz')])
+        # Every finish is by a new user so it always writes a completion and a rating
+        results['finish'] = await median_time_async(lambda: bot.finish.callback(FakeContext(guild, next(picks)), isbns[next(picks) % len(isbns)], '7'))
+        results['add'] = await median_time_async(lambda: bot.add.callback(ctx, 'Bench book', 'Bench author', convert(f'{books + next(picks):09d}'), 'tag 1'))
+        ctx.sent.clear()
+    asyncio.run(commands())
+
+    # What instrumentation adds to every command, to compare against the commands themselves
+    results['perf overhead'] = median_time(lambda: (metrics.observe_command('bench', 0.001), metrics.observe_send(0.001)))
+
+    def flush ():
+        for _ in range(100):
+            library.complete(isbns[next(picks) % len(isbns)], next(picks))
+        # Leave compaction to its own benchmark
+        if db.BACKEND == 'json':
+            library.journal_bytes = 0
+            library.needs_snapshot = False
+        library.flush()
+    results['flush 100 writes'] = median_time(flush, 10)
+
+    if db.BACKEND == 'json':
+        results['compact'] = median_time(lambda: library.compact(library.snapshot()), 1)
+        # Compacting left a snapshot behind, so this is how long every start after the first takes
+        results['load snapshot'] = median_time(lambda: db.JsonLibrary(library.path), 1)
+
+    db.libraries.loaded.pop(guild.id).close()
+    return results
+
+def run_contention (books:int, workdir:str) -> dict :
+    '''
+    Latency of lib!view, counted from when it should have started so time spent waiting on a blocked event loop shows up,
+    while recommendations are rebuilt and fuzzy titles looked up over and over. Once with everything inline and once offloaded
+    '''
+    rng = random.Random(books)
+    guild = FakeGuild(books)
+    shutil.copy(library_file(books), os.path.join(workdir, f'{books}.json'))
+    if db.BACKEND == 'sqlite':
+        from sqlite_db import migrate
+        migrate(os.path.join(workdir, f'{books}.json'), os.path.join(workdir, f'{books}.sqlite'))
+    results = {}
+
+    async def contend (offloaded:bool):
+        offload.OFFLOAD_BOOKS = 0 if offloaded else 10**12
+        library = await db.library(guild)
+        isbns = rng.sample(list(library.books), min(REPEAT, len(library.books)))
+        if offloaded:
+            # Not counting the worker's first load of the library
+            await offload.run(library, offload.size)
+        ctx = FakeContext(guild)
+        done = False
+        latencies = []
+
+        async def heavy ():
+            nonlocal done
+            for i in range(3):
+                library.recommender.similarity = None
+                await library.recommendations(10**17 + i, 5)
+                library.titles.unposted.update(library.titles.entries)
+                await validate(guild, f'Night house girl {i} x')
+            done = True
+
+        task = asyncio.create_task(heavy())
+        while not done:
+            due = time.perf_counter() + 0.01
+            await asyncio.sleep(0.01)
+            await bot.view.callback(ctx, rng.choice(isbns))
+            latencies.append(time.perf_counter() - due)
+            ctx.sent.clear()
+        await task
+        db.libraries.loaded.pop(guild.id).close()
+
+        latencies.sort()
+        label = 'offloaded' if offloaded else 'inline'
+        results[f'view p50 {label}'] = latencies[len(latencies) // 2]
+        results[f'view p99 {label}'] = latencies[len(latencies) * 99 // 100]
+        results[f'view max {label}'] = latencies[-1]
+
+    asyncio.run(contend(False))
+    asyncio.run(contend(True))
+    offload.shutdown()
+    return results
+
+def run_render (books:int, workdir:str, burst:int = 50) -> dict :
+    '''
+    Bursts of the same command back to back the way a busy channel sends them, with the rendered embed caches hot and with them
+    emptied before every command. Results are per command, the median over REPEAT // 10 bursts
+    '''
+    rng = random.Random(books)
+    guild = FakeGuild(books)
+    shutil.copy(library_file(books), os.path.join(workdir, f'{books}.json'))
+    if db.BACKEND == 'sqlite':
+        from sqlite_db import migrate
+        migrate(os.path.join(workdir, f'{books}.json'), os.path.join(workdir, f'{books}.sqlite'))
+    docs.build_help_cache(bot.bot)
+    results = {}
+
+    async def bursts ():
+        library = await db.library(guild)
+        # A handful of books everyone's looking at, fewer than fit in the cache
+        isbns = rng.sample(list(library.books), min(20, len(library.books)))
+        ctx = FakeContext(guild)
+        # Not counting building the shelves and rankings the first time
+        await bot.list_books.callback(ctx, 'title')
+        await bot.stats.callback(ctx)
+        commands = {
+            'list': lambda: bot.list_books.callback(ctx, 'title'),
+            'stats': lambda: bot.stats.callback(ctx),
+            'view': lambda: bot.view.callback(ctx, isbns[rng.randrange(len(isbns))]),
+            'help': lambda: bot.help.callback(ctx, 'view'),
+        }
+        help_embeds = dict(docs.help_embeds)
+
+        def cool ():
+            bot.book_embeds.entries.clear()
+            docs.help_embeds.clear()
+
+        for name, command in commands.items():
+            async def hot ():
+                for _ in range(burst):
+                    await command()
+                ctx.sent.clear()
+
+            async def cold ():
+                for _ in range(burst):
+                    cool()
+                    await command()
+                ctx.sent.clear()
+
+            await hot()
+            bot.book_embeds.stats = {'hits': 0, 'misses': 0, 'render_time': 0.0}
+            results[f'{name} hot'] = await median_time_async(hot, REPEAT // 10) / burst
+            hit_rate = bot.book_embeds.hit_rate()
+            results[f'{name} cold'] = await median_time_async(cold, REPEAT // 10) / burst
+            docs.help_embeds.update(help_embeds)
+            if name == 'view':
+                print(f'  view hot hit rate {round(hit_rate * 100, 1)}%, {round(bot.book_embeds.time_saved() * 1000, 1)}ms of rendering saved in the hot bursts')
+        db.libraries.loaded.pop(guild.id).close()
+
+    asyncio.run(bursts())
+    return results
+
+def run_export (books:int, workdir:str) -> dict :
+    '''
+    Times streaming the library out in each format, and prints the most memory each export allocated alongside how big
+    the export is, which should stay the same however big the library gets
+    '''
+    guild = FakeGuild(books)
+    shutil.copy(library_file(books), os.path.join(workdir, f'{books}.json'))
+    if db.BACKEND == 'sqlite':
+        from sqlite_db import migrate
+        migrate(os.path.join(workdir, f'{books}.json'), os.path.join(workdir, f'{books}.sqlite'))
+    library = db.libraries.get(guild.id)
+    directory = os.path.join(workdir, 'export')
+    os.makedirs(directory, exist_ok=True)
+    results = {}
+
+    async def exports ():
+        for format in export.FORMATS:
+            # Split at Discord's default upload limit like lib!export does
+            limit = discord.utils.DEFAULT_FILE_SIZE_LIMIT_BYTES - export.UPLOAD_MARGIN
+            started = time.perf_counter()
+            paths = await export.export(library, format, None, directory, limit)
+            results[f'export {format}'] = time.perf_counter() - started
+            size = sum(os.path.getsize(path) for path in paths)
+
+            tracemalloc.start()
+            await export.export(library, format, None, directory, limit)
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+            print(f'  {format:<8} {size / 1024**2:>8.1f}MB in {len(paths)} files, {peak / 1024**2:.2f}MB allocated at most')
+            for path in paths:
+                os.remove(path)
+    asyncio.run(exports())
+
+    db.libraries.loaded.pop(guild.id).close()
+    return results
+
+def run_trending (books:int, days:int = 540, per_day:int = 20_000) -> dict :
+    '''
+    Times recording finishes and ratings and listing what's trending over a year and a half of them, printing how many
+    per-book counts are kept as it goes, which should level off once buckets start being merged into weeks and dropped
+    '''
+    rng = random.Random(books)
+    log = activity.Activity()
+    start = int(time.time()) - days * activity.DAY
+    results = {}
+    recording = 0.0
+    for day in range(days):
+        # Popularity follows a long tail, so some books are busy every day and most hardly ever come up
+        events = [(f'{int(rng.paretovariate(0.8)) % books:013d}', start + day * activity.DAY + rng.randrange(activity.DAY)) for _ in range(per_day)]
+        events.sort(key=lambda event: event[1])
+        started = time.perf_counter()
+        for isbn, at in events:
+            log.record(isbn, at)
+        recording += time.perf_counter() - started
+        if day % 90 == 89:
+            print(f'  day {day + 1:>4}: {log.buckets()} counts in {len(log.days)} days and {len(log.weeks)} weeks')
+    results['record'] = recording / (days * per_day)
+
+    now = start + days * activity.DAY
+    for window in (7, 30, 90, activity.MAX_DAYS):
+        results[f'top {window}'] = median_time(lambda: log.top(window, bot.TRENDING, now), 20)
+    # The first event of a new day moves every window on by a day
+    results['advance'] = median_time(lambda: log.advance(log.today + 1), 20)
+    return results
+
+def run_memory (books:int = 100_000, ratings_per_book:int = 10) -> dict :
+    '''
+    Prints how much memory a library's books take as the dicts json parses them into (how they were kept before Book) and as
+    Book records, with ratings_per_book ratings on average (1M at the defaults). Times both ways of loading them
+    '''
+    users = 1000
+    print(f'Generating {books} books...')
+    text = json.dumps(synthetic.generate(books, users=users, ratings_density=ratings_per_book / users)['books'])
+    results = {}
+
+    tracemalloc.start()
+    dicts = json.loads(text)
+    as_dicts = tracemalloc.get_traced_memory()[0]
+    records = {isbn: Book.from_dict(book) for isbn, book in dicts.items()}
+    as_books = tracemalloc.get_traced_memory()[0] - as_dicts
+    tracemalloc.stop()
+    ratings = sum(len(book.raters) for book in records.values())
+    completions = sum(len(book.completions) for book in records.values())
+    print(f'  {ratings} ratings and {completions} completions')
+    print(f'  {as_dicts / books:>6.0f} bytes per book as dicts')
+    print(f'  {as_books / books:>6.0f} bytes per book as Books, {as_books / as_dicts:.0%} of the dicts')
+    del records
+
+    started = time.perf_counter()
+    dicts = json.loads(text)
+    results['parse'] = time.perf_counter() - started
+    started = time.perf_counter()
+    {isbn: Book.from_dict(book) for isbn, book in dicts.items()}
+    results['to books'] = time.perf_counter() - started
+    return results
+
+def run_isbn (count:int = 1_000_000) -> dict :
+    '''
+    Times canonicalising ISBNs one at a time like lib!add does against canonical_many like imports do, over a mix of hyphenated
+    ISBN-10s, ISBN-13s and a few bad ones the way a real spreadsheet has them. Results are per ISBN
+    '''
+    rng = random.Random(count)
+    isbns = []
+    for _ in range(count):
+        key = convert(f'{rng.randrange(10**9):09d}')
+        kind = rng.random()
+        if kind < 0.4:
+            # The ISBN-10 for it, hyphenated
+            isbn10 = key[3:12]
+            check = sum(int(digit) * weight for weight, digit in enumerate(isbn10, 1)) % 11
+            isbns.append(f'{isbn10[0]}-{isbn10[1:4]}-{isbn10[4:9]}-{"X" if check == 10 else check}')
+        elif kind < 0.95:
+            isbns.append(key)
+        else:
+            isbns.append(key[:12] + str((int(key[12]) + 1) % 10))
+
+    def one_at_a_time ():
+        keys = []
+        for raw in isbns:
+            try:
+                keys.append(canonical(raw))
+            except (LengthError, ValidationError):
+                keys.append(None)
+        return keys
+
+    results = {}
+    started = time.perf_counter()
+    expected = one_at_a_time()
+    results['per item'] = (time.perf_counter() - started) / count
+    started = time.perf_counter()
+    batched = canonical_many(isbns)
+    results['batched'] = (time.perf_counter() - started) / count
+    if batched != expected:
+        raise AssertionError('canonical_many disagrees with canonical')
+
+    print(f'  {count} ISBNs, {expected.count(None)} invalid, batched {results["per item"] / results["batched"]:.1f}x faster' + (' with numpy' if numpy != None else ' without numpy'))
+    return results
+
+def run_recommender (users:int, books:int, per_user:int) -> dict :
+    ''' Times building the similarities from scratch, refreshing after new ratings, and asking for recommendations '''
+    rng = random.Random(users)
+    print(f'Generating {users} users rating {books} books...')
+    ratings = synthetic.ratings(users, books, per_user)
+    results = {}
+
+    started = time.perf_counter()
+    similarity = recommend.build(ratings)
+    results['build'] = time.perf_counter() - started
+
+    recommender = recommend.Recommender()
+    recommender.similarity = similarity
+    people = rng.sample(list(ratings), min(REPEAT, users))
+    picks = iter(range(10**9))
+    results['query'] = median_time(lambda: recommender.recommend(ratings[people[next(picks) % len(people)]], (), 10))
+
+    # 100 new ratings on random books, refreshed the way the bot does it
+    rated = rng.sample(similarity.items, 100)
+    for isbn in rated:
+        ratings[rng.choice(people)][isbn] = rng.randint(1, 10)
+    raters = {isbn: [user for user in ratings.values() if isbn in user] for isbn in rated}
+    norms = {other: similarity.norm(other) for rated in raters.values() for user in rated for other in user}
+    started = time.perf_counter()
+    similarity.apply(recommend.refresh_rows(raters, norms))
+    results['refresh 100 books'] = time.perf_counter() - started
+    return results
+
+async def mutate (libraries:list, mutations:int, seed:int):
+    ''' Finishes, rates and retags random books the way a busy server would, letting the event loop run between bursts '''
+    rng = random.Random(seed)
+    isbns = [rng.sample(list(library.books), min(200, len(library.books))) for library in libraries]
+    for i in range(mutations):
+        which = rng.randrange(len(libraries))
+        library, isbn, user = libraries[which], rng.choice(isbns[which]), 10**17 + rng.randrange(1000)
+        roll = rng.random()
+        if roll < 0.5:
+            library.complete(isbn, user)
+        elif roll < 0.9:
+            library.rate(isbn, user, rng.randint(1, 10))
+        else:
+            book = library.books[isbn].to_dict()
+            library.append_data({isbn: {**book, 'tags': book['tags'] + [f'retagged {i}']}})
+        if i % 50 == 49:
+            await asyncio.sleep(0)
+
+def shard_guilds (shard:int, shards:int) -> list :
+    ''' Two servers only this shard serves, and one every shard writes to like the DM library '''
+    return [shard * 2, shard * 2 + 1, shards * 2]
+
+def shard (socket:str, workdir:str, number:int, shards:int, mutations:int, barrier, results):
+    ''' One bot process sharing the storage service, run in its own process by run_shards '''
+    db.LIBRARIES_PATH = workdir
+    guilds = shard_guilds(number, shards)
+
+    async def main ():
+        client = await storage.connect(socket)
+        db.libraries.client = client
+        libraries = [await db.library(FakeGuild(guild)) for guild in guilds]
+        await client.sync()
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, barrier.wait)
+
+        started = time.perf_counter()
+        await mutate(libraries, mutations, number)
+        await client.sync()
+        elapsed = time.perf_counter() - started
+        # Once every shard's writes are in, every copy should match the service's
+        await loop.run_in_executor(None, barrier.wait)
+        matching = 0
+        for guild, library in zip(guilds, libraries):
+            seq, expected = await client.digest(guild)
+            matching += library.seq == seq and storage.digest(library) == expected
+        await client.close()
+        return elapsed, matching
+
+    results.put(asyncio.run(main()))
+
+def run_shards (books:int, workdir:str, shards:int, mutations:int = 5000) -> dict :
+    '''
+    Mutation throughput with shards bot processes writing through the storage service, against one process doing all of their
+    writes itself, and whether every shard's copy of every library ends up matching the service's
+    '''
+    guilds = shards * 2 + 1
+    for guild in range(guilds):
+        shutil.copy(library_file(books), os.path.join(workdir, f'{guild}.json'))
+    results = {}
+
+    async def direct ():
+        libraries = {guild: await db.library(FakeGuild(guild)) for guild in range(guilds)}
+        started = time.perf_counter()
+        await asyncio.gather(*(
+            mutate([libraries[guild] for guild in shard_guilds(number, shards)], mutations, number)
+            for number in range(shards)
+        ))
+        results['mutation direct'] = (time.perf_counter() - started) / (mutations * shards)
+        for guild in range(guilds):
+            db.libraries.loaded.pop(guild).close()
+    asyncio.run(direct())
+    for guild in range(guilds):
+        for extension in ('.snap', '.journal'):
+            if os.path.exists(os.path.join(workdir, f'{guild}{extension}')):
+                os.remove(os.path.join(workdir, f'{guild}{extension}'))
+
+    context = multiprocessing.get_context('spawn')
+    socket = os.path.join(workdir, 'storage.sock')
+    service = context.Process(target=storage.run_service, args=(socket, workdir))
+    service.start()
+    while not os.path.exists(socket):
+        if not service.is_alive():
+            raise RuntimeError('The storage service exited before it started listening')
+        time.sleep(0.05)
+    barrier = context.Barrier(shards)
+    queue = context.Queue()
+    processes = [context.Process(target=shard, args=(socket, workdir, number, shards, mutations, barrier, queue)) for number in range(shards)]
+    for process in processes:
+        process.start()
+    finished = [queue.get() for _ in processes]
+    for process in processes:
+        process.join()
+    service.terminate()
+    service.join()
+
+    results['mutation sharded'] = max(elapsed for elapsed, _ in finished) / (mutations * shards)
+    matching = sum(matched for _, matched in finished)
+    print(f'  {matching} of {shards * 3} shard copies match the storage service')
+    if matching != shards * 3:
+        raise AssertionError('Shard copies drifted from the storage service')
+    return results
+
+def run_rest (workdir:str) -> dict :
+    '''
+    REST requests each command makes through the bot's real HTTP client against a local stand-in for Discord, then how long
+    bursts take once a channel's rate limit runs out, and with 429s thrown in on top
+    '''
+    shutil.copy(library_file(1_000), os.path.join(workdir, '1.json'))
+    server = fakediscord.FakeDiscord(limit=5, window=0.5)
+    prefix = bot.bot.command_prefix
+    results = {}
+
+    async def run ():
+        await server.start()
+        await fakediscord.connect(bot.bot, server)
+        library = await db.library(FakeGuild(1))
+        isbns = list(library.books)[:20]
+        csv = '\n'.join(['title,author,isbn', *(f'Imported {i},Someone,{convert(f"{900_000_000 + i:09d}")}' for i in range(20))]).encode()
+
+        async def command (content:str, channel:int = 2, attachments:list = []):
+            await bot.bot.process_commands(fakediscord.message(bot.bot, content, channel_id=channel, attachments=attachments))
+
+        async def count (name:str, content:str, **kwargs):
+            before = server.count()
+            await command(content, **kwargs)
+            print(f'  {name:<20}{server.count() - before:>5} REST requests')
+
+        # A fresh channel per command so none of them wait on another's bucket
+        await count('add', f'{prefix}add "Bench book" "Bench author" {convert("800000000")} "tag 1"', channel=10)
+        await count('add duplicate', f'{prefix}add "Bench book" "Bench author" {convert("800000000")}', channel=11)
+        await count('view', f'{prefix}view {isbns[0]}', channel=12)
+        await count('finish', f'{prefix}finish {isbns[1]} 8', channel=13)
+        await count('list', f'{prefix}list', channel=14)
+        await count('import', f'{prefix}import', channel=15, attachments=[server.attach('books.csv', csv)])
+        # Slow enough for the placeholder to go up, which the result then replaces
+        bot.WORKING_DELAY = 0
+        await count('import slow', f'{prefix}import', channel=16, attachments=[server.attach('more.csv', csv)])
+        bot.WORKING_DELAY = 1.0
+
+        # 20 views at once in one channel, four times what its bucket allows per window
+        before = server.count(429)
+        started = time.perf_counter()
+        await asyncio.gather(*(command(f'{prefix}view {isbn}', channel=20) for isbn in isbns))
+        results['burst 20 views'] = time.perf_counter() - started
+        print(f'  {"burst 429s":<20}{server.count(429) - before:>5}')
+
+        server.fail_every = 4
+        before, sent = server.count(429), len(server.messages)
+        started = time.perf_counter()
+        for isbn in isbns[:10]:
+            await command(f'{prefix}view {isbn}', channel=21)
+        results['10 views with 429s'] = time.perf_counter() - started
+        print(f'  {"429s retried":<20}{server.count(429) - before:>5}, {len(server.messages) - sent} of 10 views sent')
+
+        db.libraries.loaded.pop(1).close()
+        await bot.bot.close()
+        await server.stop()
+
+    asyncio.run(run())
+    return results
+
+def catalog_files (editions:int) -> tuple :
+    ''' Paths to a generated catalog dump with this many editions and its authors dump, generating them the first time '''
+    path, authors_path = os.path.join(DATA_PATH, f'catalog {editions}.txt'), os.path.join(DATA_PATH, f'authors {editions}.txt')
+    if not os.path.exists(path):
+        os.makedirs(DATA_PATH, exist_ok=True)
+        print(f'Generating a catalog of {editions} editions...')
+        synthetic.catalog(editions, path + '.tmp', authors_path)
+        os.replace(path + '.tmp', path)
+    return path, authors_path
+
+def resident () -> dict :
+    ''' Resident memory in MB from /proc: all of it, the process' own, and pages of mapped files '''
+    with open('/proc/self/status') as status:
+        fields = dict(line.split(':', 1) for line in status)
+    return {name: int(fields[name].split()[0]) / 1024 for name in ('VmRSS', 'RssAnon', 'RssFile')}
+
+def run_catalog (editions:int) -> dict :
+    '''
+    Indexes a generated catalog dump, then times lookups with the dump's pages dropped from the page cache, with them cached,
+    and from the decoded record cache, and reports how much memory lookups all over the dump keep resident
+    '''
+    path, authors_path = catalog_files(editions)
+    results = {}
+    started = time.perf_counter()
+    catalog.build_index(path)
+    catalog.build_index(authors_path, catalog.author_keys)
+    results['index build'] = time.perf_counter() - started
+    print(f'  {os.path.getsize(path) / 1024**3:.2f}GB dump, {os.path.getsize(catalog.index_path(path)) / 1024**2:.1f}MB index, '
+          f'{resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024:.0f}MB peak resident while indexing')
+
+    rng = random.Random(editions)
+    isbns = [convert(f'{rng.randrange(editions):09d}') for _ in range(REPEAT)]
+    picks = iter(range(10**9))
+    for dump in (path, authors_path):
+        # Nothing's mapped yet, so this leaves the first lookups reading the dump from disk
+        for file_path in (dump, catalog.index_path(dump)):
+            with open(file_path, 'rb') as file:
+                # Pages only leave the page cache once they're written out
+                os.fsync(file.fileno())
+                os.posix_fadvise(file.fileno(), 0, 0, os.POSIX_FADV_DONTNEED)
+
+    before = resident()
+    uncached = catalog.Catalog(path, authors_path, cache_size=0)
+    results['lookup cold'] = median_time(lambda: uncached.lookup(isbns[next(picks) % len(isbns)]))
+    results['lookup'] = median_time(lambda: uncached.lookup(isbns[next(picks) % len(isbns)]))
+    results['lookup missing'] = median_time(lambda: uncached.lookup(convert(f'{editions + next(picks):09d}')))
+    cached = catalog.Catalog(path, authors_path)
+    for isbn in isbns:
+        cached.lookup(isbn)
+    results['lookup cached'] = median_time(lambda: cached.lookup(isbns[next(picks) % len(isbns)]))
+
+    for _ in range(10_000):
+        cached.lookup(convert(f'{rng.randrange(editions):09d}'))
+    after = resident()
+    print(f'  {after["VmRSS"] - before["VmRSS"]:.1f}MB more resident after 10k lookups: {after["RssAnon"] - before["RssAnon"]:.1f}MB the '
+          f'process\' own (record cache included), {after["RssFile"] - before["RssFile"]:.1f}MB of the dump and index mapped in')
+    uncached.close()
+    cached.close()
+    return results
+
+def load_baselines () -> dict :
+    if not os.path.exists(BASELINES_PATH):
+        return {}
+    with open(BASELINES_PATH, 'r') as file:
+        return json.load(file)
+
+def save_baselines (baselines:dict):
+    with open(BASELINES_PATH, 'w') as file:
+        json.dump(baselines, file, indent=4, sort_keys=True)
+
+def compare (results:dict, baseline:dict, threshold:float) -> list :
+    ''' Names of hot paths more than threshold (0.25 = 25%) slower than their baseline '''
+    return [name for name, seconds in results.items() if name in baseline and seconds > baseline[name] * (1 + threshold)]
+
+def report (label:str, results:dict, baseline:dict) -> str :
+    lines = [label]
+    for name, seconds in results.items():
+        line = f'  {name:<20}{seconds * 1e6:>14.1f}us'
+        if name in baseline:
+            line += f'  {seconds / baseline[name]:>6.2f}x baseline'
+        lines.append(line)
+    return '\n'.join(lines)
+
+if __name__ == '__main__':
+    # python bench.py [scales] [--backend json|sqlite] [--save] [--check] [--threshold 0.25]
+    parser = argparse.ArgumentParser(description='Times the bot\'s hot paths against generated libraries, no token needed')
+    parser.add_argument('scales', nargs='*', help=f'any of {", ".join(SCALES)}, defaults to all of them')
+    parser.add_argument('--backend', default=db.BACKEND, choices=['json', 'sqlite'])
+    parser.add_argument('--save', action='store_true', help=f'store the results as the new baselines in {BASELINES_PATH}')
+    parser.add_argument('--check', action='store_true', help='exit with an error if anything is slower than its baseline by more than the threshold')
+    parser.add_argument('--threshold', type=float, default=0.25)
+    parser.add_argument('--isbn', action='store_true', help='only time canonicalising 1M ISBNs one at a time and batched')
+    parser.add_argument('--rec', action='store_true', help='only time the recommendation engine, at 100k users by 100k books')
+    parser.add_argument('--memory', action='store_true', help='only measure bytes per book, as dicts and as Books, for 100k books with 1M ratings')
+    parser.add_argument('--contention', action='store_true', help='time lib!view while heavy queries run, inline and offloaded to workers')
+    parser.add_argument('--render', action='store_true', help='time bursts of lib!list, lib!stats, lib!view and lib!help with the embed caches hot and cold')
+    parser.add_argument('--export', action='store_true', help='time lib!export in every format and check its memory stays bounded')
+    parser.add_argument('--trending', action='store_true', help="time lib!trending's activity log over a year and a half of finishes and ratings")
+    parser.add_argument('--rest', action='store_true', help='count the REST requests commands make against a local stand-in for Discord')
+    parser.add_argument('--catalog', type=int, default=0, help='time catalog lookups in a generated dump with this many editions (2000000 is about 2.5GB)')
+    parser.add_argument('--shards', type=int, default=0, help='time mutations from this many bot processes sharing a storage service')
+    args = parser.parse_args()
+    for scale in args.scales:
+        if scale not in SCALES:
+            parser.error(f'Unknown scale {scale}, pick from {", ".join(SCALES)}')
+
+    db.BACKEND = args.backend
+    baselines = load_baselines()
+    regressions = []
+    if args.catalog != 0:
+        results = run_catalog(args.catalog)
+        name = f'catalog {args.catalog}'
+        baseline = baselines.get(name, {})
+        print(report(name, results, baseline))
+        regressions += [f'{name} {result}' for result in compare(results, baseline, args.threshold)]
+        if args.save:
+            baselines[name] = results
+    elif args.rest:
+        with tempfile.TemporaryDirectory() as workdir:
+            db.LIBRARIES_PATH = workdir
+            results = run_rest(workdir)
+        baseline = baselines.get('rest', {})
+        print(report('rest', results, baseline))
+        regressions += [f'rest {name}' for name in compare(results, baseline, args.threshold)]
+        if args.save:
+            baselines['rest'] = results
+    elif args.memory:
+        results = run_memory()
+        baseline = baselines.get('memory', {})
+        print(report('memory 100k books x 1M ratings', results, baseline))
+        regressions += [f'memory {name}' for name in compare(results, baseline, args.threshold)]
+        if args.save:
+            baselines['memory'] = results
+    elif args.isbn:
+        results = run_isbn()
+        baseline = baselines.get('isbn', {})
+        print(report('isbn 1M', results, baseline))
+        regressions += [f'isbn {name}' for name in compare(results, baseline, args.threshold)]
+        if args.save:
+            baselines['isbn'] = results
+    elif args.rec:
+        results = run_recommender(100_000, 100_000, 20)
+        baseline = baselines.get('recommend', {})
+        print(report('recommend 100k users x 100k books', results, baseline))
+        regressions += [f'recommend {name}' for name in compare(results, baseline, args.threshold)]
+        if args.save:
+            baselines['recommend'] = results
+    else:
+        with tempfile.TemporaryDirectory() as workdir:
+            db.LIBRARIES_PATH = workdir
+            for scale in args.scales or SCALES:
+                if args.shards != 0:
+                    name = f'{scale} {args.shards} shards'
+                    results = run_shards(SCALES[scale], workdir, args.shards)
+                elif args.trending:
+                    name = f'{scale} trending'
+                    results = run_trending(SCALES[scale])
+                elif args.render:
+                    name = f'{scale} render'
+                    results = run_render(SCALES[scale], workdir)
+                elif args.export:
+                    name = f'{scale} export'
+                    results = run_export(SCALES[scale], workdir)
+                elif args.contention:
+                    name = f'{scale} contention'
+                    results = run_contention(SCALES[scale], workdir)
+                else:
+                    name = scale
+                    results = run_scale(SCALES[scale], workdir)
+                baseline = baselines.get(db.BACKEND, {}).get(name, {})
+                print(report(f'{db.BACKEND} {name}', results, baseline))
+                regressions += [f'{db.BACKEND} {name} {result}' for result in compare(results, baseline, args.threshold)]
+                if args.save:
+                    baselines.setdefault(db.BACKEND, {})[name] = results
+
+    if args.save:
+        save_baselines(baselines)
+        print(f'Saved baselines to {BASELINES_PATH}')
+    if args.check and regressions != []:
+        print(f'Slower than baseline by more than {round(args.threshold * 100)}%: ' + ', '.join(regressions))
+        sys.exit(1)
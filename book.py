@@ -0,0 +1,104 @@
+import sys
+from array import array
+from bisect import bisect_left
+
+# Every distinct tag string is stored once and books refer to it by id
+tag_names:list = []
+tag_ids:dict = {}
+
+def intern_tag (tag:str) -> int :
+    if tag not in tag_ids:
+        tag_ids[tag] = len(tag_names)
+        tag_names.append(sys.intern(tag))
+    return tag_ids[tag]
+
+def finishes (book:dict) -> list :
+    ''' (user id, when they finished it) for everyone who's finished a book in the db.json shape, 0 when that isn't known '''
+    finished = book.get("finished", {})
+    return [(int(user), int(finished.get(str(user), 0))) for user in dict.fromkeys(int(user) for user in book["completions"])]
+
+class Book:
+    '''
+    Compact in-memory form of a db.json book.
+    Completions and raters are sorted arrays of user ids so membership is a binary search, scores lines up with raters,
+    and finished with completions (when each one was, 0 for finishes from before timestamps).
+    Books are never edited in place, changes return a new Book so snapshots being written stay consistent.
+    '''
+
+    __slots__ = ('title', 'author', 'isbn', 'tag_ids', 'completions', 'raters', 'scores', 'finished')
+
+    def __init__ (self, title:str, author:str, isbn:str, tag_ids:tuple, completions:array, raters:array, scores:array, finished:array):
+        self.title = title
+        self.author = author
+        self.isbn = isbn
+        self.tag_ids = tag_ids
+        self.completions = completions
+        self.raters = raters
+        self.scores = scores
+        self.finished = finished
+
+    @classmethod
+    def from_dict (cls, book:dict):
+        ratings = sorted((int(user), int(rating)) for user, rating in book["ratings"].items())
+        completions = sorted(finishes(book))
+        return cls(
+            book["title"],
+            book["author"],
+            book["isbn"],
+            tuple(intern_tag(tag) for tag in book["tags"]),
+            array('Q', [user for user, _ in completions]),
+            array('Q', [user for user, _ in ratings]),
+            array('B', [rating for _, rating in ratings]),
+            array('Q', [at for _, at in completions]),
+        )
+
+    def to_dict (self) -> dict :
+        ''' The book in the db.json schema '''
+        return {
+            'title': self.title,
+            'author': self.author,
+            'isbn': self.isbn,
+            'tags': self.tags,
+            # Ratings are keyed by stringified user ids in db.json
+            'ratings': {str(user): rating for user, rating in zip(self.raters, self.scores)},
+            'completions': list(self.completions),
+            # When each user finished it, also keyed by stringified user id, leaving out finishes from before timestamps
+            'finished': {str(user): at for user, at in zip(self.completions, self.finished) if at != 0},
+        }
+
+    @property
+    def tags (self) -> list :
+        return [tag_names[tag] for tag in self.tag_ids]
+
+    def completed (self, user:int) -> bool :
+        index = bisect_left(self.completions, user)
+        return index < len(self.completions) and self.completions[index] == user
+
+    def rating (self, user:int) -> int | None :
+        index = bisect_left(self.raters, user)
+        if index < len(self.raters) and self.raters[index] == user:
+            return self.scores[index]
+        return None
+
+    def finishes (self):
+        ''' (user id, when they finished it) for everyone who has '''
+        return zip(self.completions, self.finished)
+
+    def with_completion (self, user:int, at:int = 0):
+        if self.completed(user):
+            return self
+        completions, finished = array('Q', self.completions), array('Q', self.finished)
+        index = bisect_left(completions, user)
+        completions.insert(index, user)
+        finished.insert(index, at)
+        return Book(self.title, self.author, self.isbn, self.tag_ids, completions, self.raters, self.scores, finished)
+
+    def with_rating (self, user:int, rating:int):
+        raters, scores = array('Q', self.raters), array('B', self.scores)
+        index = bisect_left(raters, user)
+        if index < len(raters) and raters[index] == user:
+            scores[index] = rating
+        else:
+            raters.insert(index, user)
+            scores.insert(index, rating)
+        return Book(self.title, self.author, self.isbn, self.tag_ids, self.completions, raters, scores, self.finished)
\ No newline at end of file
@@ -1,31 +1,143 @@
 # system
-from random import choice
+import asyncio
+import io
+import re
+import tempfile
+import time
 from dotenv import dotenv_values
 from datetime import datetime
-from statistics import mean
 # discord.py
 import discord
+from discord import app_commands
 from discord.ext import commands
 # homebrew
-from isbn import LengthError, ValidationError, validate
+from isbn import LengthError, ValidationError, canonical
+import activity
+import catalog
 import db
-from docs import help_embed
-books = db.library_data["books"]
+from docs import build_help_cache, help_embed
+import export
+import importer
+import offload
+from perf import metrics
+from render import RenderCache
+import rest
+from shelves import ORDERS
+import storage
+from tags import bracketed
 
 config = dotenv_values('.env')
 
 intents = discord.Intents.default()
 intents.message_content = True
 
-bot = commands.Bot(command_prefix=config["PREFIX"], intents=intents, activity=discord.Activity(name='the Village Library', type=discord.ActivityType.watching), help_command=None )  # type: ignore
+# Set to split the bot across processes sharing a storage service: SHARD_COUNT in total, with this process running SHARD_IDS (like 0,1)
+SHARD_COUNT = int(config.get('SHARD_COUNT') or 0)
+SHARD_IDS = [int(id) for id in (config.get('SHARD_IDS') or '').split(',') if id.strip() != '']
+
+# Seconds a command can take before a placeholder goes up saying it's being worked on
+WORKING_DELAY = 1.0
+
+class ResponseContext (commands.Context):
+    '''
+    Context that answers each command with as few REST requests as it can. A slow command's placeholder only goes up once it's
+    taken WORKING_DELAY seconds and only if the channel has requests to spare, and the reply edits it in place instead of
+    sending another message. Every send is timed for lib!perf
+    '''
+
+    placeholder = None
+    sending_placeholder = False
+
+    def working (self, embed):
+        ''' Shows embed while the command carries on if it takes a while. Whatever the command sends next replaces it '''
+        self.placeholder = asyncio.get_running_loop().create_task(self.show_placeholder(embed))
+
+    async def show_placeholder (self, embed):
+        await asyncio.sleep(WORKING_DELAY)
+        route = discord.http.Route('POST', '/channels/{channel_id}/messages', channel_id=self.channel.id)
+        # Not worth spending the last few requests in the channel's bucket on, the reply needs them more
+        if not rest.has_spare(route.method, route.url):
+            return None
+        self.sending_placeholder = True
+        return await super().send(embed=embed)
+
+    async def take_placeholder (self):
+        ''' The placeholder message if it went up, making sure it never does if it hasn't started to '''
+        task, self.placeholder = self.placeholder, None
+        if task == None:
+            return None
+        if not task.done() and not self.sending_placeholder:
+            task.cancel()
+            return None
+        try:
+            return await task
+        except discord.HTTPException:
+            return None
+
+    async def send (self, content=None, *, embed=None, embeds=None, file=None, files=None, view=None, **kwargs):
+        started = time.perf_counter()
+        try:
+            placeholder = await self.take_placeholder()
+            if placeholder != None and kwargs != {}:
+                # Edits can't take everything sends can, so this one goes out as its own message and the placeholder comes down
+                try:
+                    await placeholder.delete()
+                except discord.HTTPException:
+                    pass
+            if placeholder == None or kwargs != {}:
+                return await super().send(content, embed=embed, embeds=embeds, file=file, files=files, view=view, **kwargs)
+
+            # One edit instead of sending the reply and deleting the placeholder
+            return await placeholder.edit(
+                content=content,
+                embeds=[embed] if embed != None else embeds or [],
+                attachments=[file] if file != None else files or [],
+                view=view
+            )
+        finally:
+            metrics.observe_send(time.perf_counter() - started)
+
+class Librarian (commands.AutoShardedBot if SHARD_COUNT != 0 else commands.Bot):
+    async def get_context (self, origin, *, cls=ResponseContext):
+        return await super().get_context(origin, cls=cls)
+
+    async def close (self):
+        await super().close()
+        # Libraries unloaded just before stopping might still be saving
+        await db.libraries.wait_closed()
+        if db.libraries.client != None:
+            # Make sure the storage service has every change this process made before it exits
+            await db.libraries.client.close()
+
+shards = {'shard_count': SHARD_COUNT, 'shard_ids': SHARD_IDS or None} if SHARD_COUNT != 0 else {}
+bot = Librarian(command_prefix=config.get("PREFIX") or "lib!", intents=intents, activity=discord.Activity(name='the Village Library', type=discord.ActivityType.watching), help_command=None, http_trace=rest.trace(), **shards )  # type: ignore
 
 startTime = datetime.now()
 
+# Anything that's only digits, hyphens, spaces and an X check digit is treated as an ISBN
+ISBN_LIKE = re.compile(r'[0-9][0-9\- ]*[0-9Xx]')
+
+# Recent reads shown per lib!profile page
+PROFILE_PAGE = 10
+# Books shown by lib!trending
+TRENDING = 10
+# Books shown per lib!list and lib!search page
+LIST_PAGE = 10
+# Seconds the buttons under a lib!list or lib!search page keep working after they were last used
+PAGER_TIMEOUT = 300
+
+# Most suggestions Discord shows for an autocompleted option, and the longest each can be
+SUGGESTIONS = 25
+SUGGESTION_LENGTH = 100
+
+# Book embeds, rendered again only once the book changes
+book_embeds = RenderCache()
+
 async def send_unhandled_error(ctx, err):
     error_embed = discord.Embed(
         color=discord.Color.dark_red(),
         title='Unhandled error!',
-        description=f'{config["UNHANDLED_ERROR"]}'
+        description=f'{config.get("UNHANDLED_ERROR", "")}'
     )
     error_embed.add_field(name='Error', value=err)
 
@@ -42,30 +154,82 @@ async def send_named_error(ctx, err, message=''):
 
     await ctx.send(embed=error_embed)
 
-async def validate_book_id(id):
-    try:
-        int(id)
-    except ValueError:
-        for isbn in books:
-            if books[isbn]['title'] == id:
-                return isbn
+async def defer(ctx):
+    ''' Lets Discord know a slash command is being worked on, for when it's about to wait on something that can take longer than Discord's 3 seconds '''
+    if ctx.interaction != None and not ctx.interaction.response.is_done():
+        await ctx.defer()
+
+async def validate_book_id(ctx, id):
+    library = await db.library(ctx.guild)
+    if ISBN_LIKE.fullmatch(id) == None:
+        isbn = library.find_title(id)
+        if isbn != None:
+            return isbn
+
+        # Fuzzy matching has to look through a lot of titles, so big libraries do it in a worker
+        if offload.heavy(library):
+            await defer(ctx)
+        suggestions = await offload.run(library, offload.similar_titles, id, 3)
+        # It might have been unloaded meanwhile
+        library = await db.library(ctx.guild)
+        if suggestions == []:
+            raise ValueError(f'No book titled "{id}" found.')
+        raise ValueError('Did you mean ' + ', '.join(f'"{library.books[isbn].title}"' for isbn in suggestions) + '?')
     else:
-        try:
-            validate(id)
-        except LengthError as err:
-            raise err
-        except ValidationError as err:
-            raise err
-        except Exception as err:
-            raise err
+        isbn = canonical(id)
         
-        if validate(id):
-            print(id)
-            return id
-        else:
-            raise ValueError("Invalid ISBN")
+        if not library.search(isbn):
+            raise ValueError(f"No book with isbn: `{isbn}` found.")
+        return isbn
                 
 
+def format_rating(library, isbn):
+    average = library.average_rating(isbn)
+    return 'N/A' if average == None else f'{round(average, 1)}/10'
+
+def render_book(library, isbn, color):
+    ''' The book's view embed in the given color, straight from book_embeds unless the book changed since it was last shown '''
+    def render():
+        book = library.books[isbn]
+        book_embed = discord.Embed(
+            color=color,
+            title=f""" "{book.title}" """
+        )
+
+        book_embed.add_field(name="Author", value=book.author, inline=True)
+        book_embed.add_field(name="Rating", value=format_rating(library, isbn), inline=True)
+        book_embed.add_field(name="Completions", value=len(book.completions), inline=True)
+        book_embed.add_field(name="Tags", value=', '.join(str(tag) for tag in book.tags) if book.tags != [] else "N/A", inline=False)
+        record = catalog.lookup(isbn)
+        if record != None:
+            if record['pages'] != None:
+                book_embed.add_field(name="Pages", value=record['pages'], inline=True)
+            if record['subjects'] != []:
+                book_embed.add_field(name="Subjects", value=', '.join(record['subjects'][:catalog.SUBJECTS])[:1024], inline=False)
+        book_embed.add_field(name="WorldCat", value=f"https://worldcat.org/search?q={isbn}", inline=False)
+        book_embed.add_field(name="B&N", value=f"https://www.barnesandnoble.com/s/{isbn}", inline=False)
+        return book_embed
+
+    return book_embeds.get((color.value, library.generation, isbn), library.version(isbn), render)
+
+async def validate_book_count(count):
+    try:
+        int(count)
+    except ValueError:
+        raise ValueError("That number doesn't look right! It can only be a whole number from 1 to 25.")
+    else:
+        if int(count) > 25 or int(count) < 1:
+            raise ValueError("You can only list from 1 to 25 books at a time.")
+
+async def validate_days(days):
+    try:
+        int(days)
+    except ValueError:
+        raise ValueError(f"That number of days doesn't look right! It can only be a whole number from 1 to {activity.MAX_DAYS}.")
+    else:
+        if int(days) > activity.MAX_DAYS or int(days) < 1:
+            raise ValueError(f"Trending only goes back from 1 to {activity.MAX_DAYS} days.")
+
 async def validate_book_r8(rating):
     if rating != '':
         try:
@@ -76,6 +240,58 @@ async def validate_book_r8(rating):
             if int(rating) > 10 or int(rating) < 1:
                 raise ValueError("A rating can only be a whole number from 1 to 10.")
 
+def clip(text, length=SUGGESTION_LENGTH):
+    return text if len(text) <= length else text[:length - 1] + '…'
+
+async def suggest_books(interaction, current):
+    ''' Books whose title or author starts with what's been typed so far, answered from the shelves without touching every book '''
+    started = time.perf_counter()
+    library = await db.library(interaction.guild)
+    books = library.books
+    choices = [app_commands.Choice(name=clip(f'{books[isbn].title} by {books[isbn].author}'), value=isbn) for isbn in library.suggest_books(current, SUGGESTIONS)]
+    metrics.observe_command('autocomplete', time.perf_counter() - started, False)
+    return choices
+
+async def suggest_tags(interaction, current):
+    ''' Tags starting with the last of the comma separated tags typed so far, keeping the ones before it '''
+    started = time.perf_counter()
+    library = await db.library(interaction.guild)
+    typed, _, last = current.rpartition(',')
+    before = typed + ', ' if typed != '' else ''
+    choices = [
+        app_commands.Choice(name=clip(before + tag), value=before + tag)
+        for tag in library.suggest_tags(last.strip(), SUGGESTIONS) if len(before + tag) <= SUGGESTION_LENGTH
+    ]
+    metrics.observe_command('autocomplete', time.perf_counter() - started, False)
+    return choices
+
+@bot.event
+async def setup_hook():
+    # Help never changes while the bot is running, so render all of it once
+    build_help_cache(bot)
+    # Event loop lag sampling and the Prometheus export
+    metrics.start()
+    if storage.STORAGE_SOCKET != '':
+        # Libraries are written by the storage service, this process keeps copies in sync with it
+        db.libraries.client = await storage.connect(storage.STORAGE_SOCKET)
+
+@bot.before_invoke
+async def start_timer(ctx):
+    ctx.started = time.perf_counter()
+    # REST requests made from here on count towards this command
+    rest.command.set(ctx.command.qualified_name)
+    # Loading a big library takes seconds
+    if not db.libraries.ready(None if ctx.guild == None else ctx.guild.id):
+        await defer(ctx)
+
+@bot.after_invoke
+async def stop_timer(ctx):
+    # Runs whether or not the command raised
+    metrics.observe_command(ctx.command.qualified_name, time.perf_counter() - ctx.started, ctx.command_failed)
+    if ctx.placeholder != None and not ctx.sending_placeholder:
+        # Finished without replying, so there's nothing left to be working on
+        ctx.placeholder.cancel()
+
 @bot.event
 async def on_ready():
     print(f'Bot authenticated as {bot.user}!')
@@ -94,10 +310,27 @@ async def add(ctx, title: str = '', author:str = '', isbn: str = '', tags: str =
     
     '''
     Adds a book to the library with a "Title", "Author", ISBN, and, optionally, "comma,separated,tags".
+    If the bot has a catalog, just the ISBN and tags will do and the title and author are filled in from it.
     '''
 
+    library = await db.library(ctx.guild)
+
     temp_book = {'title': '', 'author': '', 'isbn': '', 'tags': [], 'ratings': {}, 'completions': []}
 
+    if isbn == '' and ISBN_LIKE.fullmatch(title) != None:
+        # Only an ISBN and maybe tags, so the rest comes from the catalog
+        isbn, tags = title, author
+        try:
+            isbn = canonical(isbn)
+        except (LengthError, ValidationError) as err:
+            await send_named_error(ctx, "That ISBN doesn't look quite right!", f'`Invalid ISBN: {err}`')
+            return
+        record = catalog.lookup(isbn)
+        if record == None or record['author'] == '':
+            await send_named_error(ctx, "That book isn't in the catalog!", 'Add it with its "Title" and "Author" before the ISBN instead.')
+            return
+        title, author = record['title'], record['author']
+
     if title == '':
         await send_named_error(ctx,'''What's the name of the book?''', '`Missing argument: title`')
         return
@@ -109,36 +342,29 @@ async def add(ctx, title: str = '', author:str = '', isbn: str = '', tags: str =
         return
     if tags != '':
         temp_book['tags'] = [tag.strip() for tag in tags.split(',')]
+        if bracketed(temp_book['tags']) != []:
+            await send_named_error(ctx, "Tags can't have brackets in them!", f"`{bracketed(temp_book['tags'])[0]}` couldn't be found by `lib!random` and `lib!rec`.")
+            return
     
     temp_book['title'] = title
     temp_book['author'] = author
     
     try:
-        validate(isbn)
-    except ValueError as err:
+        isbn = canonical(isbn)
+    except (LengthError, ValidationError) as err:
         await send_named_error(ctx, "That ISBN doesn't look quite right!", f'`Invalid ISBN: {err}`')
         return
     except Exception as err:
         await send_unhandled_error(ctx, err)
         return
-    else:
-        if not validate(isbn):
-            await send_named_error(ctx, "Invalid ISBN!")
-            return
     
     temp_book['isbn'] = isbn
     
-    working_message = await ctx.send(
-        embed=discord.Embed(
-            color=discord.Color.yellow(),
-            title=f'Adding "{temp_book["title"]}"'
-        )
-    )
+    # Adding is instant, so this replies once rather than showing that it's working on it first
     try:
-        db.add(temp_book)
+        library.add(temp_book)
     except db.ISBNError:
         await send_named_error(ctx, 'A book with that ISBN already exists!')
-        await working_message.delete(delay=1)
     except Exception as err:
         print('error in exceotion throw')
         await send_unhandled_error(ctx, err)
@@ -152,7 +378,130 @@ async def add(ctx, title: str = '', author:str = '', isbn: str = '', tags: str =
         success_embed.add_field(name='Tags', value=', '.join(str(tag) for tag in temp_book["tags"]) if temp_book["tags"] != [] else "N/A")
 
         await ctx.send(embed=success_embed)
-        await working_message.delete(delay=1)
+
+@bot.command(name='import', brief='Add a whole spreadsheet of books at once!', usage='import (with a .csv attached)')
+async def import_books(ctx):
+    
+    '''
+    Adds every book from an attached CSV file with title, author, isbn, and optionally tags columns. Goodreads library exports work too!
+    Books that are already in the library or have a bad ISBN are skipped and listed at the end.
+    '''
+
+    if ctx.message.attachments == []:
+        await send_named_error(ctx, 'Attach a CSV file to import!', '`Missing attachment: .csv file`')
+        return
+
+    # Big files take a while, and the result replaces this once they're done
+    ctx.working(discord.Embed(
+        color=discord.Color.yellow(),
+        title=f'Importing "{ctx.message.attachments[0].filename}"'
+    ))
+
+    try:
+        data = await ctx.message.attachments[0].read()
+        lines = io.StringIO(data.decode('utf-8-sig'), newline='')
+        # Parsing and validating is the slow part, so keep it off the event loop, and out of the bot's process entirely for big files
+        executor = offload.get_pool() if len(data) >= offload.OFFLOAD_BYTES else None
+        books, rejected = await asyncio.get_running_loop().run_in_executor(executor, importer.prepare, lines)
+    except UnicodeDecodeError:
+        await send_named_error(ctx, "That file doesn't look like a CSV!", '`File must be UTF-8 text`')
+        return
+    except Exception as err:
+        await send_unhandled_error(ctx, err)
+        return
+
+    added = 0
+    # Line of the last book in the last lot that made it into the library
+    reached = 0
+    try:
+        for start in range(0, len(books), importer.COMMIT_SIZE):
+            # Fetched again each time since it could have been unloaded while the file was read or meanwhile
+            library = await db.library(ctx.guild)
+            added += importer.commit(library, books[start:start + importer.COMMIT_SIZE], rejected)
+            reached = books[min(start + importer.COMMIT_SIZE, len(books)) - 1][0]
+            await asyncio.sleep(0)
+    except Exception as err:
+        # Every lot before this one is in the library already, and importing the file again skips those books as duplicates
+        stopped_embed = discord.Embed(
+            color=discord.Color.dark_red(),
+            title=f'The import stopped partway, after adding {added} books!'
+        )
+        stopped_embed.add_field(name='Error', value=err, inline=False)
+        stopped_embed.add_field(name='Finishing it', value=f'Books up to line {reached} were added. Import the same file again to add the rest, the ones already added are skipped.', inline=False)
+        report = discord.File(io.BytesIO(importer.report(added, rejected).encode()), filename='import_report.txt')
+        await ctx.send(embed=stopped_embed, file=report)
+        raise err
+
+    import_embed = discord.Embed(
+        color=discord.Color.green() if added != 0 else discord.Color.red(),
+        title=f'Added {added} books to the library!'
+    )
+    if rejected != []:
+        import_embed.add_field(name=f'Skipped {len(rejected)} rows', value='\n'.join(f'Line {line}: {reason}' for line, reason in rejected[:10]) + ('\n...' if len(rejected) > 10 else ''), inline=False)
+
+    if len(rejected) > 10:
+        # Attach the full list when it won't fit in the embed
+        report = discord.File(io.BytesIO(importer.report(added, rejected).encode()), filename='import_report.txt')
+        await ctx.send(embed=import_embed, file=report)
+    else:
+        await ctx.send(embed=import_embed)
+
+@bot.command(name='export', brief='Download the library as a file!', usage='export csv "scifi,fantasy"')
+async def export_library(ctx, format='json', tags:str = ''):
+
+    '''
+    Sends the library as a file, either a line of json per book with everything in it, or a CSV that `lib!import` can read back.
+    Add .gz to the format (`json.gz` or `csv.gz`) to get it gzipped. Optionally only exports books with tags, like `lib!random` takes them.
+    Libraries too big for one upload come in several parts.
+    '''
+
+    library = await db.library(ctx.guild)
+
+    if format not in export.FORMATS:
+        await send_named_error(ctx, "That format doesn't look right!", f'`Pick from: {", ".join(export.FORMATS)}`')
+        return
+
+    matches = None
+    if tags != '':
+        try:
+            matches = library.match_tags(tags)
+        except ValueError as err:
+            await send_named_error(ctx, "That tag search doesn't look quite right!", f'`{err}`')
+            return
+    count = len(library.books) if matches == None else library.tags.count(matches)
+    if count == 0:
+        await send_named_error(ctx, "The library is empty!" if matches == None else 'No books with those tags were found!')
+        return
+
+    ctx.working(discord.Embed(
+        color=discord.Color.yellow(),
+        title=f'Exporting {count} books'
+    ))
+
+    limit = (ctx.guild.filesize_limit if ctx.guild != None else discord.utils.DEFAULT_FILE_SIZE_LIMIT_BYTES) - export.UPLOAD_MARGIN
+    # Written to disk a chunk at a time and uploaded from there, so a big library never has to fit in memory
+    with tempfile.TemporaryDirectory() as directory:
+        try:
+            paths = await export.export(library, format, matches, directory, limit)
+        except Exception as err:
+            if library.closed:
+                # Unloaded partway through, which SQLite can't keep reading after
+                await send_named_error(ctx, 'The library was unloaded while it was exported!', 'Try exporting again.')
+                return
+            await send_unhandled_error(ctx, err)
+            return
+
+        export_embed = discord.Embed(
+            color=discord.Color.green(),
+            title=f'Exported {count} books{f" tagged {tags}" if tags != "" else ""}!'
+        )
+        if len(paths) > 1:
+            export_embed.add_field(name='Parts', value=f'Too big for one upload, so it comes in {len(paths)} files.')
+
+        # One file per message, since the upload limit is per message
+        await ctx.send(embed=export_embed, file=discord.File(paths[0]))
+        for path in paths[1:]:
+            await ctx.send(file=discord.File(path))
 
 @bot.command(aliases=['data'], brief="View an overview of the Library's data!", usage='stats')
 async def stats(ctx):
@@ -162,20 +511,16 @@ async def stats(ctx):
     Currently displays total number of books, favorite book (based on average rating), and most popular book (based on number of completions).
     """
 
+    library = await db.library(ctx.guild)
+    books = library.books
+
     # Bounce if the library is empty
-    if books == {}:
+    if len(books) == 0:
         await send_named_error(ctx, "The library is empty!")
         return
 
-    def complete_sort(isbn):
-        return len(books[isbn]["completions"])
-    complete_sorted = sorted(books, key=complete_sort, reverse=True)
-
-    def favorite_sort(isbn):
-        if books[isbn]['ratings'] == {}:
-            return 0
-        return mean(books[isbn]['ratings'].values())
-    favorite_sorted = sorted(books, key=favorite_sort, reverse=True)
+    most_popular = library.most_popular(1)[0]
+    favorite = library.favorites(1)
 
     stats_embed = discord.Embed(
         color=discord.Color.purple(),
@@ -183,8 +528,9 @@ async def stats(ctx):
     )
     # Total entries, number of entries in top 5 tags, most popular book (based on number of completions), and favorite book (based on average rating)
     stats_embed.add_field(name='Total books', value=len(books))
-    stats_embed.add_field(name='Most popular book', value=f""" "{books[complete_sorted[0]]['title']}" with {len(books[complete_sorted[0]]['completions'])} completions""", inline=False)
-    stats_embed.add_field(name='Favorite book', value=f""" "{books[favorite_sorted[0]]['title']}" with a rating of {mean(books[favorite_sorted[0]]['ratings'].values())}/10""", inline=False)
+    stats_embed.add_field(name='Most popular book', value=f""" "{books[most_popular].title}" with {library.completion_count(most_popular)} completions""", inline=False)
+    if favorite != []:
+        stats_embed.add_field(name='Favorite book', value=f""" "{books[favorite[0]].title}" with a rating of {format_rating(library, favorite[0])}""", inline=False)
     # avg_rating = 
     # [ ] When there are actually enough tags add the top 5 to stats
     # [ ] When a book is added add its tags to known_tags
@@ -192,14 +538,149 @@ async def stats(ctx):
     
     await ctx.send(embed=stats_embed)
 
-@bot.command(aliases=['done', 'complete'], brief='Complete a book and give it a rating!', usage='finish 9781982158507 10')
+@bot.command(aliases=['top'], brief='The most finished books!', usage='hot 10 scifi')
+async def hot(ctx, count='10', tag=''):
+    
+    """
+    Lists the books with the most completions, optionally only ones with a specific tag.
+    Defaults to the top 10 across all tags.
+    """
+
+    try:
+        await validate_book_count(count)
+    except ValueError as err:
+        await send_named_error(ctx, err)
+        return
+
+    library = await db.library(ctx.guild)
+    books = library.books
+
+    ranked = library.most_popular(int(count), tag if tag != '' else None)
+    if ranked == []:
+        await send_named_error(ctx, "No books with that tag were found!" if tag != '' else "The library is empty!")
+        return
+
+    hot_embed = discord.Embed(
+        color=discord.Color.purple(),
+        title=f'Most popular books{f" tagged {tag}" if tag != "" else ""}!',
+        description='\n'.join(f"""{place}. "{books[isbn].title}" with {library.completion_count(isbn)} completions""" for place, isbn in enumerate(ranked, 1))
+    )
+
+    await ctx.send(embed=hot_embed)
+
+@bot.command(aliases=['me'], brief="See what someone's been reading!", usage='profile @kayt 2')
+async def profile(ctx, member: discord.Member | None = None, page='1'):
+    
+    """
+    Shows how many books a member has finished and rated, the average rating they give, and what they've read recently, newest first.
+    Defaults to your own profile. Pass a page number to see older reads.
+    """
+
+    library = await db.library(ctx.guild)
+    books = library.books
+    user = member if member != None else ctx.message.author
+
+    try:
+        page = int(page)
+    except ValueError:
+        await send_named_error(ctx, "That page number doesn't look right! It can only be a whole number.")
+        return
+
+    finished, rated = library.reader_counts(user.id)
+    pages = max((finished + PROFILE_PAGE - 1) // PROFILE_PAGE, 1)
+    if page < 1 or page > pages:
+        await send_named_error(ctx, f"There {'is only 1 page' if pages == 1 else f'are only {pages} pages'} of reads!")
+        return
+
+    average = library.average_given(user.id)
+    reads = library.recent_reads(user.id, (page - 1) * PROFILE_PAGE, PROFILE_PAGE)
+
+    profile_embed = discord.Embed(
+        color=discord.Color.purple(),
+        title=f"{user.display_name}'s library card",
+        description='\n'.join(f""""{books[isbn].title}"{f' - {rating}/10' if rating != None else ''}""" for isbn, rating in reads) if reads != [] else 'No books finished yet!'
+    )
+    profile_embed.add_field(name='Books finished', value=finished)
+    profile_embed.add_field(name='Books rated', value=rated)
+    profile_embed.add_field(name='Average rating given', value='N/A' if average == None else f'{round(average, 1)}/10')
+    profile_embed.set_footer(text=f'Page {page} of {pages}')
+
+    await ctx.send(embed=profile_embed)
+
+@bot.hybrid_command(aliases=['faves'], brief='The highest rated books!', usage='favorites 10 scifi')
+@app_commands.describe(count='How many books to list, from 1 to 25', tag='Only list books with this tag')
+@app_commands.autocomplete(tag=suggest_tags)
+async def favorites(ctx, count='10', tag=''):
+    
+    """
+    Lists the books with the highest average rating, optionally only ones with a specific tag.
+    Defaults to the top 10 across all tags. Books nobody has rated yet aren't listed.
+    """
+
+    try:
+        await validate_book_count(count)
+    except ValueError as err:
+        await send_named_error(ctx, err)
+        return
+
+    library = await db.library(ctx.guild)
+    books = library.books
+
+    ranked = library.favorites(int(count), tag if tag != '' else None)
+    if ranked == []:
+        await send_named_error(ctx, "No rated books with that tag were found!" if tag != '' else "No books have been rated yet!")
+        return
+
+    favorites_embed = discord.Embed(
+        color=discord.Color.purple(),
+        title=f'Favorite books{f" tagged {tag}" if tag != "" else ""}!',
+        description='\n'.join(f"""{place}. "{books[isbn].title}" with a rating of {format_rating(library, isbn)}""" for place, isbn in enumerate(ranked, 1))
+    )
+
+    await ctx.send(embed=favorites_embed)
+
+@bot.hybrid_command(aliases=['trend'], brief="What's being read lately!", usage='trending 30 scifi')
+@app_commands.describe(days='How many days back to look, from 1 to 365', tag='Only list books with this tag')
+@app_commands.autocomplete(tag=suggest_tags)
+async def trending(ctx, days='7', tag=''):
+    
+    """
+    Lists the books finished and rated the most in the last few days, optionally only ones with a specific tag.
+    Defaults to the last 7 days across all tags. Looking back over a month counts whole weeks.
+    """
+
+    try:
+        await validate_days(days)
+    except ValueError as err:
+        await send_named_error(ctx, err)
+        return
+
+    library = await db.library(ctx.guild)
+    books = library.books
+
+    ranked = library.trending(int(days), TRENDING, tag if tag != '' else None)
+    if ranked == []:
+        await send_named_error(ctx, f"No books{' with that tag' if tag != '' else ''} were finished or rated {'today' if int(days) == 1 else f'in the last {int(days)} days'}!")
+        return
+
+    trending_embed = discord.Embed(
+        color=discord.Color.purple(),
+        title=f'Trending {"today" if int(days) == 1 else "this week" if int(days) == 7 else f"in the last {int(days)} days"}{f" in {tag}" if tag != "" else ""}!',
+        description='\n'.join(f"""{place}. "{books[isbn].title}" with {events} {'finish or rating' if events == 1 else 'finishes and ratings'}""" for place, (isbn, events) in enumerate(ranked, 1))
+    )
+
+    await ctx.send(embed=trending_embed)
+
+@bot.hybrid_command(aliases=['done', 'complete'], brief='Complete a book and give it a rating!', usage='finish 9781982158507 10')
+@app_commands.describe(id='Title or ISBN of the book', rating='Your rating, from 1 to 10')
+@app_commands.autocomplete(id=suggest_books)
 async def finish(ctx, id='', rating=''):
     
     """
     Mark a book as complete and optionally give it a rating.
     You can only mark a book as complete once, but can update your rating at any time with `lib!rate`
     """
-    
+
     if id == '':
         await send_named_error(ctx, 'What book is it?', '`Missing argument: title / ISBN`')
         return
@@ -208,9 +689,9 @@ async def finish(ctx, id='', rating=''):
     
     # Validate book id
     try:
-        book_isbn = await validate_book_id(id)
+        book_isbn = await validate_book_id(ctx, id)
     except ValueError as err:
-        await send_named_error(ctx, "That ID doesn't look quite right! Is the title or ISBN exact?")
+        await send_named_error(ctx, "That ID doesn't look quite right! Is the title or ISBN exact?", f"{err}")
         return
     except ValidationError as err:
         await send_named_error(ctx, "That ISBN doesn't look quite right!", f'`Invalid ISBN: {err}`')
@@ -226,7 +707,11 @@ async def finish(ctx, id='', rating=''):
         await send_named_error(ctx, err)
         return
 
-    if ctx.message.author.id in books[book_isbn]['completions']:
+    # Fetched after the awaits above, since the library could have been unloaded during them
+    library = await db.library(ctx.guild)
+    books = library.books
+
+    if library.has_completed(book_isbn, ctx.message.author.id):
         await ctx.send(embed=discord.Embed(
             color=discord.Color.yellow(),
             title="You've already finished this book! Use `lib!rate` to update your rating."
@@ -234,28 +719,29 @@ async def finish(ctx, id='', rating=''):
         return
     
     # Update completions in db
-    db.complete(book_isbn, ctx.message.author.id)
+    library.complete(book_isbn, ctx.message.author.id)
     completion_embed = discord.Embed(
         color=discord.Color.green(),
-        title=f"""Congrats on finishing "{books[book_isbn]['title']}"!"""
+        title=f"""Congrats on finishing "{books[book_isbn].title}"!"""
     )
-    completion_embed.add_field(name='Current Completions', value=len(books[book_isbn]['completions']))
+    completion_embed.add_field(name='Current Completions', value=library.completion_count(book_isbn))
     
     if rating != '':
         # Update rating in db
-        db.rate(book_isbn, ctx.message.author.id, int(rating))
-        avg_rating = mean(books[book_isbn]['ratings'].values())
-        completion_embed.add_field(name='New Rating', value=avg_rating)
+        library.rate(book_isbn, ctx.message.author.id, int(rating))
+        completion_embed.add_field(name='New Rating', value=format_rating(library, book_isbn))
 
     await ctx.send(embed=completion_embed)
 
-@bot.command(brief='Update your rating of a book!', usage='rate 9781982158507 10')
+@bot.hybrid_command(brief='Update your rating of a book!', usage='rate 9781982158507 10')
+@app_commands.describe(id='Title or ISBN of the book', rating='Your rating, from 1 to 10')
+@app_commands.autocomplete(id=suggest_books)
 async def rate(ctx, id='', rating=''):
     
     """
     Update or add a rating to any book you've marked as complete.
     """
-    
+
     if id == '':
         await send_named_error(ctx, 'What book is it?', '`Missing argument: title / ISBN`')
         return
@@ -268,7 +754,7 @@ async def rate(ctx, id='', rating=''):
     
     # Validate book id
     try:
-        book_isbn = await validate_book_id(id)
+        book_isbn = await validate_book_id(ctx, id)
     except ValueError as err:
         await send_named_error(ctx, "That ID doesn't look quite right! Is the title or ISBN exact?", f"{err}")
         return
@@ -286,7 +772,11 @@ async def rate(ctx, id='', rating=''):
         await send_named_error(ctx, err)
         return
 
-    if ctx.message.author.id not in books[book_isbn]['completions']:
+    # Fetched after the awaits above, since the library could have been unloaded during them
+    library = await db.library(ctx.guild)
+    books = library.books
+
+    if not library.has_completed(book_isbn, ctx.message.author.id):
         await ctx.send(embed=discord.Embed(
             color=discord.Color.yellow(),
             title="You haven't completed this book yet, use `lib!finish` to mark a book as complete."
@@ -294,52 +784,51 @@ async def rate(ctx, id='', rating=''):
         return
 
     # Update rating in db
-    db.rate(book_isbn, ctx.message.author.id, int(rating))
+    library.rate(book_isbn, ctx.message.author.id, int(rating))
 
-    avg_rating = mean(books[book_isbn]['ratings'].values())
-    
     rate_embed = discord.Embed(
         color=discord.Color.green(),
-        title=f"""Updating your rating on "{books[book_isbn]['title']}"!"""
+        title=f"""Updating your rating on "{books[book_isbn].title}"!"""
     )
-    rate_embed.add_field(name='New Rating', value=avg_rating)
+    rate_embed.add_field(name='New Rating', value=format_rating(library, book_isbn))
 
     await ctx.send(embed=rate_embed)
 
-@bot.command(brief="Add new tags to a book!", usage='tag 9781982158507 "heartwrenching at times, but still nonfiction"')
+@bot.hybrid_command(brief="Add new tags to a book!", usage='tag 9781982158507 "heartwrenching at times, but still nonfiction"')
+@app_commands.describe(isbn='ISBN of the book', tags='Comma separated tags to add')
+@app_commands.autocomplete(isbn=suggest_books, tags=suggest_tags)
 async def tag(ctx, isbn, tags:str = ''):
     
     '''
     Add new tags to a book after it's been added to the library! Skips over existing tags and preserves the order tags are added in.
     '''
 
+    library = await db.library(ctx.guild)
+    books = library.books
+
     try:
-        validate(isbn)
-    except ValueError as err:
-        await send_named_error(ctx, "That ISBN doesn't look quite right!", f'`Invalid ISBN: {err}`')
-        return
-    except LengthError as err:
+        isbn = canonical(isbn)
+    except (LengthError, ValidationError) as err:
         await send_named_error(ctx, "That ISBN doesn't look quite right!", f'`Invalid ISBN: {err}`')
         return
     except Exception as err:
         await send_unhandled_error(ctx, err)
         return
     else:
-        if validate(isbn):
-            # If book doesnt exist bounce
-            if isbn not in books.keys():
-                await send_named_error(ctx, "That book couldn't be found!", f"No book with isbn: `{isbn}` found. Is it the correct ISBN?")
-                return
-        else:
-            await send_named_error(ctx, "Invalid ISBN!")
+        # If book doesnt exist bounce
+        if isbn not in books:
+            await send_named_error(ctx, "That book couldn't be found!", f"No book with isbn: `{isbn}` found. Is it the correct ISBN?")
             return
 
-    book = books[isbn]
+    book = books[isbn].to_dict()
     new_tags = [tag.strip() for tag in tags.split(',')]
+    if bracketed(new_tags) != []:
+        await send_named_error(ctx, "Tags can't have brackets in them!", f"`{bracketed(new_tags)[0]}` couldn't be found by `lib!random` and `lib!rec`.")
+        return
     book["tags"] = book["tags"] + [tag for tag in new_tags if tag not in book["tags"]]
 
     try:
-        db.append_data({book["isbn"]: book})
+        library.append_data({book["isbn"]: book})
         # {book["isbn"]: book}
     except Exception as err:
         await send_unhandled_error(ctx, err)
@@ -356,109 +845,239 @@ async def tag(ctx, isbn, tags:str = ''):
     return
 
 
-@bot.command(name='random', aliases=['rec', 'recme'], brief='Picks a random book for you to read!', usage='random "scifi,fantasy" strict')
+@bot.hybrid_command(name='random', brief='Picks a random book for you to read!', usage='random "scifi,fantasy" strict')
+@app_commands.describe(tags='Comma separated tags, or an expression like scifi AND (space OR robots) AND NOT horror', method='loose or strict')
+@app_commands.autocomplete(tags=suggest_tags)
 async def random_book( ctx, tags:str = '', method:str = 'loose'):
     
     '''
     Picks a random book from the library with the specified tags.
     Loose tag matching returns all books with any of the specified tags, strict matching returns only books with all the specified tags.
     Defaults to loose matching.
+    Tags can also be combined with AND, OR, NOT and brackets, like `lib!random "scifi AND (space OR robots) AND NOT romance"`.
     '''
 
-    random_isbn:str  = ''
-    random_book:dict = {}
+    library = await db.library(ctx.guild)
+    books = library.books
+
+    random_isbn = None
     
     if tags != '':
-        user_tags = tags.split(',')
-        valid_books:list = []
-        
-        book_objs = books.values()
-
-        def loose(book):
-            return len(set(user_tags).intersection(book["tags"])) != 0
-        
-        def strict(book):
-            return set(user_tags).issubset(book["tags"])
-
-        tag_algorithms = {
-            "loose": loose,
-            "strict": strict
-        }
+        try:
+            matches = library.match_tags(tags, method)
+        except ValueError as err:
+            await send_named_error(ctx, "That tag search doesn't look quite right!", f'`{err}`')
+            return
         
-        # Loose tag matching - returns all books with any specifed tags
-        valid_books = [book for book in book_objs if tag_algorithms[method](book)]
-        # valid_books = all books for every book in books that returns true on loose matching
+        random_isbn = library.random_isbn(matches)
         
-        if valid_books == []:
-            await send_named_error(ctx, 'No books with those tags were found! Maybe try loose matching (`lib!rec "tags" loose`) or fewer tags.')
+        if random_isbn == None:
+            await send_named_error(ctx, 'No books with those tags were found! Maybe try loose matching (`lib!random "tags" loose`) or fewer tags.')
             return
         
-        random_book = choice(valid_books)
-        random_isbn = random_book["isbn"]
-        
     else:
-        random_isbn = choice(list(books.keys()))
-        random_book = books[random_isbn]
+        random_isbn = library.random_isbn()
+        
+        if random_isbn == None:
+            await send_named_error(ctx, "The library is empty!")
+            return
     
+    rec_embed = render_book(library, random_isbn, discord.Color.from_str('#ff6161'))
+    
+    await ctx.send(embed=rec_embed)
+
+@bot.command(aliases=['rec', 'recme'], brief='Books picked for you from your ratings!', usage='recommend 5 "scifi,fantasy"')
+async def recommend(ctx, count='5', tags:str = ''):
+
+    '''
+    Recommends books you haven't read yet, based on what people who rated books like you did also liked.
+    Optionally only recommends books with any of the specified tags, or matching a tag expression like `lib!random` takes.
+    If you haven't rated anything yet, picks a random book instead.
+    '''
+
+    library = await db.library(ctx.guild)
+    books = library.books
+
+    try:
+        await validate_book_count(count)
+    except ValueError as err:
+        await send_named_error(ctx, err)
+        return
+
+    matches = None
+    if tags != '':
+        try:
+            matches = library.match_tags(tags)
+        except ValueError as err:
+            await send_named_error(ctx, "That tag search doesn't look quite right!", f'`{err}`')
+            return
+
+    recommended = await library.recommendations(ctx.message.author.id, int(count), matches)
+    # Recommendations can take a while, and the library might have been unloaded meanwhile
+    library = await db.library(ctx.guild)
+    books = library.books
+    if recommended == []:
+        random_isbn = library.random_isbn(matches)
+        if random_isbn == None:
+            await send_named_error(ctx, 'No books with those tags were found!' if tags != '' else "The library is empty!")
+            return
+
+        rec_embed = render_book(library, random_isbn, discord.Color.from_str('#ff6161'))
+        await ctx.send(content="Nothing stands out for you yet, so here's a random pick! Rate the books you finish with `lib!rate` to get better recommendations.", embed=rec_embed)
+        return
 
     rec_embed = discord.Embed(
         color=discord.Color.from_str('#ff6161'),
-        title=f""" "{random_book['title']}" """
+        title=f'Picked for you{f" from {tags}" if tags != "" else ""}!',
+        description='\n'.join(f"""{place}. "{books[isbn].title}" by {books[isbn].author}""" for place, isbn in enumerate(recommended, 1))
     )
 
-    rec_embed.add_field(name="Author", value=random_book["author"], inline=True)
-    rec_embed.add_field(name="Rating", value='10/10', inline=True)
-    rec_embed.add_field(name="Completions", value=len(random_book["completions"]), inline=True)
-    rec_embed.add_field(name="Tags", value=', '.join(str(tag) for tag in random_book["tags"]) if random_book["tags"] != [] else "N/A", inline=False)
-    rec_embed.add_field(name="WorldCat", value=f"https://worldcat.org/search?q={random_isbn}", inline=False)
-    rec_embed.add_field(name="B&N", value=f"https://www.barnesandnoble.com/s/{random_isbn}", inline=False)
-    
     await ctx.send(embed=rec_embed)
 
-@bot.command(aliases=['book'], brief="Stats on a specific book", usage='view 9781982158507')
+@bot.hybrid_command(aliases=['book'], brief="Stats on a specific book", usage='view 9781982158507')
+@app_commands.describe(isbn='ISBN of the book')
+@app_commands.autocomplete(isbn=suggest_books)
 async def view (ctx, isbn):
     '''
     View information on a specific book!
     '''
+
+    library = await db.library(ctx.guild)
+    books = library.books
     
     try:
-        validate(isbn)
-    except ValueError as err:
-        await send_named_error(ctx, "That ISBN doesn't look quite right!", f'`Invalid ISBN: {err}`')
-        return
-    except LengthError as err:
+        isbn = canonical(isbn)
+    except (LengthError, ValidationError) as err:
         await send_named_error(ctx, "That ISBN doesn't look quite right!", f'`Invalid ISBN: {err}`')
         return
     except Exception as err:
         await send_unhandled_error(ctx, err)
         return
     else:
-        if validate(isbn):
-            # If book doesnt exist bounce
-            if isbn not in books.keys():
-                await send_named_error(ctx, "That book couldn't be found!", f"No book with isbn: `{isbn}` found. Is it the correct ISBN?")
-                return
-        else:
-            await send_named_error(ctx, "Invalid ISBN!")
+        # If book doesnt exist bounce
+        if isbn not in books:
+            await send_named_error(ctx, "That book couldn't be found!", f"No book with isbn: `{isbn}` found. Is it the correct ISBN?")
             return
     
     # If checks passed do the thing
-    book = books[isbn]
-
-    book_embed = discord.Embed(
-        color=discord.Color.purple(),
-        title=f""" "{book['title']}" """
-    )
-
-    book_embed.add_field(name="Author", value=book["author"], inline=True)
-    book_embed.add_field(name="Rating", value='10/10', inline=True)
-    book_embed.add_field(name="Completions", value=len(book["completions"]), inline=True)
-    book_embed.add_field(name="Tags", value=', '.join(str(tag) for tag in book["tags"]) if book["tags"] != [] else "N/A", inline=False)
-    book_embed.add_field(name="WorldCat", value=f"https://worldcat.org/search?q={isbn}", inline=False)
-    book_embed.add_field(name="B&N", value=f"https://www.barnesandnoble.com/s/{isbn}", inline=False)
+    book_embed = render_book(library, isbn, discord.Color.purple())
     
     await ctx.send(embed=book_embed)
 
+def format_shelf_entry(library, isbn, order):
+    book = library.books[isbn]
+    line = f""""{book.title}" by {book.author}"""
+    if order == 'rating':
+        line += f' - {format_rating(library, isbn)}'
+    elif order == 'completions':
+        line += f' - {library.completion_count(isbn)} completions'
+    return line
+
+class ShelfPager (discord.ui.View):
+    ''' Previous and next buttons under a lib!list or lib!search page, fetching the page either side from the cursors of the one showing '''
+
+    def __init__ (self, user_id, title, order, prefix, page):
+        super().__init__(timeout=PAGER_TIMEOUT)
+        self.user_id = user_id
+        self.title = title
+        self.order = order
+        self.prefix = prefix
+        self.entries, self.position, self.total = page
+        self.message = None
+        self.update_buttons()
+
+    def update_buttons(self):
+        self.previous_page.disabled = self.position == 0
+        self.next_page.disabled = self.position + len(self.entries) >= self.total
+
+    def embed(self, library):
+        shelf_embed = discord.Embed(
+            color=discord.Color.purple(),
+            title=self.title,
+            description='\n'.join(f'{place}. {format_shelf_entry(library, entry[-1], self.order)}' for place, entry in enumerate(self.entries, self.position + 1))
+        )
+        shelf_embed.set_footer(text=f'Books {self.position + 1}-{self.position + len(self.entries)} of {self.total}')
+        return shelf_embed
+
+    async def interaction_check(self, interaction):
+        # Only whoever asked for the list can turn its pages
+        return interaction.user.id == self.user_id
+
+    async def turn(self, interaction, after=None, before=None):
+        library = await db.library(interaction.guild)
+        entries, position, total = await library.browse(self.order, LIST_PAGE, after, before, self.prefix)
+        library = await db.library(interaction.guild)
+        if entries != []:
+            self.entries, self.position, self.total = entries, position, total
+        self.update_buttons()
+        await interaction.response.edit_message(embed=self.embed(library), view=self)
+
+    @discord.ui.button(label='Previous', style=discord.ButtonStyle.secondary)
+    async def previous_page(self, interaction, button):
+        await self.turn(interaction, before=self.entries[0])
+
+    @discord.ui.button(label='Next', style=discord.ButtonStyle.secondary)
+    async def next_page(self, interaction, button):
+        await self.turn(interaction, after=self.entries[-1])
+
+    async def on_timeout(self):
+        if self.message != None:
+            try:
+                await self.message.edit(view=None)
+            except discord.HTTPException:
+                pass
+
+async def send_shelf(ctx, title, order, prefix=None):
+    ''' Sends the first page of books in order with buttons for the rest, or says there aren't any '''
+    library = await db.library(ctx.guild)
+    page = await library.browse(order, LIST_PAGE, prefix=prefix)
+    if page[0] == []:
+        return False
+
+    # The shelves might have taken a while to build, so it's fetched again in case it was unloaded meanwhile
+    library = await db.library(ctx.guild)
+
+    pager = ShelfPager(ctx.message.author.id, title, order, prefix, page)
+    pager.message = await ctx.send(embed=pager.embed(library), view=pager if page[2] > LIST_PAGE else None)
+    return True
+
+@bot.command(name='list', aliases=['browse'], brief='Browse the whole library!', usage='list author')
+async def list_books(ctx, order='title'):
+
+    '''
+    Lists every book in the library a page at a time, with buttons to turn the pages.
+    Sorts by title by default, or by author, rating (highest first, books nobody has rated yet aren't listed) or completions (most first).
+    '''
+
+    order = order.lower()
+
+    if order not in ORDERS:
+        await send_named_error(ctx, "That's not a way books can be sorted!", f"Try one of: {', '.join(ORDERS)}")
+        return
+
+    if not await send_shelf(ctx, f'The library by {order}', order):
+        await send_named_error(ctx, "No books have been rated yet!" if order == 'rating' else "The library is empty!")
+
+@bot.command(name='search', aliases=['find'], brief='Find books by the start of their title or author!', usage='search "love hyp"')
+async def search_books(ctx, text='', by='title'):
+
+    '''
+    Finds books whose title starts with the text, a page at a time in title order, ignoring case, punctuation and a leading "the", "a" or "an".
+    Pass `author` after the text to search by the start of the author's name instead.
+    '''
+
+    by = by.lower()
+
+    if text.strip() == '':
+        await send_named_error(ctx, "What should I search for?", 'Put the start of a title, or an author with `author` after it.')
+        return
+    if by not in ('title', 'author'):
+        await send_named_error(ctx, "Books can only be searched by title or author!")
+        return
+
+    if not await send_shelf(ctx, f'Books with {"an author" if by == "author" else "a title"} starting with "{text}"', by, text):
+        await send_named_error(ctx, "No books matched that search!")
+
 @bot.command(brief='Bot version and uptime', usage='meta')
 async def meta (ctx):
     
@@ -472,12 +1091,63 @@ async def meta (ctx):
     )
     meta_embed.add_field(name='Version', value='v0.2.0')
     meta_embed.add_field(name='Uptime', value=datetime.now() - startTime)
+    meta_embed.add_field(name='Libraries loaded', value=f'{len(db.libraries.loaded)} ({db.libraries.stats["evictions"]} unloaded)')
+    meta_embed.add_field(name='Library cache hits', value=f'{round(db.libraries.hit_rate() * 100, 1)}%')
+    meta_embed.add_field(name='Library load time', value=f'{round(db.libraries.average_load_time() * 1000, 1)}ms avg, {round(db.libraries.stats["max_load_time"] * 1000, 1)}ms max')
+    meta_embed.add_field(name='Embed cache hits', value=f'{round(book_embeds.hit_rate() * 100, 1)}% ({round(book_embeds.time_saved() * 1000, 1)}ms saved)')
     meta_embed.add_field(name='Gender', value="Assigned Female By Cayman")
     meta_embed.add_field(inline=False, name='Github', value='https://github.com/Kaytwastaken/librarian')
     meta_embed.add_field(inline=False, name='Discord.py', value='https://github.com/Rapptz/discord.py')
 
     await ctx.send(embed=meta_embed)
 
+def format_latency(histogram):
+    if histogram.count == 0:
+        return 'N/A'
+    return ' / '.join(f'{round(histogram.quantile(q) * 1000, 1)}' for q in (0.5, 0.95, 0.99)) + f'ms ({histogram.count})'
+
+def format_counts(histogram):
+    if histogram.count == 0:
+        return 'N/A'
+    return ' / '.join(f'{round(histogram.quantile(q))}' for q in (0.5, 0.95, 0.99)) + f' ({histogram.count}), {round(histogram.max)} max'
+
+@bot.command(hidden=True)
+async def perf (ctx):
+
+    '''
+    Command latency percentiles, REST requests per command, db write times, flush lag and batch sizes and event loop lag since the bot started.
+    '''
+
+    perf_embed = discord.Embed(
+        color=discord.Color.purple(),
+        title='Performance (p50 / p95 / p99)',
+        description='\n'.join(f'`{name}` {format_latency(histogram)}' for name, histogram in sorted(metrics.commands.items(), key=lambda item: -item[1].count)) or 'No commands run yet.'
+    )
+    perf_embed.add_field(name='Sends', value=format_latency(metrics.sends))
+    perf_embed.add_field(name='DB writes', value=format_latency(metrics.db_writes))
+    perf_embed.add_field(name='DB written', value=f'{round(metrics.db_bytes / 1024, 1)}KB')
+    perf_embed.add_field(name='Flush lag', value=format_latency(metrics.flush_lag))
+    perf_embed.add_field(name='Changes per flush', value=format_counts(metrics.flush_batch))
+    perf_embed.add_field(name='Event loop lag', value=f'{format_latency(metrics.loop_lag)}, {round(metrics.loop_lag.max * 1000, 1)}ms max')
+    perf_embed.add_field(inline=False, name='REST requests per command', value=', '.join(f'`{name}` {round(metrics.rest_per_command(name), 2)}' for name in sorted(metrics.commands)) or 'None yet.')
+    if metrics.rate_limited != {}:
+        perf_embed.add_field(inline=False, name='Rate limited (429s)', value=', '.join(f'`{name or "other"}` {count}' for name, count in sorted(metrics.rate_limited.items(), key=lambda item: item[0] or '')))
+    if metrics.command_errors != {}:
+        perf_embed.add_field(inline=False, name='Errors', value=', '.join(f'`{name}` {count}' for name, count in sorted(metrics.command_errors.items())))
+
+    await ctx.send(embed=perf_embed)
+
+@bot.command(hidden=True)
+@commands.is_owner()
+async def sync (ctx):
+
+    '''
+    Registers the slash versions of commands with Discord. Only needed again after they change.
+    '''
+
+    synced = await bot.tree.sync()
+    await ctx.send(embed=discord.Embed(color=discord.Color.green(), title=f'Synced {len(synced)} slash commands!'))
+
 @bot.command(hidden=True)
 async def error(ctx):
     try:
@@ -485,6 +1155,12 @@ async def error(ctx):
     except Exception as err:
         await send_unhandled_error(ctx, err)
 
-token = config['TOKEN']
-bot.run(token) #type: ignore
-# type ignore bc its saying it cant cast str | None to str
\ No newline at end of file
+# Only run the bot when started directly, so the commands can be imported and called by bench.py without a token
+if __name__ == '__main__':
+    token = config['TOKEN']
+    bot.run(token) #type: ignore
+    # type ignore bc its saying it cant cast str | None to str
+
+    # Write anything the background writer hadn't gotten to yet
+    db.flush()
+    offload.shutdown()
\ No newline at end of file
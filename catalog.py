@@ -0,0 +1,243 @@
+import heapq
+import json
+import mmap
+import os
+import re
+import shutil
+import struct
+import sys
+import tempfile
+import time
+from bisect import bisect_left
+from collections import OrderedDict
+from dotenv import dotenv_values
+from isbn import LengthError, ValidationError, canonical
+
+config = dotenv_values('.env')
+# Open Library style editions dump (a tab separated record per line with its json last) that books are filled in from, indexed once with
+# python catalog.py index. Has to be uncompressed so it can be memory-mapped
+CATALOG_PATH = config.get('CATALOG_PATH') or ''
+# The matching authors dump, since editions only link to author records. Without it authors come from the edition's "by" line
+CATALOG_AUTHORS_PATH = config.get('CATALOG_AUTHORS_PATH') or ''
+# Decoded records kept around, misses included
+CACHE_SIZE = 4096
+# Subjects shown for a book
+SUBJECTS = 10
+
+# Index files start with this, the size of the dump they were built from and how many keys they have, followed by every key in order
+# and then the offset of each key's line. Native byte order, so they can be searched as they're mapped
+MAGIC = b'LIBIDX2\0'
+HEADER = struct.Struct('=8sQQ')
+# Runs of (key, offset) written while indexing
+RUN_ENTRY = struct.Struct('=QQ')
+# While indexing, keys and offsets are packed into one int (key << OFFSET_BITS | offset) so a run sorts as plain ints
+OFFSET_BITS = 40
+# Entries sorted in memory at a time while indexing, about 45MB worth. Sorted runs are merged from disk after
+RUN_LENGTH = 1_000_000
+
+ISBNS = re.compile(rb'"isbn_1[03]":\s*\[([^\]]*)\]')
+QUOTED = re.compile(rb'"([^"]*)"')
+AUTHOR = re.compile(r'/authors/OL([0-9]+)A')
+
+def index_path (dump_path:str) -> str :
+    return dump_path + '.idx'
+
+def edition_keys (line:bytes) -> list :
+    ''' ISBN-13s of an edition line as ints, without decoding its json '''
+    keys = []
+    for isbns in ISBNS.findall(line):
+        for isbn in QUOTED.findall(isbns):
+            try:
+                keys.append(int(canonical(isbn.decode())))
+            except (LengthError, ValidationError, UnicodeDecodeError):
+                pass
+    return keys
+
+def author_keys (line:bytes) -> list :
+    ''' The number in an author line's /authors/OL...A key '''
+    fields = line.split(b'\t', 2)
+    match = AUTHOR.fullmatch(fields[1].decode()) if len(fields) == 3 else None
+    return [int(match[1])] if match != None else []
+
+def write_run (entries:list, workdir:str) -> str :
+    entries.sort()
+    path = os.path.join(workdir, f'{len(os.listdir(workdir))}.run')
+    mask = (1 << OFFSET_BITS) - 1
+    with open(path, 'wb') as run:
+        for start in range(0, len(entries), 65536):
+            run.write(b''.join(RUN_ENTRY.pack(entry >> OFFSET_BITS, entry & mask) for entry in entries[start:start + 65536]))
+    return path
+
+def read_run (path:str):
+    with open(path, 'rb') as run:
+        while chunk := run.read(RUN_ENTRY.size * 65536):
+            yield from RUN_ENTRY.iter_unpack(chunk)
+
+def build_index (dump_path:str, keys = edition_keys) -> int :
+    '''
+    Writes the sorted key -> line offset index for a dump next to it, reading the dump once. Entries are sorted RUN_LENGTH at a time
+    and the runs merged from disk, so memory stays the same however big the dump is. The first line with a key wins. Returns how many keys it has
+    '''
+    size = os.path.getsize(dump_path)
+    if size >= 1 << OFFSET_BITS:
+        raise ValueError(f'{dump_path} is too big to index')
+
+    count = 0
+    with tempfile.TemporaryDirectory(dir=os.path.dirname(os.path.abspath(dump_path))) as workdir:
+        runs, entries, offset = [], [], 0
+        with open(dump_path, 'rb') as dump:
+            for line in dump:
+                entries += [key << OFFSET_BITS | offset for key in keys(line)]
+                offset += len(line)
+                if len(entries) >= RUN_LENGTH:
+                    runs.append(write_run(entries, workdir))
+                    entries = []
+        runs.append(write_run(entries, workdir))
+
+        # Written to the side and moved into place, so a running bot never sees half an index
+        offsets_path = os.path.join(workdir, 'offsets')
+        with open(index_path(dump_path) + '.tmp', 'wb') as index, open(offsets_path, 'wb+') as offsets:
+            index.write(HEADER.pack(MAGIC, size, 0))
+            last = None
+            for key, offset in heapq.merge(*(read_run(run) for run in runs)):
+                if key != last:
+                    index.write(key.to_bytes(8, sys.byteorder))
+                    offsets.write(offset.to_bytes(8, sys.byteorder))
+                    count += 1
+                    last = key
+            offsets.seek(0)
+            shutil.copyfileobj(offsets, index)
+            index.seek(0)
+            index.write(HEADER.pack(MAGIC, size, count))
+    os.replace(index_path(dump_path) + '.tmp', index_path(dump_path))
+    return count
+
+class Dump:
+    ''' A dump and its index, both memory-mapped, so finding a line is a binary search over the mapped keys and reading it touches a page or two '''
+
+    def __init__ (self, path:str):
+        self.path = path
+        with open(path, 'rb') as dump, open(index_path(path), 'rb') as index:
+            self.lines = mmap.mmap(dump.fileno(), 0, access=mmap.ACCESS_READ)
+            self.index = mmap.mmap(index.fileno(), 0, access=mmap.ACCESS_READ)
+        if hasattr(mmap, 'MADV_RANDOM'):
+            # Lookups land all over both, so reading ahead of them only fills memory with pages nothing asked for
+            self.lines.madvise(mmap.MADV_RANDOM)
+            self.index.madvise(mmap.MADV_RANDOM)
+        magic, size, self.count = HEADER.unpack_from(self.index, 0)
+        if magic != MAGIC or size != len(self.lines):
+            self.lines.close()
+            self.index.close()
+            raise ValueError(f'The index for {path} is out of date, run python catalog.py index again')
+        self.entries = memoryview(self.index).cast('Q')
+        start = HEADER.size // 8
+        self.keys = self.entries[start:start + self.count]
+        self.offsets = self.entries[start + self.count:start + 2 * self.count]
+
+    def find (self, key:int) -> bytes | None :
+        ''' The line with this key, or None '''
+        position = bisect_left(self.keys, key)
+        if position == self.count or self.keys[position] != key:
+            return None
+        offset = self.offsets[position]
+        end = self.lines.find(b'\n', offset)
+        return self.lines[offset:end if end != -1 else len(self.lines)]
+
+    def close (self):
+        # The mappings can't close while views of them are around
+        for view in (self.keys, self.offsets, self.entries):
+            view.release()
+        self.lines.close()
+        self.index.close()
+
+def record_json (line:bytes) -> dict :
+    return json.loads(line.rsplit(b'\t', 1)[-1].decode())
+
+class Catalog:
+    ''' Looks books up in a local catalog dump by ISBN, keeping the last CACHE_SIZE decoded records '''
+
+    def __init__ (self, path:str, authors_path:str = '', cache_size:int = CACHE_SIZE):
+        self.editions = Dump(path)
+        self.authors = Dump(authors_path) if authors_path != '' else None
+        self.cache_size = cache_size
+        # isbn -> record or None, least recently used first
+        self.cache:OrderedDict = OrderedDict()
+        self.stats = {'hits': 0, 'misses': 0, 'lookup_time': 0.0}
+
+    def lookup (self, isbn:str) -> dict | None :
+        ''' {title, author, subjects, pages} for a canonical ISBN, or None if the catalog doesn't have it '''
+        if isbn in self.cache:
+            self.stats['hits'] += 1
+            self.cache.move_to_end(isbn)
+            return self.cache[isbn]
+
+        self.stats['misses'] += 1
+        started = time.perf_counter()
+        line = self.editions.find(int(isbn))
+        record = self.decode(line) if line != None else None
+        self.stats['lookup_time'] += time.perf_counter() - started
+
+        self.cache[isbn] = record
+        if len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+        return record
+
+    def decode (self, line:bytes) -> dict | None :
+        edition = record_json(line)
+        title = edition.get('title') or ''
+        if title == '':
+            return None
+        if edition.get('subtitle'):
+            title += f' : {edition["subtitle"]}'
+        return {
+            'title': title,
+            'author': self.author(edition),
+            'subjects': [subject for subject in edition.get('subjects') or [] if isinstance(subject, str)],
+            'pages': edition.get('number_of_pages'),
+        }
+
+    def author (self, edition:dict) -> str :
+        names = []
+        if self.authors != None:
+            for author in edition.get('authors') or []:
+                match = AUTHOR.fullmatch(author.get('key', '')) if isinstance(author, dict) else None
+                line = self.authors.find(int(match[1])) if match != None else None
+                name = record_json(line).get('name') if line != None else None
+                if name:
+                    names.append(name)
+        if names != []:
+            return ', '.join(names)
+        return (edition.get('by_statement') or '').strip().rstrip('.')
+
+    def close (self):
+        self.editions.close()
+        if self.authors != None:
+            self.authors.close()
+
+# Opened the first time something's looked up, False if there's no usable catalog
+catalog = None
+
+def lookup (isbn:str) -> dict | None :
+    ''' Catalog.lookup on the configured catalog, None without one '''
+    global catalog
+    if catalog == None:
+        catalog = False
+        if CATALOG_PATH != '':
+            try:
+                catalog = Catalog(CATALOG_PATH, CATALOG_AUTHORS_PATH)
+            except (OSError, ValueError) as err:
+                print(f"Couldn't open the catalog: {err}")
+    if catalog == False:
+        return None
+    return catalog.lookup(isbn)
+
+if __name__ == '__main__':
+    # python catalog.py index editions.txt [authors.txt]
+    # python catalog.py lookup isbn
+    if sys.argv[1] == 'index':
+        for path, keys in zip(sys.argv[2:4], (edition_keys, author_keys)):
+            started = time.perf_counter()
+            count = build_index(path, keys)
+            print(f'Indexed {count} keys in {path} in {round(time.perf_counter() - started, 1)}s')
+    elif sys.argv[1] == 'lookup':
+        print(lookup(canonical(sys.argv[2])))
@@ -1,46 +1,701 @@
+import asyncio
+import itertools
 import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from dotenv import dotenv_values
+from book import Book, finishes
+from perf import metrics
+from isbn import LengthError, ValidationError, canonical, canonical_many
+import offload
+from activity import Activity
+from rankings import Rankings
+from readers import ReaderIndex
+from recommend import Recommender
+from shelves import Shelves, author_key, page, title_key
+from snapshot import load as load_snapshot, save as save_snapshot, snapshot_path
+from tags import TagIndex, is_expression, normalize
+from titles import TitleIndex
 class ISBNError(Exception):
     pass
 
-library_data:dict = {}
+class LibraryClosed(Exception):
+    pass
+
+DB_PATH = 'db.json'
+# The journal is folded back into the snapshot once it's grown to this fraction of the snapshot's size, so rewriting the
+# snapshot costs about the same per write however big the library is
+COMPACT_RATIO = 0.5
+# Journals smaller than this are left alone, so small libraries aren't rewritten every few writes
+COMPACT_MIN_BYTES = 256 * 1024
+
+config = dotenv_values('.env')
+# Seconds to coalesce mutations for before the background writer flushes them
+FLUSH_INTERVAL = float(config.get('FLUSH_INTERVAL') or 2)
+# Storage engine, json for small installs or sqlite for big ones
+BACKEND = config.get('BACKEND') or 'json'
+SQLITE_PATH = config.get('SQLITE_PATH') or 'library.sqlite'
+# Each server's library lives in its own file in here, db.json is only used outside of servers
+LIBRARIES_PATH = config.get('LIBRARIES_PATH') or 'libraries'
+# Rough memory that loaded libraries can use before idle ones are unloaded
+MEMORY_BUDGET = float(config.get('MEMORY_BUDGET_MB') or 256) * 1024 * 1024
+# Rough in-memory cost of one book including its share of the indexes, used to size libraries against MEMORY_BUDGET
+BOOK_BYTES = 1024
+# Updates adding at least this many new books index them with the bulk builders, which sort once rather than inserting a book at a time
+BULK_BOOKS = 1000
+# Every library opened gets a new generation so versions from a library that was unloaded and reloaded never match
+generations = itertools.count()
+
+class Library:
+    ''' Lookups shared by every storage engine, answered from indexes the engines keep up to date '''
+
+    # Set when the storage service says this copy fell too far behind, so Libraries.get opens it again
+    stale = False
+    # Set once the library's unloaded, so a command still holding it can't make changes that never get saved
+    closed = False
+
+    def __init__ (self):
+        self.titles = TitleIndex()
+        self.tags = TagIndex()
+        self.rankings = Rankings()
+        self.readers = ReaderIndex()
+        self.recommender = Recommender()
+        self.shelves = Shelves()
+        self.activity = Activity()
+        self.generation = next(generations)
+        # isbn -> number of times the book has changed since the library was opened
+        self.versions:dict = {}
+
+    def add (self, book:dict):
+        # Books are always stored under their ISBN-13 so 10 and 13 digit versions can't both be added
+        book = {**book, 'isbn': canonical(book["isbn"])}
+
+        # Check if an ISBN already exists
+        if self.search(book["isbn"]):
+            # If so, bounce
+            raise ISBNError("ISBN already exists")
+        else:
+            # Else add book
+            self.append_data({book["isbn"]: book})
+
+    def index_new (self, new_books:list):
+        ''' Indexes (isbn, book dict) pairs for books the library didn't have yet in one go, like loading does '''
+        self.titles.add_many((isbn, book["title"]) for isbn, book in new_books)
+        self.tags.add_many((isbn, book["tags"]) for isbn, book in new_books)
+        self.rankings.add_many(
+            (isbn, book["tags"], len(book["completions"]), sum(int(rating) for rating in book["ratings"].values()), len(book["ratings"]))
+            for isbn, book in new_books
+        )
+        self.shelves.add_many((isbn, book["title"], book["author"]) for isbn, book in new_books)
+        for isbn, book in new_books:
+            self.readers.add_book(isbn, finishes(book), book["ratings"].items())
+            if book["ratings"] != {}:
+                self.recommender.rated(isbn)
+            self.touch(isbn)
+
+    def search (self, isbn):
+        try:
+            isbn = canonical(isbn)
+        except (LengthError, ValidationError):
+            return False
+
+        # Search db for ISBN key
+        return isbn in self.books
+
+    def touch (self, isbn:str):
+        self.versions[isbn] = self.versions.get(isbn, 0) + 1
+
+    def version (self, isbn:str):
+        ''' Changes whenever the book does, for invalidating anything rendered from it '''
+        return (self.generation, self.versions.get(isbn, 0))
+
+    def find_title (self, title:str):
+        return self.titles.find(title)
+
+    def similar_titles (self, title:str, count:int = 5):
+        return self.titles.similar(title, count)
+
+    def match_tags (self, tags:str, method:str = 'loose'):
+        ''' Bitset of books matching a comma separated tag list, or a boolean tag expression '''
+        if is_expression(tags):
+            return self.tags.query(tags)
+        if method not in ('loose', 'strict'):
+            raise ValueError(f'Unknown matching method: {method}')
+        return self.tags.match(tags.split(','), method == 'strict')
+
+    def random_isbn (self, matches:int | None = None):
+        ''' Random isbn out of a match_tags bitset, or out of every book '''
+        return self.tags.pick(self.tags.everything if matches == None else matches)
+
+    def has_completed (self, isbn:str, id:int):
+        return self.books[isbn].completed(id)
+
+    def average_rating (self, isbn:str):
+        ''' Mean rating of a book, None if nobody has rated it '''
+        return self.rankings.average(isbn)
+
+    def completion_count (self, isbn:str):
+        return self.rankings.completions[isbn]
+
+    def most_popular (self, count:int, tag:str | None = None):
+        return self.rankings.most_popular(count, tag)
+
+    def favorites (self, count:int, tag:str | None = None):
+        return self.rankings.favorites(count, tag)
+
+    def trending (self, days:int, count:int, tag:str | None = None) -> list :
+        ''' Up to count (isbn, finishes and ratings) with the most of them in the last days days, optionally only books with tag '''
+        allowed = None
+        if tag != None:
+            tag = normalize(tag)
+            allowed = lambda isbn: tag in self.tags.book_tags.get(isbn, ())
+        return self.activity.top(days, count, int(time.time()), allowed)
+
+    def reader_counts (self, id:int) -> tuple :
+        ''' (books finished, books rated) by a user '''
+        return self.readers.completion_count(id), self.readers.rating_count(id)
+
+    def average_given (self, id:int):
+        ''' Mean rating a user has given, None if they haven't rated anything '''
+        return self.readers.average(id)
+
+    def recent_reads (self, id:int, start:int = 0, count:int = 10) -> list :
+        ''' (isbn, the user's rating or None) for books they've finished, newest first '''
+        return [(isbn, self.readers.rating(id, isbn)) for isbn in self.readers.recent(id, start, count)]
+
+    def raters (self, isbn:str):
+        ''' (user id, rating) for everyone who's rated a book '''
+        book = self.books[isbn]
+        return zip(book.raters, book.scores)
+
+    async def recommendations (self, id:int, count:int, matches:int | None = None) -> list :
+        ''' Up to count isbns a user hasn't read, best match for their ratings first, optionally only ones in a match_tags bitset '''
+        await self.recommender.ready(self)
+        allowed = None
+        if matches != None:
+            allowed = lambda isbn: (matches >> self.tags.ordinals[isbn]) & 1 == 1
+        return self.recommender.recommend(self.readers.ratings.get(id, {}), self.readers.completed.get(id, {}), count, allowed)
+
+    def shelf_rows (self):
+        ''' (isbn, title, author) for every book as they are now, safe to read off the event loop '''
+        # The outermost iterable of a generator is evaluated straight away, so the dict is copied here and read later
+        return ((isbn, book.title, book.author) for isbn, book in dict(self.books).items())
+
+    async def browse (self, order:str, count:int, after=None, before=None, prefix:str | None = None) -> tuple :
+        '''
+        A page of books in one of shelves.ORDERS, after or before a cursor, as (entries, position, total) from shelves.page.
+        Each entry ends with the isbn and is the cursor for the pages either side. Only title and author can be searched by prefix
+        '''
+        if order == 'rating':
+            entries = self.rankings.favorite[None]
+        elif order == 'completions':
+            entries = self.rankings.popular[None]
+        else:
+            if self.shelves.by_title == None:
+                await self.shelves.ready(self.shelf_rows())
+            entries = self.shelves.by_title if order == 'title' else self.shelves.by_author
+        if prefix != None:
+            prefix = title_key(prefix) if order == 'title' else author_key(prefix)
+        return page(entries, count, after, before, prefix)
+
+    def suggest_books (self, text:str, count:int) -> list :
+        '''
+        Up to count isbns of books whose title starts with text, then ones whose author does, for autocomplete.
+        Nothing until the shelves are built, which this starts in the background
+        '''
+        if self.shelves.by_title == None:
+            self.shelves.warm(self.shelf_rows)
+            return []
+        entries, _, _ = page(self.shelves.by_title, count, prefix=title_key(text))
+        isbns = [entry[-1] for entry in entries]
+        if len(isbns) < count:
+            entries, _, _ = page(self.shelves.by_author, count, prefix=author_key(text))
+            isbns += [isbn for isbn in (entry[-1] for entry in entries) if isbn not in isbns][:count - len(isbns)]
+        return isbns
+
+    def suggest_tags (self, text:str, count:int) -> list :
+        return self.tags.starting_with(text, count)
+
+    def check_open (self):
+        if self.closed:
+            raise LibraryClosed('This library was unloaded, get it again with db.library')
+
+    async def aflush (self):
+        self.flush()
+
+    async def aclose (self):
+        self.close()
+
+    def size (self) -> int :
+        ''' Estimated bytes this library takes up in memory '''
+        return len(self.books) * BOOK_BYTES
+
+class JsonLibrary (Library):
+    '''
+    The whole library held in memory, persisted as a binary snapshot plus a journal of mutations made since.
+    db.json is only read when there's no snapshot yet, to bring in libraries from before snapshots or ones edited by hand.
+    '''
+
+    BACKEND = 'json'
+
+    def __init__ (self, path:str = DB_PATH, truncate:bool = True):
+        ''' Copies that don't own the file pass truncate=False, since a torn last record might just be halfway through being written '''
+        super().__init__()
+        self.path = path
+        self.journal_path = os.path.splitext(path)[0] + '.journal'
+        self.snapshot_path = snapshot_path(path)
+        # Bytes in the journal, and in the snapshot it'll be folded into, for deciding when to compact
+        self.journal_bytes = 0
+        self.snapshot_bytes = 0
+        # How far into the journal has been applied, so replicas can pick up where they left off
+        self.journal_offset = 0
+        # Mutations applied in memory but not yet written to disk
+        self.pending:list = []
+        self.dirty_since = None
+        self.writer_task = None
+        # Held by whatever's writing from the event loop, so closing waits for a flush or compaction already running
+        self.write_lock = asyncio.Lock()
+        # Batches are numbered as they're taken and written strictly in that order whichever thread writes them,
+        # so a flush() on the loop can't land ahead of a batch still in the executor, or be truncated by its compaction
+        self.batches_taken = 0
+        self.batches_written = 0
+        self.turns = threading.Condition()
+
+        self.loaded_snapshot = snapshot_identity(self.snapshot_path)
+        if os.path.exists(self.snapshot_path):
+            # A corrupt snapshot raises rather than falling back to db.json, which is older than the journal
+            self.data:dict = load_snapshot(self.snapshot_path)
+            self.books:dict = self.data["books"]
+            self.activity.load(self.data.pop("activity", {}))
+            self.snapshot_bytes = os.path.getsize(self.snapshot_path)
+            self.needs_snapshot = False
+        else:
+            self.data = {'books': {}}
+            # New servers start with an empty library
+            if os.path.exists(path):
+                with open(path, 'r') as db:
+                    # Read and deserialize db into memory
+                    self.data = json.loads(db.read())
+            self.canonicalize()
+            self.books = {isbn: Book.from_dict(book) for isbn, book in self.data["books"].items()}
+            self.data["books"] = self.books
+            # Written at the next flush so the next load is a fast one
+            self.needs_snapshot = True
+
+        self.titles.add_many((isbn, book.title) for isbn, book in self.books.items())
+        self.tags.add_many((isbn, book.tags) for isbn, book in self.books.items())
+        self.rankings.add_many(
+            (isbn, book.tags, len(book.completions), sum(book.scores), len(book.scores))
+            for isbn, book in self.books.items()
+        )
+        for isbn, book in self.books.items():
+            self.readers.add_book(isbn, book.finishes(), zip(book.raters, book.scores))
+        self.replay(truncate)
+
+    def canonicalize (self):
+        ''' Moves books stored under an ISBN-10 or with hyphens to their ISBN-13 key, unless that's already taken '''
+        books = self.data["books"]
+        for isbn, key in zip(list(books), canonical_many(list(books))):
+            if key != None and key != isbn and key not in books:
+                books[key] = {**books.pop(isbn), 'isbn': key}
+
+    def apply (self, record:dict):
+        ''' Applies a single mutation record in memory. Records are idempotent so replaying one twice is harmless '''
+        books = self.books
+
+        if record["op"] == 'update':
+            updates = record["books"]
+            if len(updates) >= BULK_BOOKS:
+                # Big imports get their new books indexed in one go, anything already here goes through the per book path below
+                new_books = [(isbn, book) for isbn, book in updates.items() if isbn not in books]
+                for isbn, book in new_books:
+                    books[isbn] = Book.from_dict(book)
+                self.index_new(new_books)
+                added = {isbn for isbn, _ in new_books}
+                updates = {isbn: book for isbn, book in updates.items() if isbn not in added}
+            for isbn, book in updates.items():
+                old = books.get(isbn)
+                books[isbn] = Book.from_dict(book)
+                if old == None:
+                    self.readers.add_book(isbn, finishes(book), book["ratings"].items())
+                else:
+                    self.readers.replace_book(isbn, old.completions, zip(old.raters, old.scores), finishes(book), book["ratings"].items())
+                if book["ratings"] != {} or (old != None and len(old.raters) != 0):
+                    self.recommender.rated(isbn)
+                self.titles.add(isbn, book["title"])
+                self.tags.add(isbn, book["tags"])
+                self.shelves.add(isbn, book["title"], book["author"])
+                self.rankings.set_book(isbn, book)
+                self.touch(isbn)
+        # Books are swapped out rather than edited so snapshots being written stay consistent
+        elif record["op"] == 'complete':
+            book = books[record["isbn"]]
+            if not book.completed(record["id"]):
+                books[record["isbn"]] = book.with_completion(record["id"], record.get("at", 0))
+                self.rankings.complete(record["isbn"])
+                self.readers.complete(int(record["id"]), record["isbn"], record.get("at", 0))
+                self.touch(record["isbn"])
+                # Only when something changed, so replaying a record doesn't count it twice. Records from before timestamps aren't counted
+                if "at" in record:
+                    self.activity.record(record["isbn"], record["at"])
+        elif record["op"] == 'rate':
+            book = books[record["isbn"]]
+            if "at" in record and book.rating(record["id"]) != int(record["rating"]):
+                self.activity.record(record["isbn"], record["at"])
+            self.rankings.rate(record["isbn"], book.rating(record["id"]), int(record["rating"]))
+            books[record["isbn"]] = book.with_rating(record["id"], int(record["rating"]))
+            self.readers.rate(int(record["id"]), record["isbn"], int(record["rating"]))
+            self.recommender.rated(record["isbn"])
+            self.touch(record["isbn"])
+        else:
+            raise ValueError(f"Unknown journal op: {record['op']}")
+
+        # Records that went through the storage service are numbered, and snapshots remember the last one applied
+        if "seq" in record:
+            self.data["seq"] = record["seq"]
+
+    @property
+    def seq (self) -> int :
+        ''' Number of the last storage service record applied, 0 outside of sharded setups '''
+        return self.data.get("seq", 0)
+
+    def replay (self, truncate:bool = True):
+        '''
+        Replays the journal on top of the snapshot from wherever the last replay stopped, truncating a torn last record if there is one.
+        Replicas pass truncate=False since the record might just be halfway through being written by the bot.
+        '''
+        if not os.path.exists(self.journal_path):
+            return
+
+        good_offset = self.journal_offset
+        with open(self.journal_path, 'rb') as journal:
+            journal.seek(good_offset)
+            for line in journal:
+                # A record without its newline was cut off mid-write
+                if not line.endswith(b'\n'):
+                    break
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    break
+                self.apply(record)
+                good_offset += len(line)
+        self.journal_bytes += good_offset - self.journal_offset
+        self.journal_offset = good_offset
 
-with open('db.json', 'r') as db:
-    # Read and deserialize db into memory
-    library_data:dict = json.loads(db.read())
+        if truncate and good_offset != os.path.getsize(self.journal_path):
+            print(f'Dropping torn journal record at byte {good_offset}')
+            with open(self.journal_path, 'r+b') as journal:
+                journal.truncate(good_offset)
+                os.fsync(journal.fileno())
 
-def add (book:dict):
-    # Check if an ISBN already exists
-    if search(book["isbn"]):
-        # If so, bounce
-        raise ISBNError("ISBN already exists")
+    def changed_on_disk (self) -> bool :
+        ''' Whether the library was compacted since this copy was loaded, so catching up on the journal isn't enough '''
+        journal_size = os.path.getsize(self.journal_path) if os.path.exists(self.journal_path) else 0
+        return snapshot_identity(self.snapshot_path) != self.loaded_snapshot or journal_size < self.journal_offset
+
+    def catch_up (self):
+        ''' Applies whatever the bot has written to the journal since this copy last looked. Used by read-only replicas '''
+        self.replay(truncate=False)
+
+    def write_record (self, record:dict):
+        ''' Queues one mutation for the background writer and marks the store dirty '''
+        self.pending.append(record)
+        if self.dirty_since == None:
+            self.dirty_since = time.monotonic()
+
+    def take_batch (self):
+        ''' Takes everything pending, plus a snapshot of the library if it's time to compact. Runs on the event loop '''
+        batch, started = self.pending, self.dirty_since
+        self.pending, self.dirty_since = [], None
+
+        snapshot = None
+        if self.needs_snapshot or self.journal_bytes >= max(COMPACT_MIN_BYTES, self.snapshot_bytes * COMPACT_RATIO):
+            snapshot = self.snapshot()
+            self.needs_snapshot = False
+
+        self.batches_taken += 1
+        return batch, snapshot, started, self.batches_taken
+
+    def snapshot (self) -> dict :
+        ''' A view of the library that stays the same while it's written out from another thread '''
+        # Books are never edited in place, so a shallow copy is enough for them
+        return {**self.data, 'books': dict(self.books), 'activity': self.activity.to_dict()}
+
+    def write_batch (self, batch:list, snapshot:dict | None, turn:int) -> int :
+        '''
+        Writes a batch to disk with one fsync, or swaps in a new snapshot if one was taken, returning bytes written.
+        Waits for the batches taken before it to be written first. Safe to run in an executor
+        '''
+        with self.turns:
+            self.turns.wait_for(lambda: self.batches_written == turn - 1)
+        try:
+            if snapshot != None:
+                return self.compact(snapshot)
+
+            data = b''.join(json.dumps(record).encode() + b'\n' for record in batch)
+            with open(self.journal_path, 'ab') as journal:
+                journal.write(data)
+                journal.flush()
+                os.fsync(journal.fileno())
+            return len(data)
+        finally:
+            with self.turns:
+                self.batches_written = turn
+                self.turns.notify_all()
+
+    def compact (self, snapshot:dict) -> int :
+        ''' Folds the journal back into the binary snapshot, returning its size in bytes '''
+        written = save_snapshot(snapshot, self.snapshot_path)
+
+        # Only drop the journal once the snapshot is safely on disk
+        with open(self.journal_path, 'wb') as journal:
+            os.fsync(journal.fileno())
+        return written
+
+    def record_flush (self, batch:list, snapshot:dict | None, started, duration:float, written:int):
+        if snapshot != None:
+            self.snapshot_bytes, self.journal_bytes = written, 0
+        else:
+            self.journal_bytes += written
+        metrics.observe_write(duration, written)
+        if batch != []:
+            metrics.observe_flush(time.monotonic() - started, len(batch))
+
+    def flush (self):
+        ''' Synchronously writes everything pending, used on shutdown and outside the bot '''
+        if self.pending != []:
+            self.write_now()
+
+    def write_now (self):
+        batch, snapshot, started, turn = self.take_batch()
+        writing = time.perf_counter()
+        written = self.write_batch(batch, snapshot, turn)
+        self.record_flush(batch, snapshot, started, time.perf_counter() - writing, written)
+
+    async def aflush (self):
+        ''' Writes everything pending in the executor, after any write that's already running '''
+        async with self.write_lock:
+            if self.pending == []:
+                return
+
+            batch, snapshot, started, turn = self.take_batch()
+            writing = time.perf_counter()
+            try:
+                written = await asyncio.get_running_loop().run_in_executor(None, self.write_batch, batch, snapshot, turn)
+            except Exception as err:
+                # Put the batch back so the next flush retries it
+                print(f'Error flushing db: {err}')
+                self.pending = batch + self.pending
+                self.dirty_since = started
+                if snapshot != None:
+                    self.needs_snapshot = True
+            else:
+                self.record_flush(batch, snapshot, started, time.perf_counter() - writing, written)
+
+    async def writer (self, interval:float = FLUSH_INTERVAL):
+        ''' Background task that flushes pending mutations every interval seconds without blocking the event loop '''
+        while True:
+            await asyncio.sleep(interval)
+            await self.aflush()
+
+    def start_writer (self):
+        self.writer_task = asyncio.get_running_loop().create_task(self.writer())
+
+    def close (self):
+        ''' Stops the background writer and writes everything it hadn't gotten to yet '''
+        self.closed = True
+        if self.writer_task != None:
+            self.writer_task.cancel()
+            self.writer_task = None
+        if self.pending != [] or (self.needs_snapshot and self.books != {}):
+            self.write_now()
+
+    async def aclose (self):
+        ''' close() for the event loop, waiting for a flush or compaction that's already running and writing the rest in the executor '''
+        self.closed = True
+        async with self.write_lock:
+            if self.writer_task != None:
+                self.writer_task.cancel()
+                self.writer_task = None
+            await asyncio.get_running_loop().run_in_executor(None, self.close)
+
+    def append_data (self, new_data:dict):
+        self.check_open()
+        record = {'op': 'update', 'books': new_data}
+
+        # Add new book data to memory-db
+        self.apply(record)
+
+        # Queue mutation for the background writer
+        self.write_record(record)
+
+    def complete (self, isbn, id):
+        self.check_open()
+        record = {'op': 'complete', 'isbn': isbn, 'id': id, 'at': int(time.time())}
+
+        # Update books in memory
+        self.apply(record)
+
+        # Queue mutation for the background writer
+        self.write_record(record)
+
+    def rate (self, isbn, id, rating):
+        self.check_open()
+        record = {'op': 'rate', 'isbn': isbn, 'id': id, 'rating': int(rating), 'at': int(time.time())}
+
+        # Update books in memory
+        self.apply(record)
+
+        # Queue mutation for the background writer
+        self.write_record(record)
+
+def snapshot_identity (path:str):
+    ''' Changes whenever a snapshot is swapped in at path, None if there isn't one '''
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+
+def open_library (path:str):
+    ''' Opens the library at path (without an extension) with the storage engine picked by BACKEND in .env '''
+    if BACKEND == 'sqlite':
+        # Imported here since sqlite_db imports this module
+        from sqlite_db import SqliteLibrary
+        return SqliteLibrary(path + '.sqlite')
+    elif BACKEND == 'json':
+        return JsonLibrary(path + '.json')
     else:
-        # Else add book
-        append_data({book["isbn"]: book})
-
-def search (isbn):
-    # Search db for ISBN key
-    return isbn in library_data["books"]
-
-def append_data (new_data:dict):
-    # Add new book data to memory-db
-    library_data["books"].update(new_data)
-    
-    # Write memory to file
-    with open("db.json", 'w') as db:
-        json.dump(library_data, db, indent=4)
-
-def complete (isbn, id):
-    # Update library_data in memory
-    library_data["books"][isbn]['completions'].append(id)
-
-    # Write memory to file
-    with open("db.json", 'w') as db:
-        json.dump(library_data, db, indent=4)
-
-def rate (isbn, id, rating):
-    # Update library_data in memory
-    library_data["books"][isbn]['ratings'].update({str(id): int(rating)})
-
-    # Write memory to file
-    with open("db.json", 'w') as db:
-        json.dump(library_data, db, indent=4)
\ No newline at end of file
+        raise ValueError(f"Unknown BACKEND in .env: {BACKEND}")
+
+class Libraries:
+    ''' Per-server libraries, loaded on first use and unloaded least recently used first once MEMORY_BUDGET is used up '''
+
+    def __init__ (self, budget:float = MEMORY_BUDGET):
+        self.budget = budget
+        # server id (None outside of servers) -> library, least recently used first
+        self.loaded:OrderedDict = OrderedDict()
+        self.stats = {'hits': 0, 'misses': 0, 'evictions': 0, 'load_time': 0.0, 'max_load_time': 0.0}
+        # server id -> task loading its library, so every command asking for it meanwhile waits on the one load
+        self.loading:dict = {}
+        # server id -> task saving and closing its library after it was unloaded, which loading it again waits for
+        self.closing:dict = {}
+        # storage.StorageClient when this process is one of several sharing a storage service, which then does all the writing
+        self.client = None
+
+    def path (self, guild_id:int | None) -> str :
+        if guild_id == None:
+            return os.path.splitext(SQLITE_PATH if BACKEND == 'sqlite' else DB_PATH)[0]
+        return os.path.join(LIBRARIES_PATH, str(guild_id))
+
+    def cached (self, guild_id:int | None):
+        ''' The library for a server if it's loaded and up to date, otherwise None '''
+        if guild_id in self.loaded and self.loaded[guild_id].stale:
+            self.loaded.pop(guild_id).close()
+        if guild_id not in self.loaded:
+            return None
+        self.stats['hits'] += 1
+        self.loaded.move_to_end(guild_id)
+        return self.loaded[guild_id]
+
+    def ready (self, guild_id:int | None) -> bool :
+        ''' Whether load() has the library already, rather than having to load it '''
+        return guild_id in self.loaded and not self.loaded[guild_id].stale
+
+    def get (self, guild_id:int | None):
+        ''' The library for a server, loading it right here if it isn't yet. The bot uses load instead so loading doesn't block every server '''
+        library = self.cached(guild_id)
+        if library != None:
+            return library
+        os.makedirs(LIBRARIES_PATH, exist_ok=True)
+        started = time.perf_counter()
+        library = open_library(self.path(guild_id)) if self.client == None else self.client.open(guild_id, self.path(guild_id))
+        self.add(guild_id, library, time.perf_counter() - started, False)
+        try:
+            asyncio.get_running_loop()
+        except RuntimeError:
+            # Outside the bot there's no loop to write in the background on, so flush() has to be called instead
+            pass
+        else:
+            library.start_writer()
+            offload.warm(library)
+        return library
+
+    async def load (self, guild_id:int | None):
+        ''' get() for the event loop, loading the library in the executor. Commands asking for it while it loads wait on the same load '''
+        library = self.cached(guild_id)
+        if library != None:
+            return library
+        if guild_id not in self.loading:
+            self.loading[guild_id] = asyncio.get_running_loop().create_task(self.load_now(guild_id))
+        # Shielded so one command being cancelled doesn't cancel the load for everyone waiting on it
+        return await asyncio.shield(self.loading[guild_id])
+
+    async def load_now (self, guild_id:int | None):
+        try:
+            if guild_id in self.closing:
+                # Its last changes have to be on disk before it's read back. Waited on without cancelling it
+                await asyncio.wait([self.closing[guild_id]])
+            os.makedirs(LIBRARIES_PATH, exist_ok=True)
+            started = time.perf_counter()
+            if self.client == None:
+                library = await asyncio.get_running_loop().run_in_executor(None, open_library, self.path(guild_id))
+            else:
+                library = await self.client.load(guild_id, self.path(guild_id))
+            self.add(guild_id, library, time.perf_counter() - started, True)
+            library.start_writer()
+            offload.warm(library)
+            return library
+        finally:
+            del self.loading[guild_id]
+
+    def add (self, guild_id:int | None, library, load_time:float, background:bool):
+        self.stats['misses'] += 1
+        self.stats['load_time'] += load_time
+        self.stats['max_load_time'] = max(self.stats['max_load_time'], load_time)
+        self.loaded[guild_id] = library
+        self.evict(background)
+
+    def evict (self, background:bool = False):
+        '''
+        Unloads least recently used libraries until the rest fit in the budget, always keeping the newest one.
+        In the background they're closed in the executor once any write they have running finishes, otherwise right here
+        '''
+        while len(self.loaded) > 1 and sum(library.size() for library in self.loaded.values()) > self.budget:
+            guild_id, library = self.loaded.popitem(last=False)
+            self.stats['evictions'] += 1
+            if not background:
+                library.close()
+                continue
+            library.closed = True
+            closing = asyncio.get_running_loop().create_task(library.aclose())
+            self.closing[guild_id] = closing
+            closing.add_done_callback(lambda task, guild_id=guild_id: self.closing.pop(guild_id) if self.closing.get(guild_id) is task else None)
+
+    async def wait_closed (self):
+        ''' Waits for libraries still being closed in the background, so stopping the bot doesn't cut them off '''
+        if self.closing != {}:
+            await asyncio.wait(list(self.closing.values()))
+
+    def hit_rate (self) -> float :
+        lookups = self.stats['hits'] + self.stats['misses']
+        return self.stats['hits'] / lookups if lookups != 0 else 0.0
+
+    def average_load_time (self) -> float :
+        return self.stats['load_time'] / self.stats['misses'] if self.stats['misses'] != 0 else 0.0
+
+    def flush (self):
+        for library in self.loaded.values():
+            library.flush()
+
+libraries = Libraries()
+
+async def library (guild):
+    ''' The library for a discord.Guild, or the one in db.json for DMs '''
+    return await libraries.load(None if guild == None else guild.id)
+
+def flush ():
+    libraries.flush()
\ No newline at end of file
@@ -2,6 +2,7 @@ import discord
 from dotenv import dotenv_values
 
 config = dotenv_values('.env')
+prefix = config.get('PREFIX') or 'lib!'
 
 custom_helps = {
     "isbn": {
@@ -15,7 +16,25 @@ custom_helps = {
     }
 }
 
+# lib!help name -> rendered embed, filled in once at startup by build_help_cache
+help_embeds:dict = {}
+
+def build_help_cache (bot) :
+    ''' Renders the full help and every command's, alias' and custom help's embed ahead of time '''
+    help_embeds.clear()
+    names = [''] + list(custom_helps)
+    for command in bot.commands:
+        if command.hidden == False:
+            names += [command.name, *command.aliases]
+    for name in names:
+        help_embeds[name] = render_help(bot, name)
+
 def help_embed (bot, name) :
+    if name in help_embeds:
+        return help_embeds[name]
+    return render_help(bot, name)
+
+def render_help (bot, name) :
     if name == '':
         # Construct and return full help embed
         help_embed = discord.Embed(
@@ -26,19 +45,27 @@ def help_embed (bot, name) :
             Librarian is a bot for managing book recommendations and rating them! 
             
             All of its commands are listed below! Arguments in <> are required, arguments in [] are optional; /s denote alises and different options.
+            `/finish`, `/rate`, `/view`, `/tag`, `/favorites`, `/trending` and `/random` work as slash commands too, suggesting books and tags as you type.
             If you run into any issues please check the github, and follow what the error message says!
             """
         )
         help_embed.add_field(inline=False, name='lib!help [command / isbn]', value='Prints this message or information on and examples of a specific command.')
-        help_embed.add_field(inline=False, name="""lib!add <"Book Title"> <"Author's Name> <10  / 13 digit ISBN> ["comma,separated,tags]""", value='Add a new entry to the library!')
+        help_embed.add_field(inline=False, name="""lib!add <"Book Title"> <"Author's Name> <10  / 13 digit ISBN> ["comma,separated,tags]""", value='Add a new entry to the library! If the bot has a catalog, `lib!add <ISBN> ["comma,separated,tags"]` fills in the title and author for you.')
+        help_embed.add_field(inline=False, name='lib!import <attached .csv>', value='Add a whole CSV of books (title, author, isbn, tags columns) or a Goodreads export at once!')
+        help_embed.add_field(inline=False, name='lib!export [json/csv/json.gz/csv.gz] ["comma,separated,tags" / "tag AND (tag OR tag) AND NOT tag"]', value='Sends the library, or just the books with some tags, as a file. CSV exports can be imported again with `lib!import`!')
         help_embed.add_field(inline=False, name='lib!stats', value="""Sends an overview of all the library's stats, including total entries, favorite book, and most popular book!""")
         help_embed.add_field(inline=False, name='lib!view/book <isbn>', value='View an overview of a specific book!')
+        help_embed.add_field(inline=False, name='lib!list/browse [title/author/rating/completions]', value='Browse the whole library a page at a time. Defaults to sorting by title!')
+        help_embed.add_field(inline=False, name='lib!search/find <"start of a title or author"> [title/author]', value="Finds books whose title or author starts with what you type. Searches titles by default, and skips a leading 'the', 'a' or 'an'.")
         help_embed.add_field(inline=False, name='lib!finish/complete/done <ISBN / Title (title has to be exact)> [1-10]', value="""Increment a book's 'completions' counter and add your rating from 1 to 10 to the average rating!""")
         help_embed.add_field(inline=False, name='lib!rate <ISBN / Title (title has to be exact)> <1-10>', value="""Update your rating of the specified book!""")
         help_embed.add_field(inline=False, name='lib!tag <isbn>', value='Add new tags to a book!')
-        # help_embed.add_field(inline=False, name='lib!hot/top [1+] [tag]', value='Lists the most popular x  books in a specific tag. Defaults to the top 10 and all tags')
-        # help_embed.add_field(inline=False, name='lib!favorites [1+] [tag]', value='Lists the highest-rated x  books in a specific tag. Defaults to the top 10 and all tags')
-        help_embed.add_field(inline=False, name='lib!random/rec/recme ["comma,separated,tags"] [strict/loose]', value='Picks a random book from the library with the specified tags.')
+        help_embed.add_field(inline=False, name='lib!hot/top [1-25] [tag]', value='Lists the most popular x books in a specific tag. Defaults to the top 10 and all tags')
+        help_embed.add_field(inline=False, name='lib!favorites/faves [1-25] [tag]', value='Lists the highest-rated x books in a specific tag. Defaults to the top 10 and all tags')
+        help_embed.add_field(inline=False, name='lib!trending/trend [1-365] [tag]', value='Lists the books finished and rated the most in the last x days in a specific tag. Defaults to the last 7 days and all tags')
+        help_embed.add_field(inline=False, name='lib!profile/me [@member] [page]', value="Shows what someone has finished and how they've rated it. Defaults to you!")
+        help_embed.add_field(inline=False, name='lib!random ["comma,separated,tags" / "tag AND (tag OR tag) AND NOT tag"] [strict/loose]', value='Picks a random book from the library with the specified tags.')
+        help_embed.add_field(inline=False, name='lib!recommend/rec/recme [1-25] ["comma,separated,tags" / "tag AND (tag OR tag) AND NOT tag"]', value="Recommends books you haven't read based on your ratings. Defaults to 5!")
         help_embed.add_field(inline=False, name='lib!meta', value='Prints bot data.')
 
         help_embed.set_footer(text="developed with ❤ by kayt_was_taken")
@@ -80,8 +107,8 @@ def construct_doc_embed (command, included = True) :
         title=command.brief,
         description=command.help
     )
-    help_embed.add_field(name='Example', value=f'{config["PREFIX"]}{command.usage}')
+    help_embed.add_field(name='Example', value=f'{prefix}{command.usage}')
     help_embed.add_field(name='Aliases', value=', '.join(str(alias) for alias in command.aliases) if command.aliases != [] else 'N/A')
-    help_embed.set_footer(text=f"{config['PREFIX']}help {command.name}")
+    help_embed.set_footer(text=f"{prefix}help {command.name}")
 
     return help_embed
\ No newline at end of file
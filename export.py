@@ -0,0 +1,172 @@
+import asyncio
+import csv
+import io
+import json
+import os
+import sys
+import time
+import zlib
+
+# Formats lib!export can write, .gz ones gzip compressed
+FORMATS = ('json', 'csv', 'json.gz', 'csv.gz')
+EXTENSIONS = {'json': 'ndjson', 'csv': 'csv'}
+CSV_COLUMNS = ('title', 'author', 'isbn', 'tags', 'completions', 'rating')
+# Lines are gathered into chunks of about this many bytes before being compressed and written
+CHUNK_BYTES = 64 * 1024
+# Books whose tags are checked against the filter at once
+WINDOW = 4096
+# Room left under the upload limit for Discord's own overhead on each file
+UPLOAD_MARGIN = 64 * 1024
+
+def books (library, matches:int | None = None):
+    '''
+    Every book in the library, or every one in a match_tags bitset, oldest first. Goes by tag index ordinal rather than
+    over library.books, so books added while this runs don't break it, they just aren't included
+    '''
+    isbns = library.tags.isbns
+    count = len(isbns)
+    for start in range(0, count, WINDOW):
+        window = (matches >> start) & ((1 << WINDOW) - 1) if matches != None else -1
+        if window == 0:
+            continue
+        for ordinal in range(start, min(start + WINDOW, count)):
+            if (window >> (ordinal - start)) & 1:
+                yield library.books[isbns[ordinal]]
+
+def json_lines (books):
+    ''' A line of json per book in the db.json schema '''
+    for book in books:
+        yield json.dumps(book.to_dict()) + '\n'
+
+def csv_lines (books):
+    ''' A CSV row per book, in columns lib!import reads back '''
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    for book in books:
+        ratings = book.scores
+        writer.writerow((book.title, book.author, book.isbn, ','.join(book.tags), len(book.completions), round(sum(ratings) / len(ratings), 2) if len(ratings) != 0 else ''))
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+
+def csv_header () -> bytes :
+    buffer = io.StringIO()
+    csv.writer(buffer).writerow(CSV_COLUMNS)
+    return buffer.getvalue().encode()
+
+def chunks (lines, size:int = CHUNK_BYTES):
+    ''' Whole lines, encoded and joined into chunks of about size bytes '''
+    chunk, length = [], 0
+    for line in lines:
+        line = line.encode()
+        chunk.append(line)
+        length += len(line)
+        if length >= size:
+            yield b''.join(chunk)
+            chunk, length = [], 0
+    if chunk != []:
+        yield b''.join(chunk)
+
+class Parts:
+    '''
+    Files chunks are written into, each kept under limit bytes (0 for no limit) by starting the next once a chunk might not fit.
+    Every part starts with the header and is compressed separately, so each one can be read or imported on its own
+    '''
+
+    def __init__ (self, path:str, limit:int = 0, compress:bool = False, header:bytes = b''):
+        directory, name = os.path.split(path)
+        stem, _, extension = name.partition('.')
+        # Parts after the first are named like library-2.csv
+        self.root, self.extension = os.path.join(directory, stem), '.' + extension if extension != '' else ''
+        self.limit = limit
+        self.compress = compress
+        self.header = header
+        self.paths:list = []
+        self.file = None
+        self.compressor = None
+        # Bytes of the current part that are already on disk, and whether anything besides the header went in
+        self.size = 0
+        self.filled = False
+
+    def start (self):
+        self.finish()
+        number = len(self.paths) + 1
+        self.paths.append(f'{self.root}{self.extension}' if number == 1 else f'{self.root}-{number}{self.extension}')
+        self.file = open(self.paths[-1], 'wb')
+        # wbits 31 writes a gzip header and trailer around the deflate stream
+        self.compressor = zlib.compressobj(6, zlib.DEFLATED, 31) if self.compress else None
+        self.size = 0
+        self.filled = False
+        self.put(self.header)
+
+    def put (self, data:bytes):
+        if self.compressor != None:
+            # Flushing every chunk costs a few bytes but means the size on disk is always exact
+            data = self.compressor.compress(data) + self.compressor.flush(zlib.Z_SYNC_FLUSH)
+        self.file.write(data)
+        self.size += len(data)
+
+    def fits (self, chunk:bytes) -> bool :
+        # Deflate can come out slightly bigger than what went in, plus the gzip trailer
+        return self.limit == 0 or self.size + len(chunk) + len(chunk) // 1000 + 64 <= self.limit
+
+    def write (self, chunk:bytes):
+        if self.file == None or (self.filled and not self.fits(chunk)):
+            self.start()
+        self.put(chunk)
+        self.filled = True
+
+    def finish (self):
+        if self.file == None:
+            return
+        if self.compressor != None:
+            self.file.write(self.compressor.flush())
+        self.file.close()
+        self.file = None
+
+    def close (self) -> list :
+        ''' Finishes the last part, returning the path of every part '''
+        if self.file == None and self.paths == []:
+            self.start()
+        self.finish()
+        return self.paths
+
+def pipeline (library, format:str, matches:int | None = None) -> tuple :
+    ''' (chunks of the export, header every part starts with) '''
+    lines = csv_lines(books(library, matches)) if format.startswith('csv') else json_lines(books(library, matches))
+    return chunks(lines), csv_header() if format.startswith('csv') else b''
+
+def filename (format:str) -> str :
+    kind = format.split('.')[0]
+    return f'library.{EXTENSIONS[kind]}' + ('.gz' if format.endswith('.gz') else '')
+
+async def export (library, format:str, matches:int | None, directory:str, limit:int = 0) -> list :
+    '''
+    Streams the library into files in directory, split so none is over limit bytes, and returns their paths.
+    Only a chunk is in memory at a time, and the event loop gets a turn after every one
+    '''
+    data, header = pipeline(library, format, matches)
+    parts = Parts(os.path.join(directory, filename(format)), limit, format.endswith('.gz'), header)
+    for chunk in data:
+        parts.write(chunk)
+        await asyncio.sleep(0)
+    return parts.close()
+
+def export_file (library, path:str, tags:str = '') -> list :
+    ''' export() straight to path, in the format its extension says, for running outside the bot '''
+    name = os.path.basename(path)
+    format = 'csv' if '.csv' in name else 'json'
+    data, header = pipeline(library, format, library.match_tags(tags) if tags != '' else None)
+    parts = Parts(path, compress=name.endswith('.gz'), header=header)
+    for chunk in data:
+        parts.write(chunk)
+    return parts.close()
+
+if __name__ == '__main__':
+    # python export.py library.ndjson[.gz] / library.csv[.gz] [server id] [tag]
+    import db
+
+    started = time.perf_counter()
+    library = db.libraries.get(int(sys.argv[2]) if len(sys.argv) > 2 and sys.argv[2] != '' else None)
+    paths = export_file(library, sys.argv[1], sys.argv[3] if len(sys.argv) > 3 else '')
+    print(f'Exported to {", ".join(paths)} in {round(time.perf_counter() - started, 2)}s')
@@ -0,0 +1,158 @@
+import itertools
+import json
+import re
+import time
+import discord
+from aiohttp import web
+
+# Message sends and edits allowed per channel before Discord answers with 429s, and how often that allowance refills
+LIMIT = 5
+WINDOW = 5.0
+
+USER = {'id': '1', 'username': 'librarian', 'discriminator': '0', 'global_name': None, 'avatar': None, 'bot': True}
+APPLICATION = {
+    'id': '1', 'name': 'librarian', 'icon': None, 'description': '', 'bot_public': True, 'bot_require_code_grant': False,
+    'owner': USER, 'verify_key': '', 'flags': 0,
+}
+
+def bucket (method:str, path:str) -> str :
+    ''' Discord rate limits message routes per channel, with every message id in a channel sharing a bucket '''
+    return f'{method} {re.sub(r"/messages/[0-9]+", "/messages/id", path)}'
+
+def reply (data:dict, status:int = 200, headers:dict = {}) -> web.Response :
+    # discord.py only parses bodies labelled exactly application/json, without a charset
+    return web.Response(body=json.dumps(data).encode(), status=status, headers={**headers, 'Content-Type': 'application/json'})
+
+class FakeDiscord:
+    '''
+    A local stand-in for Discord's REST API that the bot's real HTTP client talks to, with per channel rate limit buckets.
+    Every request is recorded, and every nth one can be answered with a 429 on top of the real limits
+    '''
+
+    def __init__ (self, limit:int = LIMIT, window:float = WINDOW, fail_every:int = 0):
+        self.limit = limit
+        self.window = window
+        self.fail_every = fail_every
+        # (method, path, status) of every request, in order
+        self.calls:list = []
+        # bucket -> (requests left, time.monotonic() when it refills)
+        self.buckets:dict = {}
+        # Sent messages by id, so edits can keep what they don't change
+        self.messages:dict = {}
+        self.ids = itertools.count(1000)
+        # Attachment path -> bytes, for commands reading attached files
+        self.files:dict = {}
+        self.runner = None
+        self.url = ''
+
+    async def start (self) -> str :
+        app = web.Application()
+        app.router.add_route('*', '/{path:.*}', self.handle)
+        self.runner = web.AppRunner(app)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, '127.0.0.1', 0)
+        await site.start()
+        self.url = f'http://127.0.0.1:{site._server.sockets[0].getsockname()[1]}'
+        return self.url
+
+    async def stop (self):
+        await self.runner.cleanup()
+
+    def attach (self, filename:str, data:bytes) -> dict :
+        ''' An attachment payload for a message, served from here '''
+        self.files[f'/attachments/{filename}'] = data
+        return {'id': str(next(self.ids)), 'filename': filename, 'size': len(data), 'url': f'{self.url}/attachments/{filename}', 'proxy_url': f'{self.url}/attachments/{filename}'}
+
+    def limited (self, key:str) -> float :
+        ''' Takes a request out of a bucket, returning how long to wait if it's empty or 0 if it went through '''
+        now = time.monotonic()
+        remaining, resets = self.buckets.get(key, (self.limit, now + self.window))
+        if now >= resets:
+            remaining, resets = self.limit, now + self.window
+        if remaining == 0:
+            return resets - now
+        self.buckets[key] = (remaining - 1, resets)
+        return 0.0
+
+    def headers (self, key:str) -> dict :
+        remaining, resets = self.buckets[key]
+        return {
+            'X-RateLimit-Limit': str(self.limit), 'X-RateLimit-Remaining': str(remaining),
+            'X-RateLimit-Reset-After': f'{max(resets - time.monotonic(), 0):.3f}', 'X-RateLimit-Bucket': str(abs(hash(key))),
+        }
+
+    async def handle (self, request:web.Request) -> web.Response :
+        path = request.path
+        if path in self.files:
+            self.calls.append((request.method, path, 200))
+            return web.Response(body=self.files[path])
+
+        path = re.sub(r'^/api/v[0-9]+', '', path)
+        key = bucket(request.method, path)
+        wait = self.limited(key)
+        if wait == 0 and self.fail_every != 0 and (len(self.calls) + 1) % self.fail_every == 0:
+            wait = 0.05
+        if wait != 0:
+            self.calls.append((request.method, path, 429))
+            # discord.py only retries 429s that came through Discord's proxy, anything else looks like a Cloudflare ban
+            headers = {'Via': '1.1 google', 'X-RateLimit-Limit': str(self.limit), 'X-RateLimit-Remaining': '0', 'X-RateLimit-Reset-After': f'{wait:.3f}', 'X-RateLimit-Bucket': str(abs(hash(key)))}
+            return reply({'message': 'You are being rate limited.', 'retry_after': wait, 'global': False}, status=429, headers=headers)
+
+        self.calls.append((request.method, path, 200))
+        headers = self.headers(key)
+        if path == '/users/@me':
+            return reply(USER, headers=headers)
+        if path == '/oauth2/applications/@me':
+            return reply(APPLICATION, headers=headers)
+
+        match = re.fullmatch(r'/channels/([0-9]+)/messages(?:/([0-9]+))?', path)
+        if match == None:
+            return reply({'message': f'No stand-in for {request.method} {path}', 'code': 0}, status=404)
+        if request.method == 'DELETE':
+            self.messages.pop(match[2], None)
+            return web.Response(status=204, headers=headers)
+
+        payload = await self.payload(request)
+        id = match[2] or str(next(self.ids))
+        message = {
+            **self.messages.get(id, {'content': '', 'embeds': [], 'attachments': [], 'components': []}),
+            **{key: value for key, value in payload.items() if key in ('content', 'embeds', 'components')},
+            'id': id, 'channel_id': match[1], 'author': USER, 'timestamp': '2024-01-01T00:00:00+00:00', 'edited_timestamp': None,
+            'tts': False, 'mention_everyone': False, 'mentions': [], 'mention_roles': [], 'pinned': False, 'type': 0, 'flags': 0,
+        }
+        if message['content'] == None:
+            message['content'] = ''
+        self.messages[id] = message
+        return reply(message, headers=headers)
+
+    async def payload (self, request:web.Request) -> dict :
+        ''' The json body of a request, which requests with files send as the payload_json part of a multipart form '''
+        if request.content_type == 'application/json':
+            return await request.json()
+        if request.content_type.startswith('multipart/'):
+            reader = await request.multipart()
+            while (part := await reader.next()) != None:
+                if part.name == 'payload_json':
+                    return await part.json()
+        return {}
+
+    def count (self, status:int | None = None) -> int :
+        ''' Requests made so far, or only ones answered with status '''
+        return sum(1 for _, _, answered in self.calls if status == None or answered == status)
+
+async def connect (bot, server:FakeDiscord):
+    ''' Points a bot's REST requests at the stand-in and logs it in, without a gateway connection '''
+    discord.http.Route.BASE = server.url + '/api/v10'
+    await bot.login('stand-in')
+
+def message (bot, content:str, guild_id:int = 1, channel_id:int = 2, author_id:int = 3, attachments:list = []) -> discord.Message :
+    ''' A message as if the gateway had just delivered it, for bot.process_commands '''
+    state = bot._connection
+    guild = discord.Guild(data={'id': str(guild_id), 'name': 'Stand-in'}, state=state)
+    channel = discord.TextChannel(state=state, guild=guild, data={'id': str(channel_id), 'type': 0, 'name': 'library', 'position': 0, 'guild_id': str(guild_id)})
+    author = {'id': str(author_id), 'username': f'reader{author_id}', 'discriminator': '0', 'global_name': None, 'avatar': None}
+    return discord.Message(state=state, channel=channel, data={
+        'id': str(time.time_ns()), 'channel_id': str(channel_id), 'author': author, 'content': content, 'attachments': attachments,
+        'embeds': [], 'mentions': [], 'mention_roles': [], 'mention_everyone': False, 'pinned': False, 'tts': False,
+        'timestamp': '2024-01-01T00:00:00+00:00', 'edited_timestamp': None, 'type': 0, 'flags': 0,
+    })
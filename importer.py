@@ -0,0 +1,123 @@
+import csv
+import sys
+import time
+import catalog
+from isbn import LengthError, ValidationError, canonical, canonical_many
+from tags import bracketed
+
+# Rows validated per batch
+BATCH_SIZE = 1000
+# Books lib!import adds per write, letting other commands run in between so a big import doesn't hold everyone up for seconds
+COMMIT_SIZE = 5000
+
+def clean_isbn (raw:str) -> str :
+    ''' Strips Goodreads' ="..." wrapping '''
+    return raw.strip().strip('="')
+
+def read_rows (lines):
+    '''
+    Streams (line number, row) pairs from a CSV with title, author, isbn and tags columns, or a Goodreads export.
+    Header names are case-insensitive. Goodreads' ISBN13 is used over ISBN when it's there, and Bookshelves become tags.
+    '''
+    reader = csv.DictReader(lines)
+    for row in reader:
+        row = {key.strip().lower(): (value or '').strip() for key, value in row.items() if key != None}
+        yield reader.line_num, {
+            'title': row.get('title', ''),
+            'author': row.get('author', ''),
+            'isbn': clean_isbn(row.get('isbn13') or row.get('isbn') or ''),
+            'tags': row.get('tags') or row.get('bookshelves') or '',
+        }
+
+def check_batch (batch:list) -> tuple :
+    ''' Validates a batch of (line, row) pairs, returning the books that passed and (line, reason) for the ones that didn't '''
+    books, rejected = [], []
+    keys = canonical_many([row['isbn'] for _, row in batch])
+    for (line, row), key in zip(batch, keys):
+        if (row['title'] == '' or row['author'] == '') and key != None:
+            # Filled in from the catalog when there is one, rows from Goodreads lists often only have the ISBN
+            record = catalog.lookup(key)
+            if record != None:
+                row = {**row, 'title': row['title'] or record['title'], 'author': row['author'] or record['author']}
+        if row['title'] == '':
+            rejected.append((line, 'Missing title'))
+            continue
+        if row['author'] == '':
+            rejected.append((line, 'Missing author'))
+            continue
+        if row['isbn'] == '':
+            rejected.append((line, 'Missing ISBN'))
+            continue
+
+        if key == None:
+            # Only failures need the slow path to find out why
+            try:
+                canonical(row['isbn'])
+            except (LengthError, ValidationError) as err:
+                rejected.append((line, f'Invalid ISBN {row["isbn"]}: {err}'))
+            continue
+
+        tags = [tag.strip() for tag in row['tags'].split(',') if tag.strip() != '']
+        if bracketed(tags) != []:
+            rejected.append((line, f'Brackets in tag {bracketed(tags)[0]}'))
+            continue
+
+        books.append((line, {
+            'title': row['title'],
+            'author': row['author'],
+            'isbn': key,
+            'tags': tags,
+            'ratings': {},
+            'completions': [],
+        }))
+    return books, rejected
+
+def prepare (lines) -> tuple :
+    ''' Parses and validates a whole file without touching a library, so it can run off the event loop '''
+    books, rejected = [], []
+    batch = []
+    for line, row in read_rows(lines):
+        batch.append((line, row))
+        if len(batch) == BATCH_SIZE:
+            checked, failed = check_batch(batch)
+            books += checked
+            rejected += failed
+            batch = []
+    checked, failed = check_batch(batch)
+    return books + checked, rejected + failed
+
+def commit (library, books:list, rejected:list) -> int :
+    ''' Drops books already in the library or earlier in the file, then adds the rest in one write. Returns how many were added '''
+    new_books:dict = {}
+    for line, book in books:
+        # Already canonical from check_batch, so no need for library.search
+        if book['isbn'] in new_books or book['isbn'] in library.books:
+            rejected.append((line, f'Duplicate ISBN {book["isbn"]}'))
+            continue
+        new_books[book['isbn']] = book
+
+    if new_books != {}:
+        library.append_data(new_books)
+    rejected.sort()
+    return len(new_books)
+
+def report (added:int, rejected:list) -> str :
+    lines = [f'Added {added} books, rejected {len(rejected)} rows']
+    lines += [f'Line {line}: {reason}' for line, reason in rejected]
+    return '\n'.join(lines)
+
+if __name__ == '__main__':
+    # python importer.py catalog.csv [server id]
+    import db
+
+    started = time.perf_counter()
+    with open(sys.argv[1], newline='', encoding='utf-8-sig') as file:
+        books, rejected = prepare(file)
+    library = db.libraries.get(int(sys.argv[2]) if len(sys.argv) > 2 else None)
+    added = commit(library, books, rejected)
+    library.flush()
+    elapsed = time.perf_counter() - started
+
+    print(report(added, rejected))
+    rows = added + len(rejected)
+    print(f'{rows} rows in {round(elapsed, 2)}s ({round(rows / elapsed)} rows/s)')
\ No newline at end of file
@@ -1,3 +1,9 @@
+try:
+    import numpy
+except ImportError:
+    # Batch validation falls back to plain Python without numpy
+    numpy = None
+
 isbn = '9780375420528'
 isbn_hyphenated = '978-0-37-542052-8'
 
@@ -5,7 +11,7 @@ isbn_hyphenated = '978-0-37-542052-8'
 # [✓] validate
 # [✓] val_13
 # [✓] val_10
-# [ ] convert 10 -> 13
+# [✓] convert 10 -> 13
 
 class LengthError(Exception):
     pass
@@ -13,11 +19,20 @@ class LengthError(Exception):
 class ValidationError(Exception):
     pass
 
+# int() takes any Unicode digit, so anything else is turned away before it gets that far
+ALLOWED = set('0123456789Xx')
+
+def strip (isbn:str) -> str :
+    ''' Removes hyphens and spaces '''
+    # https://stackoverflow.com/questions/265960/best-way-to-strip-punctuation-from-a-string
+    return isbn.translate(str.maketrans('', '', '- '))
+
 def validate (isbn:str) -> bool :
     ''' Checks if the check digit is correct, returns T/F accordingly '''
     
-    # Remove hyphens https://stackoverflow.com/questions/265960/best-way-to-strip-punctuation-from-a-string
-    isbn.translate(str.maketrans('', '', '-'))
+    isbn = strip(isbn)
+    if not set(isbn) <= ALLOWED:
+        raise ValidationError("Input contains something other than digits and X")
 
     if len(isbn) == 13 :
         return val_13(isbn)
@@ -52,5 +67,66 @@ def val_10 (isbn:str) :
     return ( sum( [ value*coefficient for coefficient, value in enumerate(digits, 1) ] ) ) %11 == 0
 
 
-# def convert () 
+def convert (isbn:str) -> str :
+    ''' Converts a valid ISBN-10 to its ISBN-13 equivalent '''
+    digits = [int(d) for d in '978' + isbn[0:9]]
+    check = ( 10 - ( sum(digits[0:12:2]) + sum(digits[1:12:2]) *3 ) %10 ) %10
+    return '978' + isbn[0:9] + str(check)
+
+
+def canonical (isbn:str) -> str :
+    ''' The key a book is stored under: the ISBN-13 without separators. Raises LengthError or ValidationError if it isn't valid '''
+    isbn = strip(isbn)
+    if not validate(isbn):
+        raise ValidationError("Check digit doesn't match")
+    return convert(isbn) if len(isbn) == 10 else isbn
+
+
+def canonical_many (isbns:list) -> list :
+    ''' canonical() for a whole list at once, with None in place of invalid ISBNs. Vectorized with numpy when it's installed '''
+    stripped = [strip(isbn) for isbn in isbns]
+    if numpy == None:
+        results = []
+        for isbn in stripped:
+            try:
+                results.append(canonical(isbn))
+            except (LengthError, ValidationError):
+                results.append(None)
+        return results
+
+    results = [None] * len(stripped)
+    for length, check in ((13, _check_13), (10, _check_10)):
+        positions = [i for i, isbn in enumerate(stripped) if len(isbn) == length]
+        if positions == []:
+            continue
+        # One row of ascii codes per ISBN
+        codes = numpy.frombuffer(''.join(stripped[i] for i in positions).encode('ascii', 'replace'), dtype=numpy.uint8).reshape(-1, length)
+        for position, key in zip(positions, check(codes)):
+            results[position] = key
+    return results
+
+
+def _check_13 (codes):
+    digits = codes.astype(numpy.int64) - 48
+    numeric = ((digits >= 0) & (digits <= 9)).all(axis=1)
+    weights = numpy.tile([1, 3], 7)[:13]
+    valid = numeric & ( (digits * weights).sum(axis=1) %10 == 0 )
+    keys = codes.view('S13').ravel()
+    return [key.decode() if ok else None for key, ok in zip(keys, valid)]
+
+
+def _check_10 (codes):
+    digits = codes.astype(numpy.int64) - 48
+    # Handle x in check digit
+    is_x = (codes[:, 9] == ord('x')) | (codes[:, 9] == ord('X'))
+    digits[:, 9] = numpy.where(is_x, 10, digits[:, 9])
+    numeric = ((digits[:, 0:9] >= 0) & (digits[:, 0:9] <= 9)).all(axis=1) & (is_x | ((digits[:, 9] >= 0) & (digits[:, 9] <= 9)))
+    valid = numeric & ( (digits * numpy.arange(1, 11)).sum(axis=1) %11 == 0 )
+
+    # Convert to 13 digits: 978 prefix, the first 9 digits, and a new check digit
+    body = numpy.hstack([numpy.tile([9, 7, 8], (len(codes), 1)), digits[:, 0:9]])
+    check = ( 10 - (body * numpy.tile([1, 3], 6)).sum(axis=1) %10 ) %10
+    keys = numpy.hstack([body, check[:, None]]).astype(numpy.uint8) + 48
+    keys = numpy.ascontiguousarray(keys).view('S13').ravel()
+    return [key.decode() if ok else None for key, ok in zip(keys, valid)]
 
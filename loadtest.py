@@ -0,0 +1,199 @@
+import argparse
+import asyncio
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+
+import discord
+
+import bot
+import db
+import fakediscord
+import synthetic
+from isbn import convert
+
+# Made-up users get ids from here up, well clear of the ones synthetic libraries are rated by
+FIRST_USER = 10**18
+# How often each command comes up in a user's script
+MIX = {'add': 1, 'finish': 3, 'rate': 3, 'random': 2, 'stats': 1}
+# ISBNs of books users add start from here, past the ones in the generated library
+FIRST_NEW_BOOK = 900_000_000
+
+class RecordingContext (bot.ResponseContext):
+    ''' Keeps what a command replies with instead of sending it, unless the load test runs against a stand-in for Discord '''
+
+    rest = False
+    replies = None
+
+    async def send (self, content=None, *, embed=None, **kwargs):
+        self.replies.append(embed if embed != None else content)
+        if self.rest:
+            return await super().send(content, embed=embed, **kwargs)
+        return None
+
+def script (rng:random.Random, isbns:list, tags:list, commands:int, new_books) -> list :
+    '''
+    A user's commands in the order they send them. Each book is finished at most once and only finished books are rated,
+    so everything should succeed and what the library ends up with is known ahead of time
+    '''
+    lines, finished = [], []
+    for _ in range(commands):
+        kind = rng.choices(list(MIX), weights=list(MIX.values()))[0]
+        if kind == 'rate' and finished == []:
+            kind = 'finish'
+        if kind == 'finish':
+            isbn = rng.choice([isbn for isbn in rng.sample(isbns, 10) if isbn not in finished] or [None])
+            if isbn == None:
+                kind = 'stats'
+            else:
+                finished.append(isbn)
+                lines.append(('finish', f'finish {isbn} {rng.randint(1, 10)}', isbn))
+                continue
+        if kind == 'rate':
+            isbn = rng.choice(finished)
+            lines.append(('rate', f'rate {isbn} {rng.randint(1, 10)}', isbn))
+        elif kind == 'add':
+            isbn = convert(f'{next(new_books):09d}')
+            lines.append(('add', f'add "Load test book {isbn}" "Load tester" {isbn} "{rng.choice(tags)}"', isbn))
+        elif kind == 'random':
+            lines.append(('random', f'random "{rng.choice(tags)},{rng.choice(tags)}"', None))
+        else:
+            lines.append(('stats', 'stats', None))
+    return lines
+
+def expect (scripts:dict) -> tuple :
+    ''' What the scripts should leave behind: isbn -> users who finished it, (isbn, user) -> their last rating, and the books added '''
+    completions, ratings, added = {}, {}, set()
+    for user, lines in scripts.items():
+        for kind, line, isbn in lines:
+            if kind in ('finish', 'rate'):
+                ratings[(isbn, user)] = int(line.rsplit(' ', 1)[1])
+                if kind == 'finish':
+                    completions.setdefault(isbn, set()).add(user)
+            elif kind == 'add':
+                added.add(isbn)
+    return completions, ratings, added
+
+def check (library, before:dict, completions:dict, ratings:dict, added:set) -> list :
+    ''' Everything about the library that doesn't match what the scripts should have left, lost updates included '''
+    problems = []
+    for isbn, users in completions.items():
+        book = library.books[isbn]
+        ours = {user for user in book.completions if user >= FIRST_USER}
+        if ours != users:
+            problems.append(f'{isbn}: {len(users - ours)} completions lost, {len(ours - users)} that nobody made')
+        if not before[isbn] <= set(book.completions):
+            problems.append(f'{isbn}: {len(before[isbn] - set(book.completions))} completions from before the run lost')
+    for (isbn, user), rating in ratings.items():
+        if library.books[isbn].rating(user) != rating:
+            problems.append(f'{isbn}: rating by {user} is {library.books[isbn].rating(user)}, should be {rating}')
+    for isbn in added:
+        if isbn not in library.books:
+            problems.append(f'{isbn}: added but missing')
+    return problems
+
+def percentiles (times:list) -> str :
+    if len(times) < 2:
+        return ' / '.join([f'{times[0] * 1000:.1f}'] * 3) + 'ms' if times != [] else 'N/A'
+    cuts = statistics.quantiles(times, n=100, method='inclusive')
+    return f'{cuts[49] * 1000:.1f} / {cuts[94] * 1000:.1f} / {cuts[98] * 1000:.1f}ms, {max(times) * 1000:.1f}ms max'
+
+async def drive (scripts:dict, concurrency:int, server:fakediscord.FakeDiscord | None) -> tuple :
+    '''
+    Runs every user's script at once, each user's commands in order, at most concurrency commands in flight.
+    Returns command -> latencies, how many commands failed, and the replies that were errors
+    '''
+    prefix = bot.bot.command_prefix
+    limit = asyncio.Semaphore(concurrency)
+    latencies:dict = {kind: [] for kind in MIX}
+    failures, errors = [], []
+
+    async def user (id:int, lines:list):
+        for kind, line, _ in lines:
+            async with limit:
+                started = time.perf_counter()
+                # A channel each, like people using the bot all over a server
+                message = fakediscord.message(bot.bot, prefix + line, channel_id=id, author_id=id)
+                ctx = await bot.bot.get_context(message, cls=RecordingContext)
+                ctx.replies = []
+                await bot.bot.invoke(ctx)
+                latencies[kind].append(time.perf_counter() - started)
+            if ctx.command_failed:
+                failures.append(line)
+            errors.extend(reply.title for reply in ctx.replies if isinstance(reply, discord.Embed) and reply.color in (discord.Color.red(), discord.Color.dark_red()))
+
+    if server != None:
+        await server.start()
+        await fakediscord.connect(bot.bot, server)
+        RecordingContext.rest = True
+    else:
+        # Commands only need to know who the bot is, nothing gets sent
+        bot.bot._connection.user = discord.ClientUser(state=bot.bot._connection, data=fakediscord.USER)
+    await asyncio.gather(*(user(id, lines) for id, lines in scripts.items()))
+    if server != None:
+        await bot.bot.close()
+        await server.stop()
+    return latencies, failures, errors
+
+def run (users:int, commands:int, books:int, concurrency:int, seed:int, rest:bool) -> int :
+    ''' Runs the load test in a throwaway libraries folder and prints the report. Returns how many problems it found '''
+    rng = random.Random(seed)
+    path = os.path.join(db.LIBRARIES_PATH, '1')
+    synthetic.save(synthetic.generate(books, seed=seed), path + '.json')
+    if db.BACKEND == 'sqlite':
+        from sqlite_db import migrate
+        migrate(path + '.json', path + '.sqlite')
+
+    library = db.libraries.get(1)
+    isbns = list(library.books)
+    tags = sorted({tag for book in library.books.values() for tag in book.tags})
+    before = {isbn: set(library.books[isbn].completions) for isbn in isbns}
+    new_books = iter(range(FIRST_NEW_BOOK, FIRST_NEW_BOOK + users * commands))
+    scripts = {FIRST_USER + user: script(rng, isbns, tags, commands, new_books) for user in range(users)}
+    completions, ratings, added = expect(scripts)
+
+    started = time.perf_counter()
+    server = fakediscord.FakeDiscord(limit=10**9) if rest else None
+    latencies, failures, errors = asyncio.run(drive(scripts, concurrency, server))
+    elapsed = time.perf_counter() - started
+
+    total = sum(len(times) for times in latencies.values())
+    print(f'{total} commands from {users} users in {elapsed:.2f}s, {total / elapsed:.0f} commands/s ({db.BACKEND}{", through the Discord stand-in" if rest else ""})')
+    for kind, times in latencies.items():
+        print(f'  {kind:<8}{len(times):>7}  {percentiles(times)}  (p50 / p95 / p99)')
+    if server != None:
+        print(f'  {server.count()} REST requests, {server.count(429)} rate limited')
+
+    problems = [f'Failed: {line}' for line in failures] + [f'Error reply: {title}' for title in errors]
+    problems += check(library, before, completions, ratings, added)
+    # What's on disk has to agree too, not just what's in memory
+    db.flush()
+    db.libraries.loaded.pop(1).close()
+    problems += [f'On disk: {problem}' for problem in check(db.open_library(path), before, completions, ratings, added)]
+
+    checked = len(completions) + len(ratings) + len(added)
+    print(f'{checked} completions, ratings and added books checked in memory and on disk, {len(problems)} problems')
+    for problem in problems[:20]:
+        print(f'  {problem}')
+    return len(problems)
+
+if __name__ == '__main__':
+    # python loadtest.py [--users 1000] [--commands 5] [--books 200] [--concurrency 1000] [--backend json|sqlite] [--rest]
+    parser = argparse.ArgumentParser(description='Fires mixed commands from lots of made-up users at the bot at once, offline, and checks nothing was lost')
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--commands', type=int, default=5, help='commands each user sends, one after the other')
+    parser.add_argument('--books', type=int, default=200, help='books in the generated library, fewer means more users finishing and rating the same ones')
+    parser.add_argument('--concurrency', type=int, default=1000, help='most commands running at once')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--backend', default=db.BACKEND, choices=['json', 'sqlite'])
+    parser.add_argument('--rest', action='store_true', help="send replies through the bot's real HTTP client to a local stand-in for Discord")
+    args = parser.parse_args()
+
+    db.BACKEND = args.backend
+    with tempfile.TemporaryDirectory() as workdir:
+        db.LIBRARIES_PATH = workdir
+        problems = run(args.users, args.commands, args.books, args.concurrency, args.seed, args.rest)
+    sys.exit(1 if problems != 0 else 0)
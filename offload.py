@@ -0,0 +1,78 @@
+import asyncio
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from dotenv import dotenv_values
+
+config = dotenv_values('.env')
+# Libraries with fewer books than this answer heavy queries on the event loop, since a worker round trip costs more than it saves
+OFFLOAD_BOOKS = int(config.get('OFFLOAD_BOOKS') or 50000)
+# Imported files bigger than this many bytes are parsed in a worker
+OFFLOAD_BYTES = 1024 * 1024
+# Worker processes for heavy queries. Each one keeps its own copy of every big library it's asked about
+WORKERS = int(config.get('WORKERS') or 1)
+
+pool = None
+# path -> read-only copy of a library as the bot last wrote it to disk, only ever filled in worker processes
+replicas:dict = {}
+
+def get_pool () -> ProcessPoolExecutor :
+    global pool
+    if pool == None:
+        # Spawned rather than forked so workers don't inherit the bot's event loop and sockets
+        pool = ProcessPoolExecutor(WORKERS, mp_context=multiprocessing.get_context('spawn'))
+    return pool
+
+def heavy (library) -> bool :
+    return len(library.books) >= OFFLOAD_BOOKS
+
+async def run (library, func, *args):
+    ''' func(library, *args) in a worker against its replica of the library if it's big, otherwise right here on the event loop '''
+    if not heavy(library):
+        return func(library, *args)
+    return await asyncio.get_running_loop().run_in_executor(get_pool(), call, library.BACKEND, library.path, func, args)
+
+def warm (library):
+    ''' Starts every worker loading its replica of a big library, so the first heavy query doesn't have to wait for it '''
+    if heavy(library):
+        for _ in range(WORKERS):
+            get_pool().submit(call, library.BACKEND, library.path, size, ())
+
+def replica (backend:str, path:str):
+    ''' This worker's copy of the library at path, reloaded if it was compacted (or its changes log trimmed) and caught up otherwise '''
+    # Imported here since db imports this module
+    import db
+    library = replicas.get(path)
+    if library != None and not library.changed_on_disk():
+        library.catch_up()
+        return library
+
+    # Only the bot trims the journal and old activity, a replica might see a record halfway through being written
+    if backend == 'sqlite':
+        from sqlite_db import SqliteLibrary
+        library = SqliteLibrary(path, truncate=False)
+    else:
+        library = db.JsonLibrary(path, truncate=False)
+    replicas[path] = library
+    return library
+
+def call (backend:str, path:str, func, args:tuple):
+    return func(replica(backend, path), *args)
+
+def shutdown ():
+    global pool
+    if pool != None:
+        pool.shutdown(cancel_futures=True)
+        pool = None
+
+# Heavy read-only queries, picklable by name so they can be sent to workers
+
+def size (library) -> int :
+    return len(library.books)
+
+def similar_titles (library, title:str, count:int) -> list :
+    return library.similar_titles(title, count)
+
+def build_similarity (library):
+    # Imported here since recommend imports this module
+    from recommend import build
+    return build(library.readers.ratings)
@@ -0,0 +1,189 @@
+import asyncio
+import os
+import time
+from bisect import bisect_left
+from dotenv import dotenv_values
+
+config = dotenv_values('.env')
+# Turns every timer below into a no-op when set to 0
+ENABLED = (config.get('PERF') or '1') != '0'
+# Where the Prometheus text file is written for a local scraper, empty to not write one
+EXPORT_PATH = config.get('PERF_EXPORT_PATH') or ''
+# Seconds between writes of the Prometheus text file
+EXPORT_INTERVAL = float(config.get('PERF_EXPORT_INTERVAL') or 15)
+# Seconds between event loop lag samples
+LAG_INTERVAL = 0.5
+
+# Bucket upper bounds in seconds, roughly doubling from 100us to 30s
+BOUNDS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+# Bucket upper bounds for how many changes a flush wrote
+BATCH_BOUNDS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000)
+
+class Histogram:
+    ''' Fixed buckets of observed seconds, cheap enough to record on every command. Quantiles are read back from the buckets '''
+
+    def __init__ (self, bounds:tuple = BOUNDS):
+        self.bounds = bounds
+        # One count per bound plus one for anything past the last bound
+        self.counts = [0] * (len(bounds) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe (self, seconds:float):
+        self.counts[bisect_left(self.bounds, seconds)] += 1
+        self.count += 1
+        self.sum += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def quantile (self, q:float) -> float :
+        ''' Estimated q quantile (0.95 = p95), interpolated within the bucket it lands in '''
+        if self.count == 0:
+            return 0.0
+
+        rank = q * self.count
+        seen = 0
+        for i, count in enumerate(self.counts):
+            if count != 0 and seen + count >= rank:
+                lower = self.bounds[i - 1] if i != 0 else 0.0
+                upper = self.bounds[i] if i < len(self.bounds) else self.max
+                return min(lower + (upper - lower) * (rank - seen) / count, self.max)
+            seen += count
+        return self.max
+
+    def mean (self) -> float :
+        return self.sum / self.count if self.count != 0 else 0.0
+
+class Metrics:
+    ''' Everything lib!perf reports and the Prometheus file exports '''
+
+    def __init__ (self):
+        # command name -> Histogram of how long it took, including sends
+        self.commands:dict = {}
+        self.command_errors:dict = {}
+        # command name (None outside of commands) -> REST requests made, and how many of them Discord answered with a 429
+        self.rest_calls:dict = {}
+        self.rate_limited:dict = {}
+        self.sends = Histogram()
+        self.db_writes = Histogram()
+        self.db_bytes = 0
+        # Seconds from a library's first unsaved change to it being on disk, and how many changes each flush wrote, for tuning FLUSH_INTERVAL
+        self.flush_lag = Histogram()
+        self.flush_batch = Histogram(BATCH_BOUNDS)
+        self.loop_lag = Histogram()
+        self.started = time.time()
+
+    def command (self, name:str) -> Histogram :
+        if name not in self.commands:
+            self.commands[name] = Histogram()
+        return self.commands[name]
+
+    def observe_command (self, name:str, seconds:float, failed:bool = False):
+        if not ENABLED:
+            return
+        self.command(name).observe(seconds)
+        if failed:
+            self.command_errors[name] = self.command_errors.get(name, 0) + 1
+
+    def observe_send (self, seconds:float):
+        if ENABLED:
+            self.sends.observe(seconds)
+
+    def observe_rest (self, name:str | None):
+        if ENABLED:
+            self.rest_calls[name] = self.rest_calls.get(name, 0) + 1
+
+    def observe_rate_limit (self, name:str | None):
+        if ENABLED:
+            self.rate_limited[name] = self.rate_limited.get(name, 0) + 1
+
+    def rest_per_command (self, name:str) -> float :
+        ''' Average REST requests one run of a command made '''
+        runs = self.commands[name].count if name in self.commands else 0
+        return self.rest_calls.get(name, 0) / runs if runs != 0 else 0.0
+
+    def observe_write (self, seconds:float, written:int = 0):
+        ''' One db write (a journal batch, a compaction or a SQLite commit) and how many bytes it put on disk if known '''
+        if ENABLED:
+            self.db_writes.observe(seconds)
+            self.db_bytes += written
+
+    def observe_flush (self, lag:float, changes:int):
+        ''' One background flush of a json library '''
+        if ENABLED:
+            self.flush_lag.observe(lag)
+            self.flush_batch.observe(changes)
+
+    async def sample_lag (self, interval:float = LAG_INTERVAL):
+        ''' Background task measuring how late the event loop wakes up from a sleep, which is how long something blocked it '''
+        while True:
+            expected = time.perf_counter() + interval
+            await asyncio.sleep(interval)
+            if ENABLED:
+                self.loop_lag.observe(max(time.perf_counter() - expected, 0.0))
+
+    def prometheus (self) -> str :
+        ''' Every metric in the Prometheus text exposition format '''
+        lines = []
+        write_histogram(lines, 'librarian_command_seconds', 'Command latency including sends', [({'command': name}, histogram) for name, histogram in sorted(self.commands.items())])
+        lines += ['# HELP librarian_command_errors_total Commands that raised', '# TYPE librarian_command_errors_total counter']
+        lines += [f'librarian_command_errors_total{{command="{name}"}} {count}' for name, count in sorted(self.command_errors.items())]
+        for name, help, counts in (('rest_calls', 'REST requests made to Discord', self.rest_calls), ('rate_limited', 'REST requests Discord answered with a 429', self.rate_limited)):
+            lines += [f'# HELP librarian_{name}_total {help}', f'# TYPE librarian_{name}_total counter']
+            lines += [f'librarian_{name}_total{{command="{command or ""}"}} {count}' for command, count in sorted(counts.items(), key=lambda item: item[0] or '')]
+        write_histogram(lines, 'librarian_send_seconds', 'Time spent sending messages to Discord', [({}, self.sends)])
+        write_histogram(lines, 'librarian_db_write_seconds', 'Time spent writing the db to disk', [({}, self.db_writes)])
+        write_histogram(lines, 'librarian_flush_lag_seconds', 'Time from the first unsaved change to it being on disk', [({}, self.flush_lag)])
+        write_histogram(lines, 'librarian_flush_batch_changes', 'Changes written by each flush', [({}, self.flush_batch)])
+        lines += ['# HELP librarian_db_written_bytes_total Bytes written to the db', '# TYPE librarian_db_written_bytes_total counter', f'librarian_db_written_bytes_total {self.db_bytes}']
+        write_histogram(lines, 'librarian_loop_lag_seconds', 'How late the event loop woke up from a sleep', [({}, self.loop_lag)])
+        lines += ['# HELP librarian_start_time_seconds When the bot started', '# TYPE librarian_start_time_seconds gauge', f'librarian_start_time_seconds {self.started}']
+        return '\n'.join(lines) + '\n'
+
+    def export (self, path:str = EXPORT_PATH):
+        write_export(path, self.prometheus())
+
+    async def exporter (self, path:str = EXPORT_PATH, interval:float = EXPORT_INTERVAL):
+        ''' Background task rewriting the Prometheus text file every interval seconds '''
+        loop = asyncio.get_running_loop()
+        while True:
+            await asyncio.sleep(interval)
+            # Rendered on the loop since commands keep adding to the dicts it reads, only writing it out goes to the executor
+            text = self.prometheus()
+            try:
+                await loop.run_in_executor(None, write_export, path, text)
+            except OSError as err:
+                print(f'Error exporting metrics: {err}')
+
+    def start (self):
+        ''' Starts lag sampling, and exporting if there's somewhere to export to. Needs a running event loop '''
+        if not ENABLED:
+            return
+        loop = asyncio.get_running_loop()
+        loop.create_task(self.sample_lag())
+        if EXPORT_PATH != '':
+            loop.create_task(self.exporter())
+
+def write_export (path:str, text:str):
+    # Written next to the real file and swapped in so the scraper never reads half of it
+    with open(path + '.tmp', 'w') as file:
+        file.write(text)
+    os.replace(path + '.tmp', path)
+
+def write_histogram (lines:list, name:str, help:str, series:list):
+    lines += [f'# HELP {name} {help}', f'# TYPE {name} histogram']
+    for labels, histogram in series:
+        cumulative = 0
+        for bound, count in zip((*histogram.bounds, '+Inf'), histogram.counts):
+            cumulative += count
+            lines.append(f'{name}_bucket{format_labels({**labels, "le": bound})} {cumulative}')
+        lines.append(f'{name}_sum{format_labels(labels)} {histogram.sum}')
+        lines.append(f'{name}_count{format_labels(labels)} {histogram.count}')
+
+def format_labels (labels:dict) -> str :
+    if labels == {}:
+        return ''
+    return '{' + ','.join(f'{key}="{value}"' for key, value in labels.items()) + '}'
+
+metrics = Metrics()
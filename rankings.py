@@ -0,0 +1,107 @@
+from bisect import bisect_left, insort
+from itertools import islice
+from tags import normalize
+
+class Rankings:
+    ''' Running completion counts and rating sums per book, with books kept sorted by popularity and by average rating, overall and per tag '''
+
+    def __init__ (self):
+        self.completions:dict = {}
+        self.rating_sums:dict = {}
+        self.rating_counts:dict = {}
+        # isbn -> normalized tags the book is ranked under
+        self.book_tags:dict = {}
+        # tag (None for every book) -> sorted list of (-completions, isbn)
+        self.popular:dict = {None: []}
+        # tag (None for every book) -> sorted list of (-average rating, isbn), unrated books left out
+        self.favorite:dict = {None: []}
+
+    def scopes (self, isbn:str):
+        return [None, *self.book_tags.get(isbn, ())]
+
+    def average (self, isbn:str) -> float | None :
+        if self.rating_counts.get(isbn, 0) == 0:
+            return None
+        return self.rating_sums[isbn] / self.rating_counts[isbn]
+
+    def popular_key (self, isbn:str):
+        return (-self.completions[isbn], isbn)
+
+    def favorite_key (self, isbn:str):
+        average = self.average(isbn)
+        return None if average == None else (-average, isbn)
+
+    def unrank (self, isbn:str):
+        popular_key, favorite_key = self.popular_key(isbn), self.favorite_key(isbn)
+        for scope in self.scopes(isbn):
+            remove(self.popular[scope], popular_key)
+            if favorite_key != None:
+                remove(self.favorite[scope], favorite_key)
+
+    def rank (self, isbn:str):
+        popular_key, favorite_key = self.popular_key(isbn), self.favorite_key(isbn)
+        for scope in self.scopes(isbn):
+            insort(self.popular.setdefault(scope, []), popular_key)
+            if favorite_key != None:
+                insort(self.favorite.setdefault(scope, []), favorite_key)
+
+    def set_book (self, isbn:str, book:dict):
+        ''' (Re)ranks a whole book from its db.json dict '''
+        if isbn in self.completions:
+            self.unrank(isbn)
+
+        self.track(isbn, book["tags"], len(book["completions"]), sum(book["ratings"].values()), len(book["ratings"]))
+        self.rank(isbn)
+
+    def track (self, isbn:str, tags, completions:int, rating_sum:int, rating_count:int):
+        self.completions[isbn] = completions
+        self.rating_sums[isbn] = rating_sum
+        self.rating_counts[isbn] = rating_count
+        self.book_tags[isbn] = {normalize(tag) for tag in tags if tag.strip() != ''}
+
+    def add_many (self, rows):
+        '''
+        Ranks (isbn, tags, completions, rating sum, rating count) rows of books that aren't ranked yet in one go, when loading or importing,
+        sorting each list they went in once instead of inserting into it
+        '''
+        touched:set = set()
+        for row in rows:
+            isbn = row[0]
+            self.track(*row)
+            popular_key, favorite_key = self.popular_key(isbn), self.favorite_key(isbn)
+            for scope in self.scopes(isbn):
+                self.popular.setdefault(scope, []).append(popular_key)
+                touched.add(('popular', scope))
+                if favorite_key != None:
+                    self.favorite.setdefault(scope, []).append(favorite_key)
+                    touched.add(('favorite', scope))
+
+        for kind, scope in touched:
+            (self.popular if kind == 'popular' else self.favorite)[scope].sort()
+
+    def complete (self, isbn:str):
+        self.unrank(isbn)
+        self.completions[isbn] += 1
+        self.rank(isbn)
+
+    def rate (self, isbn:str, old_rating:int | None, rating:int):
+        self.unrank(isbn)
+        if old_rating != None:
+            self.rating_sums[isbn] -= old_rating
+            self.rating_counts[isbn] -= 1
+        self.rating_sums[isbn] += rating
+        self.rating_counts[isbn] += 1
+        self.rank(isbn)
+
+    def most_popular (self, count:int, tag:str | None = None) -> list :
+        ''' Up to count isbns with the most completions, optionally only ones with tag '''
+        ranking = self.popular.get(None if tag == None else normalize(tag), [])
+        return [isbn for _, isbn in islice(ranking, count)]
+
+    def favorites (self, count:int, tag:str | None = None) -> list :
+        ''' Up to count isbns with the highest average rating, optionally only ones with tag '''
+        ranking = self.favorite.get(None if tag == None else normalize(tag), [])
+        return [isbn for _, isbn in islice(ranking, count)]
+
+def remove (ranking:list, key):
+    del ranking[bisect_left(ranking, key)]
\ No newline at end of file
@@ -0,0 +1,65 @@
+import heapq
+
+class ReaderIndex:
+    ''' What every user has finished and rated, kept up to date alongside the books so a profile never scans the library '''
+
+    def __init__ (self):
+        # user id -> isbn -> when they finished it (0 from before timestamps), in the order they were indexed
+        self.completed:dict = {}
+        # user id -> isbn -> rating
+        self.ratings:dict = {}
+        self.rating_sums:dict = {}
+
+    def complete (self, user:int, isbn:str, at:int = 0):
+        finished = self.completed.setdefault(user, {})
+        # Finishing again (like a replayed journal record) doesn't move the book to the front
+        if isbn not in finished:
+            finished[isbn] = at
+
+    def rate (self, user:int, isbn:str, rating:int):
+        rated = self.ratings.setdefault(user, {})
+        self.rating_sums[user] = self.rating_sums.get(user, 0) - rated.get(isbn, 0) + rating
+        rated[isbn] = rating
+
+    def add_book (self, isbn:str, completions, ratings):
+        ''' Indexes a book's completions ((user id, when they finished it) pairs) and ratings ((user id, rating) pairs) '''
+        for user, at in completions:
+            self.complete(int(user), isbn, int(at))
+        for user, rating in ratings:
+            self.rate(int(user), isbn, int(rating))
+
+    def replace_book (self, isbn:str, old_completions, old_ratings, completions, ratings):
+        ''' Reindexes a book that was replaced as a whole, leaving anyone who'd already finished it where they were in their reads '''
+        completions = [(int(user), int(at)) for user, at in completions]
+        finished = {user for user, _ in completions}
+        ratings = [(int(user), int(rating)) for user, rating in ratings]
+        rated = {user for user, _ in ratings}
+        for user in old_completions:
+            if int(user) not in finished:
+                self.completed.get(int(user), {}).pop(isbn, None)
+        for user, rating in old_ratings:
+            if int(user) not in rated:
+                self.ratings[int(user)].pop(isbn)
+                self.rating_sums[int(user)] -= int(rating)
+        self.add_book(isbn, completions, ratings)
+
+    def completion_count (self, user:int) -> int :
+        return len(self.completed.get(user, ()))
+
+    def rating_count (self, user:int) -> int :
+        return len(self.ratings.get(user, ()))
+
+    def average (self, user:int) -> float | None :
+        ''' Mean rating the user has given, None if they haven't rated anything '''
+        if self.rating_count(user) == 0:
+            return None
+        return self.rating_sums[user] / self.rating_count(user)
+
+    def rating (self, user:int, isbn:str) -> int | None :
+        return self.ratings.get(user, {}).get(isbn)
+
+    def recent (self, user:int, start:int = 0, count:int = 10) -> list :
+        ''' isbns the user finished, newest first, skipping the first start '''
+        finished = self.completed.get(user, {})
+        # Going through them backwards breaks ties (like finishes from before timestamps) by which was indexed last
+        return heapq.nlargest(start + count, reversed(finished), key=finished.get)[start:]
@@ -0,0 +1,241 @@
+import asyncio
+import heapq
+import math
+from array import array
+import offload
+try:
+    import numpy
+    from scipy import sparse
+except ImportError:
+    # Similarities are built in plain Python without numpy and scipy, fine for libraries with a few thousand ratings
+    numpy = None
+    sparse = None
+
+# Most similar books kept per book
+NEIGHBORS = 50
+# Books whose similarities are worked out per sparse matrix product when building with scipy
+BLOCK = 2048
+# Ratings above the middle of the 1-10 scale count towards a book's neighbors, ratings below count against them
+MIDDLE = 5.5
+
+class Similarity:
+    ''' Each book's most similar books by adjusted cosine over everyone's ratings, as parallel arrays of book numbers and similarities '''
+
+    def __init__ (self, items:list, norms:array, neighbors:list):
+        self.items = items
+        self.index = {isbn: i for i, isbn in enumerate(items)}
+        # Length of each book's rating vector, for working out similarities to books refreshed later
+        self.norms = norms
+        # book number -> (array of neighbor book numbers, array of similarities)
+        self.neighbors = neighbors
+
+    def __getstate__ (self):
+        # Flattened so handing it back from a worker unpickles a few big buffers instead of two arrays per book
+        return {
+            'items': self.items,
+            'norms': self.norms,
+            'lengths': array('i', [len(books) for books, _ in self.neighbors]),
+            'books': array('i', [book for books, _ in self.neighbors for book in books]),
+            'similarities': array('f', [similarity for _, similarities in self.neighbors for similarity in similarities]),
+        }
+
+    def __setstate__ (self, state:dict):
+        self.items = state['items']
+        self.index = {isbn: i for i, isbn in enumerate(self.items)}
+        self.norms = state['norms']
+        self.neighbors = []
+        start = 0
+        for length in state['lengths']:
+            self.neighbors.append((state['books'][start:start + length], state['similarities'][start:start + length]))
+            start += length
+
+    def norm (self, isbn:str) -> float :
+        return self.norms[self.index[isbn]] if isbn in self.index else 0.0
+
+    def number (self, isbn:str) -> int :
+        ''' The isbn's book number, giving it one if it's new '''
+        if isbn not in self.index:
+            self.index[isbn] = len(self.items)
+            self.items.append(isbn)
+            self.norms.append(0.0)
+            self.neighbors.append((array('i'), array('f')))
+        return self.index[isbn]
+
+    def set_neighbor (self, i:int, j:int, similarity:float):
+        ''' Puts j in i's neighbors at this similarity if it's close enough to make the cut, replacing where it was before '''
+        books, similarities = self.neighbors[i]
+        if j in books:
+            position = books.index(j)
+            del books[position]
+            del similarities[position]
+        if similarity <= 0:
+            return
+        if len(books) >= NEIGHBORS:
+            weakest = min(range(len(similarities)), key=similarities.__getitem__)
+            if similarities[weakest] >= similarity:
+                return
+            del books[weakest]
+            del similarities[weakest]
+        books.append(j)
+        similarities.append(similarity)
+
+    def apply (self, rows:dict):
+        ''' Swaps in rows from refresh_rows, and updates the other side of every pair in them '''
+        for isbn, (norm, row) in rows.items():
+            i = self.number(isbn)
+            self.norms[i] = norm
+            top = heapq.nlargest(NEIGHBORS, row, key=lambda pair: pair[1])
+            self.neighbors[i] = (array('i', [self.number(other) for other, _ in top]), array('f', [similarity for _, similarity in top]))
+            for other, similarity in row:
+                self.set_neighbor(self.number(other), i, similarity)
+
+def centered (ratings:dict) -> dict :
+    ''' A user's ratings minus their own average, so generous and harsh raters compare fairly '''
+    mean = sum(ratings.values()) / len(ratings)
+    return {isbn: rating - mean for isbn, rating in ratings.items()}
+
+def build (ratings:dict) -> Similarity :
+    ''' Builds every book's neighbors from user id -> isbn -> rating. Slow for big libraries, so run it in an executor '''
+    items:list = []
+    index:dict = {}
+    users, books, values = array('i'), array('i'), array('f')
+    for user, (_, rated) in enumerate(ratings.items()):
+        if len(rated) == 0:
+            continue
+        for isbn, rating in centered(rated).items():
+            if isbn not in index:
+                index[isbn] = len(items)
+                items.append(isbn)
+            users.append(user)
+            books.append(index[isbn])
+            values.append(rating)
+
+    if sparse == None:
+        return build_python(items, users, books, values)
+
+    matrix = sparse.csr_matrix((numpy.frombuffer(values, dtype=numpy.float32), (numpy.frombuffer(users, dtype=numpy.int32), numpy.frombuffer(books, dtype=numpy.int32))), shape=(len(ratings), len(items)))
+    norms = numpy.sqrt(numpy.asarray(matrix.multiply(matrix).sum(axis=0)).ravel()).astype(numpy.float32)
+    normalized = (matrix @ sparse.diags(1 / numpy.where(norms == 0, 1, norms))).tocsr()
+    transposed = normalized.T.tocsr()
+
+    neighbors = []
+    # A block of books against every book at a time keeps the similarity matrix from ever being held whole
+    for start in range(0, len(items), BLOCK):
+        block = (transposed[start:start + BLOCK] @ normalized).tocsr()
+        for row in range(block.shape[0]):
+            low, high = block.indptr[row], block.indptr[row + 1]
+            others, similarities = block.indices[low:high], block.data[low:high]
+            keep = (others != start + row) & (similarities > 0)
+            others, similarities = others[keep], similarities[keep]
+            if len(others) > NEIGHBORS:
+                top = numpy.argpartition(-similarities, NEIGHBORS)[:NEIGHBORS]
+                others, similarities = others[top], similarities[top]
+            neighbors.append((array('i', others.astype(numpy.int32).tobytes()), array('f', similarities.astype(numpy.float32).tobytes())))
+    return Similarity(items, array('f', norms.tobytes()), neighbors)
+
+def build_python (items:list, users:array, books:array, values:array) -> Similarity :
+    book_raters:list = [[] for _ in items]
+    user_books:dict = {}
+    for user, book, value in zip(users, books, values):
+        book_raters[book].append((user, value))
+        user_books.setdefault(user, []).append((book, value))
+    norms = array('f', [math.sqrt(sum(value * value for _, value in raters)) for raters in book_raters])
+
+    neighbors = []
+    for i, raters in enumerate(book_raters):
+        dots:dict = {}
+        for user, value in raters:
+            for j, other in user_books[user]:
+                dots[j] = dots.get(j, 0.0) + value * other
+        row = ((j, dot / (norms[i] * norms[j])) for j, dot in dots.items() if j != i and dot > 0)
+        top = heapq.nlargest(NEIGHBORS, row, key=lambda pair: pair[1])
+        neighbors.append((array('i', [j for j, _ in top]), array('f', [similarity for _, similarity in top])))
+    return Similarity(items, norms, neighbors)
+
+def refresh_rows (raters:dict, norms:dict) -> dict :
+    '''
+    Works out fresh similarities for a few books from isbn -> list of the ratings dicts of everyone who rated it,
+    and isbn -> norm for books that aren't being refreshed. Returns isbn -> (norm, [(other isbn, similarity)])
+    '''
+    own:dict = {}
+    fresh_norms:dict = {}
+    for isbn, rated in raters.items():
+        own[isbn] = [(ratings, centered(ratings)) for ratings in rated]
+        fresh_norms[isbn] = math.sqrt(sum(user[isbn] ** 2 for _, user in own[isbn]))
+
+    rows = {}
+    for isbn, rated in own.items():
+        dots:dict = {}
+        for _, user in rated:
+            for other, value in user.items():
+                dots[other] = dots.get(other, 0.0) + user[isbn] * value
+        row = []
+        for other, dot in dots.items():
+            norm = fresh_norms[other] if other in fresh_norms else norms.get(other, 0.0)
+            if other != isbn and dot > 0 and norm != 0:
+                row.append((other, dot / (fresh_norms[isbn] * norm)))
+        rows[isbn] = (fresh_norms[isbn], row)
+    return rows
+
+class Recommender:
+    ''' Item-item collaborative filtering over a library's ratings, built the first time it's asked for and patched as ratings come in '''
+
+    def __init__ (self):
+        self.similarity = None
+        # isbns rated since their neighbors were last worked out
+        self.dirty:set = set()
+        self.lock = asyncio.Lock()
+        self.stats = {'builds': 0, 'build_time': 0.0, 'refreshes': 0}
+
+    def rated (self, isbn:str):
+        self.dirty.add(isbn)
+
+    async def ready (self, library):
+        ''' Builds the similarities, or refreshes the books rated since, off the event loop '''
+        loop = asyncio.get_running_loop()
+        async with self.lock:
+            if self.similarity == None:
+                started = loop.time()
+                if offload.heavy(library):
+                    # The worker builds from what's on disk, so write everything out first. Books rated during the build stay dirty
+                    await library.aflush()
+                    self.dirty.clear()
+                    self.similarity = await offload.run(library, offload.build_similarity)
+                else:
+                    self.dirty.clear()
+                    # Copied on the loop so ratings coming in during the build can't change it underneath
+                    ratings = {user: dict(rated) for user, rated in library.readers.ratings.items()}
+                    self.similarity = await loop.run_in_executor(None, build, ratings)
+                self.stats['builds'] += 1
+                self.stats['build_time'] += loop.time() - started
+            if self.dirty != set():
+                dirty, self.dirty = self.dirty, set()
+                readers = library.readers.ratings
+                raters = {isbn: [dict(readers[user]) for user, _ in library.raters(isbn)] for isbn in dirty}
+                norms = {other: self.similarity.norm(other) for rated in raters.values() for ratings in rated for other in ratings}
+                self.similarity.apply(await loop.run_in_executor(None, refresh_rows, raters, norms))
+                self.stats['refreshes'] += 1
+
+    def recommend (self, ratings:dict, read, count:int, allowed=None) -> list :
+        '''
+        Up to count isbns a user hasn't read (read is anything supporting in) from their isbn -> rating, best first.
+        allowed, if given, is called with each candidate isbn to filter them.
+        '''
+        if self.similarity == None:
+            return []
+        similarity = self.similarity
+        scores:dict = {}
+        for isbn, rating in ratings.items():
+            if isbn not in similarity.index:
+                continue
+            weight = rating - MIDDLE
+            for other, value in zip(*similarity.neighbors[similarity.index[isbn]]):
+                scores[other] = scores.get(other, 0.0) + value * weight
+
+        candidates = (
+            (score, similarity.items[other]) for other, score in scores.items()
+            if score > 0 and similarity.items[other] not in read and similarity.items[other] not in ratings
+        )
+        if allowed != None:
+            candidates = ((score, isbn) for score, isbn in candidates if allowed(isbn))
+        return [isbn for _, isbn in heapq.nlargest(count, candidates)]
@@ -0,0 +1,40 @@
+import time
+from collections import OrderedDict
+
+class RenderCache:
+    ''' Keeps rendered embeds around until the data behind them changes, least recently used ones are dropped past size '''
+
+    def __init__ (self, size:int = 1024):
+        self.size = size
+        # key -> (version, embed)
+        self.entries:OrderedDict = OrderedDict()
+        self.stats = {'hits': 0, 'misses': 0, 'render_time': 0.0}
+
+    def get (self, key, version, render):
+        ''' The cached embed for key if it was rendered at this version, otherwise calls render() and caches that '''
+        entry = self.entries.get(key)
+        if entry != None and entry[0] == version:
+            self.stats['hits'] += 1
+            self.entries.move_to_end(key)
+            return entry[1]
+
+        self.stats['misses'] += 1
+        started = time.perf_counter()
+        embed = render()
+        self.stats['render_time'] += time.perf_counter() - started
+
+        self.entries[key] = (version, embed)
+        self.entries.move_to_end(key)
+        if len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+        return embed
+
+    def hit_rate (self) -> float :
+        lookups = self.stats['hits'] + self.stats['misses']
+        return self.stats['hits'] / lookups if lookups != 0 else 0.0
+
+    def time_saved (self) -> float :
+        ''' Estimated seconds of rendering skipped thanks to hits '''
+        if self.stats['misses'] == 0:
+            return 0.0
+        return self.stats['hits'] * self.stats['render_time'] / self.stats['misses']
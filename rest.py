@@ -0,0 +1,47 @@
+import contextvars
+import time
+import aiohttp
+from yarl import URL
+from perf import metrics
+
+# Name of the command whose REST requests are being made, set for as long as each command runs
+command = contextvars.ContextVar('command', default=None)
+# Requests kept back in a bucket for replies. Optional messages, like the placeholder for slow commands, are skipped once it's this low
+RESERVE = 2
+# Buckets remembered before refilled ones are forgotten
+MAX_LIMITS = 1024
+
+# (method, url path) -> (requests left, time.monotonic() when the bucket refills), from the rate limit headers of its last response
+limits:dict = {}
+
+def spare (method:str, url:str) -> int | None :
+    ''' Requests left in the bucket of a route before Discord starts answering with 429s, None if it isn't known to be limited '''
+    remaining, resets = limits.get((method, URL(url).path), (None, 0.0))
+    if time.monotonic() >= resets:
+        return None
+    return remaining
+
+def has_spare (method:str, url:str) -> bool :
+    left = spare(method, url)
+    return left == None or left > RESERVE
+
+async def on_request_start (session, context, params):
+    metrics.observe_rest(command.get())
+
+async def on_request_end (session, context, params):
+    headers = params.response.headers
+    if 'X-RateLimit-Remaining' in headers:
+        if len(limits) >= MAX_LIMITS:
+            now = time.monotonic()
+            for key in [key for key, (_, resets) in limits.items() if resets <= now]:
+                del limits[key]
+        limits[(params.method, params.url.path)] = (int(headers['X-RateLimit-Remaining']), time.monotonic() + float(headers.get('X-RateLimit-Reset-After', 0)))
+    if params.response.status == 429:
+        metrics.observe_rate_limit(command.get())
+
+def trace () -> aiohttp.TraceConfig :
+    ''' Hooks for the bot's HTTP session counting every REST request (retries included) against the command making it '''
+    config = aiohttp.TraceConfig()
+    config.on_request_start.append(on_request_start)
+    config.on_request_end.append(on_request_end)
+    return config
@@ -0,0 +1,125 @@
+import asyncio
+from bisect import bisect_left, bisect_right, insort
+from titles import normalize
+
+# Orders books can be browsed in. Title and author can also be searched by prefix
+ORDERS = ('title', 'author', 'rating', 'completions')
+# Left off the front of titles when shelving them, so "The Love Hypothesis" sits under L
+ARTICLES = ('the ', 'a ', 'an ')
+# Sorts after any character a title or author can have, for finding the end of a run of keys starting with a prefix
+LAST = '\U0010ffff'
+
+def title_key (title:str) -> str :
+    key = normalize(title)
+    for article in ARTICLES:
+        if key.startswith(article) and len(key) > len(article):
+            return key[len(article):]
+    return key
+
+def author_key (author:str) -> str :
+    return normalize(author)
+
+def build (rows) -> tuple :
+    ''' isbn -> keys plus both shelves from (isbn, title, author) rows, sorting each once. Safe to run in an executor '''
+    keys = {isbn: (title_key(title), author_key(author)) for isbn, title, author in rows}
+    by_title = sorted((title, isbn) for isbn, (title, _) in keys.items())
+    by_author = sorted((author, title, isbn) for isbn, (title, author) in keys.items())
+    return keys, by_title, by_author
+
+class Shelves:
+    '''
+    Every book kept sorted by title and by author for browsing a page at a time.
+    Built the first time someone browses, so loading a library doesn't pay for it, and kept up to date a book at a time after that
+    '''
+
+    def __init__ (self):
+        # isbn -> (title key, author key)
+        self.keys:dict = {}
+        # Sorted (title key, isbn), None until built
+        self.by_title = None
+        # Sorted (author key, title key, isbn), None until built
+        self.by_author = None
+        # isbn -> (title, author) for books added while building, put on the shelves once it's done
+        self.changed = None
+        self.lock = asyncio.Lock()
+        # The build warm started, kept so it isn't garbage collected partway through
+        self.task = None
+
+    def add (self, isbn:str, title:str, author:str):
+        ''' Shelves a book, moving it if it was already shelved under a different title or author '''
+        if self.by_title == None:
+            if self.changed != None:
+                self.changed[isbn] = (title, author)
+            return
+
+        keys = (title_key(title), author_key(author))
+        if isbn in self.keys:
+            if self.keys[isbn] == keys:
+                return
+            self.remove(isbn)
+        self.keys[isbn] = keys
+        insort(self.by_title, (keys[0], isbn))
+        insort(self.by_author, (keys[1], keys[0], isbn))
+
+    def add_many (self, rows):
+        ''' add() for lots of (isbn, title, author) rows at once, sorting each shelf once instead of inserting a book at a time '''
+        if self.by_title == None:
+            if self.changed != None:
+                self.changed.update((isbn, (title, author)) for isbn, title, author in rows)
+            return
+
+        keys:dict = {}
+        for isbn, title, author in rows:
+            if isbn in self.keys:
+                self.add(isbn, title, author)
+            else:
+                keys[isbn] = (title_key(title), author_key(author))
+        self.keys.update(keys)
+        # Sorting a sorted list with a run added on the end is close to a merge
+        self.by_title += [(title, isbn) for isbn, (title, _) in keys.items()]
+        self.by_title.sort()
+        self.by_author += [(author, title, isbn) for isbn, (title, author) in keys.items()]
+        self.by_author.sort()
+
+    def remove (self, isbn:str):
+        title, author = self.keys.pop(isbn)
+        del self.by_title[bisect_left(self.by_title, (title, isbn))]
+        del self.by_author[bisect_left(self.by_author, (author, title, isbn))]
+
+    def warm (self, rows):
+        ''' Starts building the shelves in the background if nothing has yet, calling rows for them only if it does '''
+        if self.by_title == None and not self.lock.locked() and (self.task == None or self.task.done()):
+            # Books added before the task gets going still have to make it onto the shelves
+            self.changed = {}
+            self.task = asyncio.get_running_loop().create_task(self.ready(rows()))
+
+    async def ready (self, rows):
+        ''' Builds the shelves from (isbn, title, author) rows off the event loop if they haven't been yet. rows mustn't change meanwhile '''
+        async with self.lock:
+            if self.by_title != None:
+                return
+            if self.changed == None:
+                self.changed = {}
+            try:
+                self.keys, self.by_title, self.by_author = await asyncio.get_running_loop().run_in_executor(None, build, rows)
+            finally:
+                changed, self.changed = self.changed, None
+            self.add_many((isbn, title, author) for isbn, (title, author) in changed.items())
+
+def page (entries:list, count:int, after=None, before=None, prefix:str | None = None) -> tuple :
+    '''
+    Up to count entries of a sorted list of tuples, straight after the entry after or straight before the entry before
+    (from the start if neither), optionally only ones whose first item starts with prefix.
+    Returns (entries, how many matching entries come before them, how many match in total), costing a couple of binary searches plus the page
+    '''
+    low, high = 0, len(entries)
+    if prefix != None:
+        low, high = bisect_left(entries, (prefix,)), bisect_left(entries, (prefix + LAST,))
+
+    if before != None:
+        end = max(min(bisect_left(entries, tuple(before)), high), low)
+        start = max(end - count, low)
+    else:
+        start = low if after == None else min(max(bisect_right(entries, tuple(after)), low), high)
+        end = min(start + count, high)
+    return entries[start:end], start - low, high - low
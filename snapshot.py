@@ -0,0 +1,99 @@
+import marshal
+import mmap
+import os
+import struct
+import sys
+import zlib
+from array import array
+from book import Book, intern_tag, tag_names
+
+# Binary snapshot of a library, much faster to load than db.json:
+#   header: magic, format version, crc32 of the payload, payload length
+#   payload: marshalled columns, with each book's user ids and scores already sorted as raw array bytes
+MAGIC = b'LIBSNAP\0'
+VERSION = 1
+HEADER = struct.Struct('<8sHIQ')
+
+class SnapshotError(Exception):
+    pass
+
+def snapshot_path (path:str) -> str :
+    ''' Where the snapshot for the library at path (db.json, libraries/<id>.json) lives '''
+    return os.path.splitext(path)[0] + '.snap'
+
+def dumps (data:dict) -> bytes :
+    ''' A library in the db.json shape, with books as Books, as snapshot bytes '''
+    books = list(data["books"].values())
+    # Tags are renumbered so the snapshot doesn't depend on the order this process happened to intern them in
+    local_ids:dict = {}
+    for book in books:
+        for tag in book.tag_ids:
+            local_ids.setdefault(tag, len(local_ids))
+
+    payload = marshal.dumps({
+        'extra': {key: value for key, value in data.items() if key != 'books'},
+        'tags': [tag_names[tag] for tag in local_ids],
+        'isbns': [book.isbn for book in books],
+        'titles': [book.title for book in books],
+        'authors': [book.author for book in books],
+        'book_tags': [tuple(local_ids[tag] for tag in book.tag_ids) for book in books],
+        'completions': [book.completions.tobytes() for book in books],
+        'raters': [book.raters.tobytes() for book in books],
+        'scores': [book.scores.tobytes() for book in books],
+        'finished': [book.finished.tobytes() for book in books],
+    })
+    return HEADER.pack(MAGIC, VERSION, zlib.crc32(payload), len(payload)) + payload
+
+def loads (buffer) -> dict :
+    ''' Snapshot bytes (or anything bytes-like, like an mmap) back into the db.json shape with books as Books '''
+    if len(buffer) < HEADER.size:
+        raise SnapshotError('Snapshot is too short')
+    magic, version, checksum, length = HEADER.unpack_from(buffer)
+    if magic != MAGIC:
+        raise SnapshotError('Not a library snapshot')
+    if version != VERSION:
+        raise SnapshotError(f'Unsupported snapshot version {version}')
+
+    with memoryview(buffer)[HEADER.size:] as payload:
+        if len(payload) != length or zlib.crc32(payload) != checksum:
+            raise SnapshotError('Snapshot is corrupt')
+        columns = marshal.loads(payload)
+
+    tag_ids = [intern_tag(tag) for tag in columns['tags']]
+    # Snapshots from before finishes had timestamps don't have them, the bytes are the same length as the completions'
+    finished = columns.get('finished') or [bytes(len(completions)) for completions in columns['completions']]
+    books = {}
+    for isbn, title, author, book_tags, completions, raters, scores, times in zip(
+        columns['isbns'], columns['titles'], columns['authors'], columns['book_tags'],
+        columns['completions'], columns['raters'], columns['scores'], finished
+    ):
+        books[isbn] = Book(title, author, isbn, tuple(tag_ids[tag] for tag in book_tags), array('Q', completions), array('Q', raters), array('B', scores), array('Q', times))
+    return {**columns['extra'], 'books': books}
+
+def load (path:str) -> dict :
+    ''' Reads a snapshot through a memory map, so the payload is checksummed and unmarshalled without copying it first '''
+    with open(path, 'rb') as file:
+        if os.fstat(file.fileno()).st_size == 0:
+            raise SnapshotError('Snapshot is empty')
+        with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            return loads(mapped)
+
+def save (data:dict, path:str) -> int :
+    ''' Writes a snapshot next to the real one and swaps it in so a crash never leaves a half-written file, returning its size '''
+    snapshot = dumps(data)
+    with open(path + '.tmp', 'wb') as file:
+        file.write(snapshot)
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(path + '.tmp', path)
+    return len(snapshot)
+
+if __name__ == '__main__':
+    # python snapshot.py libraries/<server id>.json out.json
+    # Exports a library (snapshot plus journal) as db.json for editing or moving to another install
+    import json
+    import db
+    library = db.JsonLibrary(sys.argv[1])
+    with open(sys.argv[2], 'w') as out:
+        json.dump({**library.data, 'books': library.books}, out, indent=4, default=Book.to_dict)
+    print(f'Exported {len(library.books)} books from {sys.argv[1]} to {sys.argv[2]}')
@@ -0,0 +1,314 @@
+import sqlite3
+import sys
+import time
+from collections.abc import Mapping
+from contextlib import contextmanager
+from itertools import groupby
+import db
+from activity import DAY, kept_from, today
+from book import Book, finishes
+from db import Library, SQLITE_PATH
+from perf import metrics
+
+# Changes kept for replicas catching up, ones further behind load the library again
+CHANGES_KEPT = 10000
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS books (
+    isbn TEXT PRIMARY KEY,
+    title TEXT NOT NULL,
+    author TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS tags (
+    isbn TEXT NOT NULL REFERENCES books(isbn) ON DELETE CASCADE,
+    position INTEGER NOT NULL,
+    tag TEXT NOT NULL,
+    PRIMARY KEY (isbn, position)
+);
+CREATE TABLE IF NOT EXISTS completions (
+    isbn TEXT NOT NULL REFERENCES books(isbn) ON DELETE CASCADE,
+    user_id INTEGER NOT NULL,
+    -- When it was finished, 0 from before timestamps
+    at INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (isbn, user_id)
+);
+CREATE TABLE IF NOT EXISTS ratings (
+    isbn TEXT NOT NULL REFERENCES books(isbn) ON DELETE CASCADE,
+    user_id INTEGER NOT NULL,
+    rating INTEGER NOT NULL,
+    PRIMARY KEY (isbn, user_id)
+);
+-- When books were finished and rated, for lib!trending. Only kept as long as Activity keeps its buckets
+CREATE TABLE IF NOT EXISTS activity (
+    at INTEGER NOT NULL,
+    isbn TEXT NOT NULL REFERENCES books(isbn) ON DELETE CASCADE
+);
+-- Every change in the order it was made (update, complete or rate), so read-only replicas can bring their indexes up to date
+-- without loading the whole library again. Only the last CHANGES_KEPT are kept
+CREATE TABLE IF NOT EXISTS changes (
+    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+    op TEXT NOT NULL,
+    isbn TEXT NOT NULL,
+    user_id INTEGER,
+    rating INTEGER
+);
+CREATE INDEX IF NOT EXISTS books_title ON books(title);
+CREATE INDEX IF NOT EXISTS tags_tag ON tags(tag);
+CREATE INDEX IF NOT EXISTS completions_user ON completions(user_id);
+CREATE INDEX IF NOT EXISTS ratings_user ON ratings(user_id);
+CREATE INDEX IF NOT EXISTS activity_at ON activity(at);
+'''
+
+class BookTable (Mapping):
+    ''' Read-only dict-like view of the books table that builds each Book on access '''
+
+    def __init__ (self, connection:sqlite3.Connection):
+        self.connection = connection
+
+    def __getitem__ (self, isbn):
+        row = self.connection.execute('SELECT title, author FROM books WHERE isbn = ?', (isbn,)).fetchone()
+        if row == None:
+            raise KeyError(isbn)
+
+        return Book.from_dict({
+            'title': row[0],
+            'author': row[1],
+            'isbn': isbn,
+            'tags': [tag for (tag,) in self.connection.execute('SELECT tag FROM tags WHERE isbn = ? ORDER BY position', (isbn,))],
+            # Ratings are keyed by stringified user ids in db.json
+            'ratings': {str(user): rating for user, rating in self.connection.execute('SELECT user_id, rating FROM ratings WHERE isbn = ? ORDER BY rowid', (isbn,))},
+            'completions': [user for (user,) in self.connection.execute('SELECT user_id FROM completions WHERE isbn = ? ORDER BY rowid', (isbn,))],
+            'finished': {str(user): at for user, at in self.connection.execute('SELECT user_id, at FROM completions WHERE isbn = ? AND at != 0', (isbn,))},
+        })
+
+    def __contains__ (self, isbn):
+        return self.connection.execute('SELECT 1 FROM books WHERE isbn = ?', (isbn,)).fetchone() != None
+
+    def __iter__ (self):
+        return (isbn for (isbn,) in self.connection.execute('SELECT isbn FROM books ORDER BY rowid'))
+
+    def __len__ (self):
+        return self.connection.execute('SELECT COUNT(*) FROM books').fetchone()[0]
+
+class SqliteLibrary (Library):
+    ''' The library stored in SQLite, for installs too big to keep in memory. Same surface as db.JsonLibrary '''
+
+    BACKEND = 'sqlite'
+
+    def __init__ (self, path:str = SQLITE_PATH, truncate:bool = True):
+        ''' Read-only replicas pass truncate=False, leaving trimming old activity to the bot '''
+        super().__init__()
+        self.path = path
+        # Opened in the executor and used on the event loop after that, never from both at once
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        # WAL only needs to sync at checkpoints to stay consistent, so commits stay cheap on the event loop
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        self.connection.execute('PRAGMA foreign_keys=ON')
+        self.connection.executescript(SCHEMA)
+        if 'at' not in [column for _, column, *_ in self.connection.execute('PRAGMA table_info(completions)')]:
+            # Libraries from before finishes had timestamps
+            with self.connection:
+                self.connection.execute('ALTER TABLE completions ADD COLUMN at INTEGER NOT NULL DEFAULT 0')
+        if truncate:
+            with self.connection:
+                self.connection.execute('DELETE FROM activity WHERE at < ?', (kept_from(today()) * DAY,))
+        self.books = BookTable(self.connection)
+        # Read in one transaction, so the indexes match the changes log as of the last change in it
+        self.connection.execute('BEGIN')
+        self.titles.add_many(self.connection.execute('SELECT isbn, title FROM books'))
+        rows = self.connection.execute('SELECT books.isbn, tags.tag FROM books LEFT JOIN tags ON tags.isbn = books.isbn ORDER BY books.rowid, tags.position')
+        self.tags.add_many((isbn, [tag for _, tag in group if tag != None]) for isbn, group in groupby(rows, key=lambda row: row[0]))
+        self.rankings.add_many(
+            (isbn, self.tags.book_tags[isbn], completions, rating_sum, rating_count)
+            for isbn, completions, rating_sum, rating_count in self.connection.execute('''
+                SELECT isbn,
+                    (SELECT COUNT(*) FROM completions WHERE completions.isbn = books.isbn),
+                    (SELECT COALESCE(SUM(rating), 0) FROM ratings WHERE ratings.isbn = books.isbn),
+                    (SELECT COUNT(*) FROM ratings WHERE ratings.isbn = books.isbn)
+                FROM books
+            ''')
+        )
+        for isbn, user, at in self.connection.execute('SELECT isbn, user_id, at FROM completions ORDER BY rowid'):
+            self.readers.complete(user, isbn, at)
+        for isbn, user, rating in self.connection.execute('SELECT isbn, user_id, rating FROM ratings ORDER BY rowid'):
+            self.readers.rate(user, isbn, rating)
+        for at, isbn in self.connection.execute('SELECT at, isbn FROM activity ORDER BY at'):
+            self.activity.record(isbn, at)
+        # The last change the indexes include
+        self.changes_seen = self.connection.execute('SELECT COALESCE(MAX(seq), 0) FROM changes').fetchone()[0]
+        self.connection.commit()
+
+    @contextmanager
+    def transaction (self):
+        ''' Commits everything written inside it at the end, timing the whole thing as one db write '''
+        started = time.perf_counter()
+        with self.connection:
+            yield
+        metrics.observe_write(time.perf_counter() - started)
+
+    def log_change (self, op:str, isbn:str, user:int | None = None, rating:int | None = None):
+        ''' Adds a change to the log replicas catch up from, trimming it every CHANGES_KEPT changes. Doesn't commit '''
+        seq = self.connection.execute('INSERT INTO changes (op, isbn, user_id, rating) VALUES (?, ?, ?, ?)', (op, isbn, user, rating)).lastrowid
+        if seq % CHANGES_KEPT == 0:
+            self.connection.execute('DELETE FROM changes WHERE seq <= ?', (seq - CHANGES_KEPT,))
+        self.changes_seen = seq
+
+    def write_rows (self, book:dict):
+        ''' Upserts a whole book in the db.json shape without touching the indexes. Doesn't commit '''
+        isbn = book["isbn"]
+        self.connection.execute(
+            'INSERT INTO books (isbn, title, author) VALUES (?, ?, ?) ON CONFLICT(isbn) DO UPDATE SET title = excluded.title, author = excluded.author',
+            (isbn, book["title"], book["author"])
+        )
+        for table in ('tags', 'completions', 'ratings'):
+            self.connection.execute(f'DELETE FROM {table} WHERE isbn = ?', (isbn,))
+        self.connection.executemany('INSERT INTO tags (isbn, position, tag) VALUES (?, ?, ?)', [(isbn, position, tag) for position, tag in enumerate(book["tags"])])
+        self.connection.executemany('INSERT OR IGNORE INTO completions (isbn, user_id, at) VALUES (?, ?, ?)', [(isbn, user, at) for user, at in finishes(book)])
+        self.connection.executemany('INSERT INTO ratings (isbn, user_id, rating) VALUES (?, ?, ?)', [(isbn, int(user), int(rating)) for user, rating in book["ratings"].items()])
+        self.log_change('update', isbn)
+
+    def write_book (self, book:dict):
+        ''' Upserts a whole book in the db.json shape and indexes it. Doesn't commit '''
+        isbn = book["isbn"]
+        old = self.books[isbn] if isbn in self.books else None
+        self.write_rows(book)
+        self.titles.add(isbn, book["title"])
+        self.tags.add(isbn, book["tags"])
+        self.shelves.add(isbn, book["title"], book["author"])
+        self.rankings.set_book(isbn, book)
+        if old == None:
+            self.readers.add_book(isbn, finishes(book), book["ratings"].items())
+        else:
+            self.readers.replace_book(isbn, old.completions, zip(old.raters, old.scores), finishes(book), book["ratings"].items())
+        if book["ratings"] != {} or (old != None and len(old.raters) != 0):
+            self.recommender.rated(isbn)
+        self.touch(isbn)
+
+    def append_data (self, new_data:dict):
+        self.check_open()
+        new_books = []
+        if len(new_data) >= db.BULK_BOOKS:
+            # Big imports get their new books indexed in one go once they're written
+            new_books = [(isbn, book) for isbn, book in new_data.items() if isbn not in self.books]
+        added = {isbn for isbn, _ in new_books}
+        with self.transaction():
+            for isbn, book in new_data.items():
+                if isbn in added:
+                    self.write_rows(book)
+                else:
+                    self.write_book(book)
+        self.index_new(new_books)
+
+    def complete (self, isbn, id):
+        self.check_open()
+        at = int(time.time())
+        with self.transaction():
+            inserted = self.connection.execute('INSERT OR IGNORE INTO completions (isbn, user_id, at) VALUES (?, ?, ?)', (isbn, int(id), at)).rowcount
+            if inserted == 1:
+                self.connection.execute('INSERT INTO activity (at, isbn) VALUES (?, ?)', (at, isbn))
+                self.log_change('complete', isbn, int(id))
+        if inserted == 1:
+            self.activity.record(isbn, at)
+            self.rankings.complete(isbn)
+            self.readers.complete(int(id), isbn, at)
+            self.touch(isbn)
+
+    def rate (self, isbn, id, rating):
+        self.check_open()
+        old_rating = self.connection.execute('SELECT rating FROM ratings WHERE isbn = ? AND user_id = ?', (isbn, int(id))).fetchone()
+        at = int(time.time())
+        changed = old_rating == None or old_rating[0] != int(rating)
+        with self.transaction():
+            self.connection.execute(
+                'INSERT INTO ratings (isbn, user_id, rating) VALUES (?, ?, ?) ON CONFLICT(isbn, user_id) DO UPDATE SET rating = excluded.rating',
+                (isbn, int(id), int(rating))
+            )
+            if changed:
+                self.connection.execute('INSERT INTO activity (at, isbn) VALUES (?, ?)', (at, isbn))
+                self.log_change('rate', isbn, int(id), int(rating))
+        if changed:
+            self.activity.record(isbn, at)
+        self.rankings.rate(isbn, None if old_rating == None else old_rating[0], int(rating))
+        self.readers.rate(int(id), isbn, int(rating))
+        self.recommender.rated(isbn)
+        self.touch(isbn)
+
+    def shelf_rows (self):
+        return self.connection.execute('SELECT isbn, title, author FROM books').fetchall()
+
+    def raters (self, isbn:str):
+        return self.connection.execute('SELECT user_id, rating FROM ratings WHERE isbn = ?', (isbn,)).fetchall()
+
+    def changed_on_disk (self) -> bool :
+        ''' Whether changes this copy hasn't seen were already trimmed from the log, so catching up on it isn't enough '''
+        oldest = self.connection.execute('SELECT MIN(seq) FROM changes').fetchone()[0]
+        return oldest != None and oldest > self.changes_seen + 1
+
+    def catch_up (self):
+        '''
+        Brings the indexes up to date with the changes the bot made since this copy last looked. Used by read-only replicas.
+        Rows are always read live, so updated books are indexed again from how they are now and their other changes skipped
+        '''
+        with self.connection:
+            self.connection.execute('BEGIN')
+            changes = self.connection.execute('''
+                SELECT seq, op, changes.isbn, changes.user_id, rating, completions.at FROM changes
+                LEFT JOIN completions ON op = 'complete' AND completions.isbn = changes.isbn AND completions.user_id = changes.user_id
+                WHERE seq > ? ORDER BY seq
+            ''', (self.changes_seen,)).fetchall()
+            updated = {isbn for _, op, isbn, _, _, _ in changes if op == 'update'}
+            books = {isbn: self.books[isbn].to_dict() for isbn in updated if isbn in self.books}
+        for _, op, isbn, user, rating, at in changes:
+            if isbn in updated:
+                continue
+            if op == 'complete':
+                self.rankings.complete(isbn)
+                self.readers.complete(user, isbn, at)
+            elif op == 'rate':
+                self.rankings.rate(isbn, self.readers.rating(user, isbn), rating)
+                self.readers.rate(user, isbn, rating)
+                self.recommender.rated(isbn)
+            self.touch(isbn)
+        for isbn, book in books.items():
+            # Nothing takes finishes or ratings away, so indexing them again on top of the old ones is enough
+            self.titles.add(isbn, book["title"])
+            self.tags.add(isbn, book["tags"])
+            self.shelves.add(isbn, book["title"], book["author"])
+            self.rankings.set_book(isbn, book)
+            self.readers.add_book(isbn, finishes(book), book["ratings"].items())
+            self.recommender.rated(isbn)
+            self.touch(isbn)
+        if changes != []:
+            self.changes_seen = changes[-1][0]
+
+    def flush (self):
+        # Every write is committed as it happens
+        pass
+
+    def start_writer (self):
+        pass
+
+    def close (self):
+        self.closed = True
+        self.connection.close()
+
+def migrate (json_path:str = db.DB_PATH, sqlite_path:str = SQLITE_PATH):
+    ''' One-shot copy of a json library (snapshot plus journal) into a SQLite library '''
+    source = db.JsonLibrary(json_path)
+    target = SqliteLibrary(sqlite_path)
+
+    with target.connection:
+        for book in source.books.values():
+            target.write_book(book.to_dict())
+        # Only the buckets are kept, so events go in at the start of their day or week
+        for days, buckets in ((1, source.activity.days), (7, source.activity.weeks)):
+            for start, bucket in buckets.items():
+                target.connection.executemany('INSERT INTO activity (at, isbn) VALUES (?, ?)', [(start * days * DAY, isbn) for isbn, events in bucket.items() for _ in range(events)])
+
+    print(f'Migrated {len(target.books)} books from {json_path} to {sqlite_path}')
+    target.close()
+
+if __name__ == '__main__':
+    # python sqlite_db.py [db.json] [library.sqlite]
+    migrate(*sys.argv[1:3])
\ No newline at end of file
@@ -0,0 +1,341 @@
+import asyncio
+import hashlib
+import itertools
+import json
+import os
+import sys
+import uuid
+from collections import deque
+from dotenv import dotenv_values
+import db
+
+config = dotenv_values('.env')
+# Unix socket the storage service listens on. When set, bot processes send their writes there instead of writing libraries themselves
+STORAGE_SOCKET = config.get('STORAGE_SOCKET') or ''
+# Records kept per library for bot processes catching up, ones further behind reload the library from disk instead
+RECENT = 10000
+# Longest line either side reads, big enough for an import's worth of books in one record
+LINE_LIMIT = 64 * 1024 * 1024
+
+def encode (message:dict) -> bytes :
+    return json.dumps(message).encode() + b'\n'
+
+def touched (record:dict) -> list :
+    ''' isbns a journal record changes '''
+    return list(record["books"]) if record["op"] == 'update' else [record["isbn"]]
+
+def merge (library, record:dict) -> dict :
+    '''
+    An update record with the completions and ratings the library already has for its books kept, since it carries whole books
+    from a shard's copy that might not have another shard's finishes and ratings yet. Ratings already here win
+    '''
+    if record["op"] != 'update':
+        return record
+    books = {}
+    for isbn, book in record["books"].items():
+        if isbn in library.books:
+            current = library.books[isbn].to_dict()
+            book = {
+                **book,
+                'ratings': {**book["ratings"], **current["ratings"]},
+                'completions': sorted(set(current["completions"]) | set(int(user) for user in book["completions"])),
+                'finished': {**book.get("finished", {}), **current["finished"]},
+            }
+        books[isbn] = book
+    return {**record, 'books': books}
+
+def digest (library) -> str :
+    ''' Hash of every book in a library, for checking that copies of it agree '''
+    hashed = hashlib.sha256()
+    for isbn in sorted(library.books):
+        hashed.update(json.dumps(library.books[isbn].to_dict(), sort_keys=True).encode())
+    return hashed.hexdigest()
+
+class StorageService:
+    '''
+    Owns every library and is the only process writing them. Bot processes send it batches of records, it numbers and applies them,
+    and sends every record back out to each process subscribed to that library, in order.
+    '''
+
+    def __init__ (self, libraries:db.Libraries | None = None):
+        self.libraries = libraries if libraries != None else db.Libraries()
+        # guild id -> the last RECENT records written, for subscribers catching up
+        self.recent:dict = {}
+        # guild id -> writers of the connections subscribed to it
+        self.subscribers:dict = {}
+        self.stats = {'batches': 0, 'writes': 0, 'reloads': 0}
+        # Tasks writing out libraries before telling subscribers to reload them
+        self.reloading:set = set()
+
+    async def serve (self, path:str = STORAGE_SOCKET):
+        if os.path.exists(path):
+            os.remove(path)
+        server = await asyncio.start_unix_server(self.handle, path, limit=LINE_LIMIT)
+        print(f'Storage service listening on {path}')
+        async with server:
+            await server.serve_forever()
+
+    async def handle (self, reader:asyncio.StreamReader, writer:asyncio.StreamWriter):
+        try:
+            while line := await reader.readline():
+                self.process(json.loads(line), writer)
+                await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            for subscribers in self.subscribers.values():
+                subscribers.discard(writer)
+            writer.close()
+
+    def process (self, message:dict, writer:asyncio.StreamWriter):
+        ''' Runs a batch of requests in order, then acks it. Consecutive writes go out on the feed together '''
+        self.stats['batches'] += 1
+        written:dict = {}
+        for request in message["batch"]:
+            guild = request["guild"]
+            if request["op"] == 'write':
+                try:
+                    written.setdefault(guild, []).append(self.write(guild, request["record"]))
+                except (KeyError, ValueError) as err:
+                    writer.write(encode({'error': f'Bad record for {guild}: {err!r}'}))
+                continue
+
+            # Anything else has to see the writes before it on the feed first
+            self.broadcast(written)
+            written = {}
+            if request["op"] == 'subscribe':
+                self.subscribe(guild, request["since"], writer)
+            elif request["op"] == 'unsubscribe':
+                self.subscribers.get(guild, set()).discard(writer)
+            elif request["op"] == 'digest':
+                library = self.libraries.get(guild)
+                writer.write(encode({'digest': guild, 'seq': library.seq, 'value': digest(library)}))
+            else:
+                writer.write(encode({'error': f"Unknown storage op: {request['op']}"}))
+        self.broadcast(written)
+        writer.write(encode({'ack': message["id"]}))
+
+    def write (self, guild, record:dict) -> dict :
+        library = self.libraries.get(guild)
+        record = {**merge(library, record), 'seq': library.seq + 1}
+        library.apply(record)
+        library.write_record(record)
+        if guild not in self.recent:
+            self.recent[guild] = deque(maxlen=RECENT)
+        self.recent[guild].append(record)
+        self.stats['writes'] += 1
+        return record
+
+    def broadcast (self, written:dict):
+        for guild, records in written.items():
+            feed = encode({'feed': guild, 'records': records})
+            for subscriber in self.subscribers.get(guild, ()):
+                subscriber.write(feed)
+
+    def subscribe (self, guild, since:int, writer:asyncio.StreamWriter):
+        ''' Sends a subscriber everything after the last record its copy has, or tells it to reload if that's too far back '''
+        library = self.libraries.get(guild)
+        self.subscribers.setdefault(guild, set()).add(writer)
+        if since == library.seq:
+            return
+
+        recent = self.recent.get(guild, ())
+        if since < library.seq and len(recent) != 0 and recent[0]["seq"] <= since + 1:
+            writer.write(encode({'feed': guild, 'records': [record for record in recent if record["seq"] > since]}))
+            return
+
+        self.stats['reloads'] += 1
+        task = asyncio.get_running_loop().create_task(self.reload(library, guild, writer))
+        self.reloading.add(task)
+        task.add_done_callback(self.reloading.discard)
+
+    async def reload (self, library, guild, writer:asyncio.StreamWriter):
+        # Make sure the copy it reloads has everything so far, written in the executor so the service keeps going meanwhile
+        await library.aflush()
+        if not writer.is_closing():
+            writer.write(encode({'reload': guild}))
+
+class RemoteLibrary (db.JsonLibrary):
+    '''
+    A bot process's copy of a library the storage service owns. Reads are answered locally, changes are applied locally straight away
+    and sent to the service, and the feed brings in everyone else's changes in the order the service applied them.
+    '''
+
+    def __init__ (self, path:str, guild_id, client):
+        self.guild_id = guild_id
+        self.client = client
+        # isbn -> this process' changes to it that haven't come back on the feed yet
+        self.in_flight:dict = {}
+        # isbns someone else changed while this process had changes to them in flight
+        self.overtaken:set = set()
+        # The service owns the file and might be partway through appending to it
+        super().__init__(path, truncate=False)
+
+    def write_record (self, record:dict):
+        for isbn in touched(record):
+            self.in_flight[isbn] = self.in_flight.get(isbn, 0) + 1
+        self.client.request({'op': 'write', 'guild': self.guild_id, 'record': {**record, 'from': self.client.name}})
+
+    def receive (self, records:list):
+        for record in records:
+            if record["seq"] <= self.seq:
+                continue
+            if record["seq"] != self.seq + 1:
+                # Missed some, ask for them again
+                self.client.request({'op': 'subscribe', 'guild': self.guild_id, 'since': self.seq})
+                return
+
+            isbns = touched(record)
+            if record.get("from") != self.client.name:
+                self.apply(record)
+                self.overtaken.update(isbn for isbn in isbns if isbn in self.in_flight)
+                continue
+
+            # Already applied when it was made, but again if someone else's change landed on top of it here while the service applied it first
+            if any(isbn in self.overtaken for isbn in isbns):
+                self.apply(record)
+            else:
+                self.data["seq"] = record["seq"]
+            for isbn in isbns:
+                self.in_flight[isbn] -= 1
+                if self.in_flight[isbn] == 0:
+                    del self.in_flight[isbn]
+                    self.overtaken.discard(isbn)
+
+    def flush (self):
+        # The service does the writing
+        pass
+
+    def start_writer (self):
+        pass
+
+    def close (self):
+        self.closed = True
+        if self.client.libraries.get(self.guild_id) is self:
+            self.client.libraries.pop(self.guild_id)
+        if self.client.connected:
+            self.client.request({'op': 'unsubscribe', 'guild': self.guild_id})
+
+    async def aclose (self):
+        # Nothing's written here, so there's nothing to wait for
+        self.close()
+
+class StorageClient:
+    ''' A bot process' connection to the storage service. Requests made between two sends go out as one batch '''
+
+    def __init__ (self, reader:asyncio.StreamReader, writer:asyncio.StreamWriter):
+        self.reader = reader
+        self.writer = writer
+        # Marks the records this process sends, so it can tell them apart from everyone else's on the feed
+        self.name = uuid.uuid4().hex[:8]
+        # guild id -> RemoteLibrary subscribed to its feed
+        self.libraries:dict = {}
+        self.outbox:list = []
+        self.wakeup = asyncio.Event()
+        self.batch_ids = itertools.count()
+        # Futures resolved once the next batch sent is acked, and batch id -> the futures waiting on it
+        self.waiting:list = []
+        self.acks:dict = {}
+        # guild id -> futures waiting on a digest
+        self.digests:dict = {}
+        self.connected = True
+        loop = asyncio.get_running_loop()
+        self.tasks = [loop.create_task(self.sender()), loop.create_task(self.receiver())]
+
+    def open (self, guild_id, path:str) -> RemoteLibrary :
+        return self.subscribe(RemoteLibrary(path + '.json', guild_id, self))
+
+    async def load (self, guild_id, path:str) -> RemoteLibrary :
+        ''' open() with the library loaded in the executor. Feed records for it until it's subscribed are caught up on by the subscribe '''
+        return self.subscribe(await asyncio.get_running_loop().run_in_executor(None, RemoteLibrary, path + '.json', guild_id, self))
+
+    def subscribe (self, library:RemoteLibrary) -> RemoteLibrary :
+        self.libraries[library.guild_id] = library
+        self.request({'op': 'subscribe', 'guild': library.guild_id, 'since': library.seq})
+        return library
+
+    def request (self, request:dict):
+        if not self.connected:
+            raise ConnectionError('Not connected to the storage service')
+        self.outbox.append(request)
+        self.wakeup.set()
+
+    async def sync (self):
+        ''' Waits until the service has applied everything requested so far '''
+        future = asyncio.get_running_loop().create_future()
+        self.waiting.append(future)
+        self.wakeup.set()
+        await future
+
+    async def digest (self, guild_id) -> tuple :
+        ''' (seq, digest) of the service's copy of a library '''
+        future = asyncio.get_running_loop().create_future()
+        self.digests.setdefault(guild_id, []).append(future)
+        self.request({'op': 'digest', 'guild': guild_id})
+        return await future
+
+    async def sender (self):
+        while True:
+            await self.wakeup.wait()
+            self.wakeup.clear()
+            batch, self.outbox = self.outbox, []
+            if batch == [] and self.waiting == []:
+                continue
+            id = next(self.batch_ids)
+            self.acks[id], self.waiting = self.waiting, []
+            self.writer.write(encode({'id': id, 'batch': batch}))
+            await self.writer.drain()
+
+    async def receiver (self):
+        while line := await self.reader.readline():
+            message = json.loads(line)
+            if 'feed' in message:
+                if message["feed"] in self.libraries:
+                    self.libraries[message["feed"]].receive(message["records"])
+            elif 'ack' in message:
+                for future in self.acks.pop(message["ack"], []):
+                    future.set_result(None)
+            elif 'reload' in message:
+                if message["reload"] in self.libraries:
+                    # Libraries.load opens it again from disk next time it's used
+                    self.libraries.pop(message["reload"]).stale = True
+            elif 'digest' in message:
+                for future in self.digests.pop(message["digest"], []):
+                    future.set_result((message["seq"], message["value"]))
+            elif 'error' in message:
+                print(f'Storage service error: {message["error"]}')
+
+        print('Lost connection to the storage service')
+        self.connected = False
+        for futures in (*self.acks.values(), *self.digests.values(), self.waiting):
+            for future in futures:
+                future.set_exception(ConnectionError('Lost connection to the storage service'))
+
+    async def close (self):
+        await self.sync()
+        for task in self.tasks:
+            task.cancel()
+        self.writer.close()
+
+async def connect (path:str = STORAGE_SOCKET) -> StorageClient :
+    reader, writer = await asyncio.open_unix_connection(path, limit=LINE_LIMIT)
+    return StorageClient(reader, writer)
+
+def run_service (path:str = STORAGE_SOCKET, libraries_path:str = db.LIBRARIES_PATH):
+    if db.BACKEND != 'json':
+        # Copies are kept in sync by replaying journal records, which only the json engine has
+        raise ValueError('The storage service only works with BACKEND=json')
+    if path == '':
+        raise ValueError('Set STORAGE_SOCKET in .env or pass the socket path')
+    db.LIBRARIES_PATH = libraries_path
+    try:
+        asyncio.run(StorageService().serve(path))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        # Write anything the background writers hadn't gotten to yet
+        db.flush()
+
+if __name__ == '__main__':
+    # python storage.py [socket] [libraries folder]
+    run_service(*sys.argv[1:3])
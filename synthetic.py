@@ -0,0 +1,86 @@
+import itertools
+import json
+import random
+import sys
+from isbn import convert
+
+WORDS = ('the', 'of', 'night', 'house', 'girl', 'love', 'hypothesis', 'station', 'eleven', 'dune', 'queer', 'essays',
+         'kiss', 'now', 'silent', 'river', 'song', 'stars', 'empire', 'garden', 'last', 'city', 'winter', 'glass')
+
+def generate (books:int, tags_per_book:int = 3, users:int = 1000, ratings_density:float = 0.005, tag_count:int = 200, seed:int = 0) -> dict :
+    '''
+    A made-up library in the db.json schema for benchmarking.
+    Each book gets up to tags_per_book tags out of tag_count, and every user rates it with probability ratings_density.
+    Raters have all finished the book, plus a few people who finished it without rating it.
+    '''
+    rng = random.Random(seed)
+    tags = [f'tag {i}' for i in range(tag_count)]
+    user_ids = [10**17 + i for i in range(users)]
+    # Spread evenly around the density instead of drawing every user, so a million books doesn't take a billion draws
+    most_ratings = min(users, round(2 * users * ratings_density))
+
+    library = {}
+    for i in range(books):
+        isbn = convert(f'{i:09d}')
+        raters = rng.sample(user_ids, rng.randint(0, most_ratings))
+        readers = rng.sample(user_ids, rng.randint(0, most_ratings // 2 + 1))
+        library[isbn] = {
+            'title': ' '.join(rng.choice(WORDS) for _ in range(rng.randint(1, 4))).capitalize() + f' {i}',
+            'author': f'Author {rng.randrange(books // 10 + 1)}',
+            'isbn': isbn,
+            'tags': rng.sample(tags, rng.randint(1, min(tags_per_book, tag_count))),
+            'ratings': {str(user): rng.randint(1, 10) for user in raters},
+            'completions': sorted(set(raters) | set(readers)),
+        }
+    return {'books': library}
+
+def ratings (users:int, books:int, per_user:int = 20, seed:int = 0) -> dict :
+    '''
+    Made-up user id -> isbn -> rating for benchmarking recommendations without building a whole library.
+    Users rate per_user books on average, picked with a long tail so a few books are rated by lots of people like in a real library.
+    '''
+    rng = random.Random(seed)
+    isbns = [convert(f'{i:09d}') for i in range(books)]
+    popularity = list(itertools.accumulate(1 / (rank + 1) ** 0.8 for rank in range(books)))
+    return {10**17 + user: {isbn: rng.randint(1, 10) for isbn in rng.choices(isbns, cum_weights=popularity, k=rng.randint(1, 2 * per_user))} for user in range(users)}
+
+def catalog (editions:int, path:str, authors_path:str, seed:int = 0):
+    '''
+    A made-up Open Library style editions dump and its authors dump for benchmarking catalog lookups, written a line at a time.
+    Editions get about 1KB of description like real ones, and half of them have an ISBN-10 on top of the ISBN-13 in the other one's place
+    '''
+    rng = random.Random(seed)
+    authors = editions // 10 + 1
+    with open(authors_path, 'w') as dump:
+        for i in range(authors):
+            record = {'key': f'/authors/OL{i}A', 'name': f'Author {i}', 'type': {'key': '/type/author'}}
+            dump.write(f'/type/author\t/authors/OL{i}A\t1\t2024-01-01T00:00:00\t{json.dumps(record)}\n')
+    with open(path, 'w') as dump:
+        for i in range(editions):
+            isbn = convert(f'{i:09d}')
+            record = {
+                'key': f'/books/OL{i}M',
+                'title': ' '.join(rng.choice(WORDS) for _ in range(rng.randint(1, 4))).capitalize() + f' {i}',
+                'authors': [{'key': f'/authors/OL{rng.randrange(authors)}A'}],
+                'subjects': [f'Subject {rng.randrange(1000)}' for _ in range(rng.randint(0, 6))],
+                'number_of_pages': rng.randint(40, 900),
+                'description': ' '.join(rng.choice(WORDS) for _ in range(160)),
+                'type': {'key': '/type/edition'},
+            }
+            if i % 2 == 0:
+                check = sum(weight * int(digit) for weight, digit in enumerate(f'{i:09d}', 1)) % 11
+                record['isbn_10'] = [f'{i:09d}' + ('X' if check == 10 else str(check))]
+            else:
+                record['isbn_13'] = [isbn]
+            dump.write(f'/type/edition\t/books/OL{i}M\t1\t2024-01-01T00:00:00\t{json.dumps(record)}\n')
+
+def save (library:dict, path:str):
+    with open(path, 'w') as db:
+        json.dump(library, db)
+
+if __name__ == '__main__':
+    # python synthetic.py books out.json [tags per book] [users] [ratings density]
+    books, path = int(sys.argv[1]), sys.argv[2]
+    options = [int(sys.argv[3]) if len(sys.argv) > 3 else 3, int(sys.argv[4]) if len(sys.argv) > 4 else 1000, float(sys.argv[5]) if len(sys.argv) > 5 else 0.005]
+    save(generate(books, *options), path)
+    print(f'Wrote {books} books to {path}')
@@ -0,0 +1,174 @@
+import random
+import re
+from bisect import bisect_left, insort
+from functools import lru_cache
+
+KEYWORDS = ('AND', 'OR', 'NOT')
+TOKENS = re.compile(r'(\(|\)|\bAND\b|\bOR\b|\bNOT\b)')
+
+# Libraries reuse the same few tags over and over, so loading mostly hits this cache
+@lru_cache(maxsize=4096)
+def normalize (tag:str) -> str :
+    ''' Casefolds and collapses whitespace so " Misogyny" and "misogyny" are the same tag '''
+    return ' '.join(tag.casefold().split())
+
+def is_expression (query:str) -> bool :
+    ''' Whether a query has AND, OR or NOT in it. Brackets alone don't count, so older tags like "sci-fi (hard)" still match as a list '''
+    return any(token in KEYWORDS for token in TOKENS.findall(query))
+
+def bracketed (tags:list) -> list :
+    ''' Tags that couldn't be matched inside an expression, since brackets group its parts '''
+    return [tag for tag in tags if '(' in tag or ')' in tag]
+
+def nth_bit (mask:int, n:int) -> int :
+    ''' Position of the nth (from 0) set bit in mask, found by binary searching on popcounts '''
+    low, high = 0, mask.bit_length()
+    while high - low > 1:
+        middle = (low + high) // 2
+        count = ((mask >> low) & ((1 << (middle - low)) - 1)).bit_count()
+        if n < count:
+            high = middle
+        else:
+            n -= count
+            low = middle
+    return low
+
+class TagIndex:
+    ''' Inverted index from tag to the books that have it, stored as bitsets over dense book ordinals '''
+
+    def __init__ (self):
+        # isbn <-> ordinal, ordinals are never reused
+        self.ordinals:dict = {}
+        self.isbns:list = []
+        # normalized tag -> bitset of book ordinals
+        self.postings:dict = {}
+        # isbn -> normalized tags, so edits can be undone
+        self.book_tags:dict = {}
+        # Bitset of every book
+        self.everything = 0
+        # Every tag in use, sorted for prefix lookups
+        self.names:list = []
+
+    def add (self, isbn:str, tags:list):
+        ''' Indexes a book's tags, replacing whatever was indexed for that isbn before '''
+        if isbn not in self.ordinals:
+            self.ordinals[isbn] = len(self.isbns)
+            self.isbns.append(isbn)
+        bit = 1 << self.ordinals[isbn]
+        self.everything |= bit
+
+        new_tags = {normalize(tag) for tag in tags if tag.strip() != ''}
+        old_tags = self.book_tags.get(isbn, set())
+        for tag in old_tags - new_tags:
+            self.postings[tag] &= ~bit
+            if self.postings[tag] == 0:
+                del self.postings[tag]
+                del self.names[bisect_left(self.names, tag)]
+        for tag in new_tags - old_tags:
+            if tag not in self.postings:
+                insort(self.names, tag)
+            self.postings[tag] = self.postings.get(tag, 0) | bit
+        self.book_tags[isbn] = new_tags
+
+    def add_many (self, books):
+        ''' Indexes (isbn, tags) pairs in one go when loading, since growing big bitsets one bit at a time is quadratic '''
+        members:dict = {}
+        for isbn, tags in books:
+            if isbn not in self.ordinals:
+                self.ordinals[isbn] = len(self.isbns)
+                self.isbns.append(isbn)
+            self.book_tags[isbn] = {normalize(tag) for tag in tags if tag.strip() != ''}
+            for tag in self.book_tags[isbn]:
+                members.setdefault(tag, []).append(self.ordinals[isbn])
+
+        def bitset (ordinals):
+            bits = bytearray((len(self.isbns) + 7) // 8)
+            for ordinal in ordinals:
+                bits[ordinal >> 3] |= 1 << (ordinal & 7)
+            return int.from_bytes(bits, 'little')
+
+        self.everything = (1 << len(self.isbns)) - 1
+        for tag, ordinals in members.items():
+            self.postings[tag] = self.postings.get(tag, 0) | bitset(ordinals)
+        self.names = sorted(self.postings)
+
+    def starting_with (self, prefix:str, count:int) -> list :
+        ''' Up to count tags in use starting with prefix, alphabetically '''
+        prefix = normalize(prefix)
+        start = bisect_left(self.names, prefix)
+        return [tag for tag in self.names[start:start + count] if tag.startswith(prefix)]
+
+    def posting (self, tag:str) -> int :
+        return self.postings.get(normalize(tag), 0)
+
+    def match (self, tags:list, strict:bool = False) -> int :
+        ''' Bitset of books with all (strict) or any (loose) of the tags '''
+        if strict:
+            result = self.everything
+            for tag in tags:
+                result &= self.posting(tag)
+            return result
+
+        result = 0
+        for tag in tags:
+            result |= self.posting(tag)
+        return result
+
+    def query (self, expression:str) -> int :
+        ''' Bitset of books matching a boolean expression like "scifi AND (space OR robots) AND NOT romance" '''
+        tokens = [token.strip() for token in TOKENS.split(expression) if token.strip() != '']
+        position = 0
+
+        def peek ():
+            return tokens[position] if position < len(tokens) else None
+
+        def take ():
+            nonlocal position
+            position += 1
+            return tokens[position - 1]
+
+        def either ():
+            result = both()
+            while peek() == 'OR':
+                take()
+                result |= both()
+            return result
+
+        def both ():
+            result = negated()
+            while peek() == 'AND':
+                take()
+                result &= negated()
+            return result
+
+        def negated ():
+            token = peek()
+            if token == None:
+                raise ValueError('Expected a tag at the end of the expression')
+            take()
+            if token == 'NOT':
+                return self.everything & ~negated()
+            if token == '(':
+                result = either()
+                if peek() != ')':
+                    raise ValueError('Missing a closing bracket')
+                take()
+                return result
+            if token in KEYWORDS or token == ')':
+                raise ValueError(f'Expected a tag but found `{token}`')
+            return self.posting(token)
+
+        result = either()
+        if peek() != None:
+            raise ValueError(f'Unexpected `{peek()}` in expression')
+        return result
+
+    def count (self, bits:int) -> int :
+        return bits.bit_count()
+
+    def pick (self, bits:int) -> str | None :
+        ''' Uniformly random isbn out of a bitset without building a list of matches '''
+        total = bits.bit_count()
+        if total == 0:
+            return None
+        return self.isbns[nth_bit(bits, random.randrange(total))]
\ No newline at end of file
@@ -0,0 +1,68 @@
+import random
+
+from activity import DAILY, DAY, WINDOWS, Activity, kept_from, today
+
+START = 20_000
+
+def brute (events:list, today:int, days:int) -> dict :
+    ''' Events in the last days days as of today, added up from scratch '''
+    counts:dict = {}
+    for day, isbn in events:
+        if today - days < day <= today:
+            counts[isbn] = counts.get(isbn, 0) + 1
+    return counts
+
+def test_windows_roll_over ():
+    activity = Activity()
+    rng = random.Random(1)
+    events = []
+    for day in range(START, START + 120):
+        for _ in range(rng.randrange(5)):
+            isbn = f'book {rng.randrange(8)}'
+            # Some come in late, for a day that's already in the windows
+            at = (day - rng.randrange(3)) * DAY + rng.randrange(DAY)
+            activity.record(isbn, at)
+            events.append((at // DAY, isbn))
+        # Quiet days still move the windows on
+        if rng.random() < 0.2:
+            continue
+        activity.top(7, 10, day * DAY)
+        for window in WINDOWS:
+            assert activity.counts(window) == brute(events, day, window)
+        # Nothing older than DAILY days is kept a day at a time
+        assert min(activity.days) > day - DAILY
+
+def test_old_days_merge_into_weeks ():
+    activity = Activity()
+    for day in range(START, START + 40):
+        activity.record('book', day * DAY)
+    last = START + 39
+    merged = list(range(START, last - DAILY + 1))
+    assert sorted(activity.days) == list(range(last - DAILY + 1, last + 1))
+    # Every merged day went into its week's bucket
+    assert sum(bucket['book'] for bucket in activity.weeks.values()) == len(merged)
+    assert set(activity.weeks) == {day // 7 for day in merged}
+    # Longer windows count weeks whole
+    assert activity.counts(35)['book'] == sum(1 for day in range(START, last + 1) if day > last - 35 or (day // 7) * 7 + 6 > last - 35)
+
+def test_weeks_past_a_year_are_dropped ():
+    activity = Activity()
+    activity.record('old', START * DAY)
+    activity.advance(START + 400)
+    assert activity.weeks == {} and activity.days == {}
+    # Events for days already dropped aren't kept either
+    activity.record('older', (START + 400 - 380) * DAY)
+    assert activity.buckets() == 0
+    assert kept_from(START + 400) > START + 20
+
+def test_saved_buckets_load_back ():
+    activity = Activity()
+    rng = random.Random(2)
+    # Up to a few days ago, so loading has to move the windows on to today
+    for day in range(today() - 60, today() - 3):
+        activity.record(f'book {rng.randrange(4)}', day * DAY)
+    loaded = Activity()
+    loaded.load(activity.to_dict())
+    activity.advance(today())
+    assert loaded.windows == activity.windows and loaded.windows[30] != {}
+    assert loaded.days == activity.days and loaded.weeks == activity.weeks
@@ -0,0 +1,62 @@
+import json
+
+import pytest
+
+import catalog
+from isbn import convert
+
+def edition (key:int, record:dict) -> str :
+    return f'/type/edition\t/books/OL{key}M\t1\t2020-01-01T00:00:00\t{json.dumps(record)}\n'
+
+EDITIONS = [
+    {'title': 'Girls can kiss now', 'subtitle': 'essays', 'isbn_13': ['9781982158507'], 'authors': [{'key': '/authors/OL1A'}], 'subjects': ['Essays', 5], 'number_of_pages': 256},
+    # ISBN-10s are looked up by their ISBN-13, hyphens and all
+    {'title': 'By statement', 'isbn_10': ['0-306-40615-2'], 'by_statement': 'Someone Else.'},
+    # The first line with a key wins
+    {'title': 'Second printing', 'isbn_13': ['9781982158507']},
+    {'isbn_13': ['9780143127550']},
+    {'title': 'Bad ISBN', 'isbn_13': ['9780000000000', 'not an isbn']},
+] + [{'title': f'Filler {i}', 'isbn_13': [convert(f'{100_000_000 + i:09d}')]} for i in range(50)]
+
+@pytest.fixture
+def dump (tmp_path, monkeypatch):
+    path, authors_path = str(tmp_path / 'editions.txt'), str(tmp_path / 'authors.txt')
+    with open(path, 'w') as file:
+        file.writelines(edition(key, record) for key, record in enumerate(EDITIONS))
+    with open(authors_path, 'w') as file:
+        file.write('/type/author\t/authors/OL1A\t1\t2020-01-01T00:00:00\t{"name": "Jill Gutowitz"}\n')
+    # Small runs so indexing has several to merge
+    monkeypatch.setattr(catalog, 'RUN_LENGTH', 8)
+    assert catalog.build_index(path) == 53
+    catalog.build_index(authors_path, catalog.author_keys)
+    return path, authors_path
+
+def test_lookups (dump):
+    books = catalog.Catalog(*dump, cache_size=2)
+    assert books.lookup('9781982158507') == {'title': 'Girls can kiss now : essays', 'author': 'Jill Gutowitz', 'subjects': ['Essays'], 'pages': 256}
+    assert books.lookup(convert('030640615'))['author'] == 'Someone Else'
+    assert books.lookup(convert(f'{100_000_049:09d}'))['title'] == 'Filler 49'
+    # Misses, including a book with no title, are cached too
+    assert books.lookup('9780143127550') == None
+    assert books.lookup('9789999999991') == None
+    assert books.lookup('9789999999991') == None
+    # Only the last cache_size are kept
+    assert books.stats['hits'] == 1 and list(books.cache) == ['9780143127550', '9789999999991']
+    books.close()
+
+def test_out_of_date_index_is_rejected (dump):
+    path, _ = dump
+    with open(path, 'a') as file:
+        file.write(edition(999, {'title': 'New', 'isbn_13': ['9780143127550']}))
+    with pytest.raises(ValueError, match='out of date'):
+        catalog.Catalog(path)
+
+def test_lookup_without_a_usable_catalog (dump, monkeypatch):
+    path, _ = dump
+    monkeypatch.setattr(catalog, 'CATALOG_PATH', path + '.missing')
+    monkeypatch.setattr(catalog, 'catalog', None)
+    assert catalog.lookup('9781982158507') == None
+    monkeypatch.setattr(catalog, 'CATALOG_PATH', path)
+    monkeypatch.setattr(catalog, 'catalog', None)
+    assert catalog.lookup('9781982158507')['title'] == 'Girls can kiss now : essays'
+    catalog.catalog.close()
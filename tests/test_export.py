@@ -0,0 +1,65 @@
+import asyncio
+import csv
+import gzip
+import io
+import json
+import os
+
+import pytest
+
+import db
+import export
+import importer
+from isbn import convert
+
+BOOKS = 5000
+LIMIT = 150 * 1024
+# Compressed parts are checked against the most a chunk could take uncompressed, so they need a limit not much over a chunk to split
+GZ_LIMIT = export.CHUNK_BYTES + 16 * 1024
+
+def library (tmp_path):
+    library = db.JsonLibrary(str(tmp_path / 'library.json'))
+    library.append_data({
+        convert(f'{i:09d}'): {
+            'title': f'Book {i} "{i * 7919 % 10007}"', 'author': f'Author, {i % 97}', 'isbn': convert(f'{i:09d}'),
+            'tags': [f'tag {i % 5}', f'tag {i % 11}'], 'ratings': {str(i % 13): i % 10 + 1}, 'completions': [i % 17],
+        }
+        for i in range(BOOKS)
+    })
+    return library
+
+@pytest.mark.parametrize('format', export.FORMATS)
+def test_parts_stand_alone (tmp_path, format):
+    source = library(tmp_path)
+    directory = tmp_path / 'out'
+    directory.mkdir()
+    limit = GZ_LIMIT if format.endswith('.gz') else LIMIT
+    paths = asyncio.run(export.export(source, format, None, str(directory), limit))
+    assert len(paths) > 1
+
+    isbns = []
+    for path in paths:
+        assert os.path.getsize(path) <= limit
+        with open(path, 'rb') as file:
+            data = file.read()
+        # Every part is a whole gzip file of its own
+        text = (gzip.decompress(data) if format.endswith('.gz') else data).decode()
+        if format.startswith('json'):
+            isbns += [json.loads(line)['isbn'] for line in text.splitlines()]
+        else:
+            # Starts with the header, so each part imports on its own
+            assert next(csv.reader(io.StringIO(text))) == list(export.CSV_COLUMNS)
+            books, rejected = importer.prepare(io.StringIO(text, newline=''))
+            assert rejected == []
+            isbns += [book['isbn'] for _, book in books]
+    # Every book exactly once, in order
+    assert isbns == list(source.books)
+
+def test_tag_filter (tmp_path):
+    source = library(tmp_path)
+    paths = asyncio.run(export.export(source, 'json', source.match_tags('tag 3 AND tag 4'), str(tmp_path)))
+    with open(paths[0]) as file:
+        exported = [json.loads(line) for line in file]
+    assert len(paths) == 1
+    assert [book['isbn'] for book in exported] == [isbn for isbn, book in source.books.items() if {'tag 3', 'tag 4'} <= set(book.tags)]
+    assert exported[0] == source.books[exported[0]['isbn']].to_dict()
@@ -0,0 +1,42 @@
+import db
+import sqlite_db
+from isbn import convert
+from shelves import build
+
+def books (count:int, start:int = 0) -> dict :
+    return {
+        convert(f'{i:09d}'): {'title': f'Book {i}', 'author': f'Author {i % 7}', 'isbn': convert(f'{i:09d}'), 'tags': [f'tag{i % 5}'], 'ratings': {}, 'completions': []}
+        for i in range(start, start + count)
+    }
+
+def indexes (library) -> tuple :
+    return (
+        library.titles.exact, library.tags.postings, library.tags.names, library.rankings.popular,
+        library.rankings.favorite, library.shelves.by_title, library.shelves.by_author,
+    )
+
+def import_matches_loading (library, reopen):
+    first = books(10)
+    library.append_data(first)
+    isbn = next(iter(first))
+    library.complete(isbn, 1)
+    library.rate(isbn, 1, 8)
+    library.shelves.keys, library.shelves.by_title, library.shelves.by_author = build(library.shelf_rows())
+
+    # Enough new books for the bulk path, plus one already there being retagged
+    imported = books(db.BULK_BOOKS + 10, 10)
+    imported[isbn] = {**library.books[isbn].to_dict(), 'tags': ['tag0', 'new']}
+    library.append_data(imported)
+
+    reopened = reopen()
+    reopened.shelves.keys, reopened.shelves.by_title, reopened.shelves.by_author = build(reopened.shelf_rows())
+    assert len(library.books) == db.BULK_BOOKS + 20
+    assert indexes(library) == indexes(reopened)
+
+def test_json_bulk_import_matches_loading (tmp_path):
+    library = db.JsonLibrary(str(tmp_path / 'library.json'))
+    import_matches_loading(library, lambda: (library.flush(), db.JsonLibrary(library.path))[1])
+
+def test_sqlite_bulk_import_matches_loading (tmp_path):
+    library = sqlite_db.SqliteLibrary(str(tmp_path / 'library.sqlite'))
+    import_matches_loading(library, lambda: sqlite_db.SqliteLibrary(library.path))
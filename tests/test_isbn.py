@@ -0,0 +1,34 @@
+import isbn
+from isbn import LengthError, ValidationError, canonical, canonical_many
+
+EDGE = [
+    '9780306406157', '978-0-306-40615-7', '978 0 306 40615 7', ' 9780306406157 ',
+    '0-8044-2957-X', '0-8044-2957-x', '080442957X', '080442957x',
+    # Fullwidth, Arabic-Indic and superscript digits, which int() would take
+    '97803064061５7', '٩٧٨٠٣٠٦٤٠٦١٥٧', '978030640615⁷',
+    '9780306406158', '97803064061X7', 'X780306406157', '08044x2957', '978-0-306', '', '---',
+]
+
+def one_at_a_time (isbns:list) -> list :
+    keys = []
+    for raw in isbns:
+        try:
+            keys.append(canonical(raw))
+        except (LengthError, ValidationError):
+            keys.append(None)
+    return keys
+
+def test_canonical_keys ():
+    assert one_at_a_time(EDGE) == [
+        '9780306406157', '9780306406157', '9780306406157', '9780306406157',
+        '9780804429573', '9780804429573', '9780804429573', '9780804429573',
+        None, None, None,
+        None, None, None, None, None, None, None,
+    ]
+
+def test_canonical_many_agrees (monkeypatch):
+    expected = one_at_a_time(EDGE)
+    assert canonical_many(EDGE) == expected
+    # And without numpy
+    monkeypatch.setattr(isbn, 'numpy', None)
+    assert canonical_many(EDGE) == expected
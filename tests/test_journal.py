@@ -0,0 +1,115 @@
+import asyncio
+import json
+import os
+import time
+
+import pytest
+
+import db
+
+ISBN = '9781982158507'
+BOOK = {'title': 'Girls can kiss now : essays', 'author': 'Jill Gutowitz', 'isbn': ISBN, 'tags': ['essays'], 'ratings': {}, 'completions': []}
+
+def new_library (tmp_path):
+    library = db.JsonLibrary(str(tmp_path / 'library.json'))
+    library.add(BOOK)
+    # The first flush writes the snapshot, everything after goes in the journal
+    library.flush()
+    return library
+
+def test_torn_record_is_dropped (tmp_path):
+    library = new_library(tmp_path)
+    library.complete(ISBN, 1)
+    library.flush()
+    journal_size = os.path.getsize(library.journal_path)
+    # The bot died partway through appending the next record
+    with open(library.journal_path, 'ab') as journal:
+        journal.write(json.dumps({'op': 'complete', 'isbn': ISBN, 'id': 2})[:20].encode())
+
+    reopened = db.JsonLibrary(library.path)
+    assert reopened.books[ISBN].completed(1)
+    assert not reopened.books[ISBN].completed(2)
+    assert os.path.getsize(reopened.journal_path) == journal_size
+
+    # Records written after recovering start on a line of their own
+    reopened.complete(ISBN, 3)
+    reopened.flush()
+    again = db.JsonLibrary(library.path)
+    assert again.books[ISBN].completed(1) and again.books[ISBN].completed(3)
+
+def test_unterminated_record_is_dropped (tmp_path):
+    library = new_library(tmp_path)
+    # Whole json but no newline, so it can't be told apart from a record cut off right before it
+    with open(library.journal_path, 'ab') as journal:
+        journal.write(json.dumps({'op': 'complete', 'isbn': ISBN, 'id': 2}).encode())
+
+    reopened = db.JsonLibrary(library.path)
+    assert not reopened.books[ISBN].completed(2)
+    assert os.path.getsize(reopened.journal_path) == 0
+
+def test_compacts_once_journal_outgrows_snapshot (tmp_path, monkeypatch):
+    monkeypatch.setattr(db, 'COMPACT_MIN_BYTES', 0)
+    library = new_library(tmp_path)
+    snapshot_size = os.path.getsize(library.snapshot_path)
+
+    user = 0
+    while os.path.getsize(library.journal_path) < snapshot_size * db.COMPACT_RATIO:
+        user += 1
+        library.complete(ISBN, user)
+        library.flush()
+    assert user > 1
+
+    # The journal is big enough now, so the next flush folds it into the snapshot instead
+    user += 1
+    library.complete(ISBN, user)
+    library.flush()
+    assert os.path.getsize(library.journal_path) == 0
+    assert len(db.JsonLibrary(library.path).books[ISBN].completions) == user
+
+def slow_snapshots (monkeypatch):
+    save = db.save_snapshot
+    def slow_save (snapshot, path):
+        time.sleep(0.2)
+        return save(snapshot, path)
+    monkeypatch.setattr(db, 'save_snapshot', slow_save)
+
+def test_close_waits_for_running_compaction (tmp_path, monkeypatch):
+    library = new_library(tmp_path)
+    slow_snapshots(monkeypatch)
+
+    async def evict ():
+        library.needs_snapshot = True
+        library.complete(ISBN, 1)
+        compacting = asyncio.create_task(library.aflush())
+        await asyncio.sleep(0.05)
+        # Made after the snapshot being written was taken, so it has to land in the journal after the compaction empties it
+        library.complete(ISBN, 2)
+        await library.aclose()
+        await compacting
+
+    asyncio.run(evict())
+    reopened = db.JsonLibrary(library.path)
+    assert reopened.books[ISBN].completed(1) and reopened.books[ISBN].completed(2)
+
+def test_flush_waits_its_turn (tmp_path, monkeypatch):
+    library = new_library(tmp_path)
+    slow_snapshots(monkeypatch)
+
+    async def flush_during_compaction ():
+        library.needs_snapshot = True
+        library.complete(ISBN, 1)
+        compacting = asyncio.create_task(library.aflush())
+        await asyncio.sleep(0)
+        library.complete(ISBN, 2)
+        library.flush()
+        await compacting
+
+    asyncio.run(flush_during_compaction())
+    reopened = db.JsonLibrary(library.path)
+    assert reopened.books[ISBN].completed(1) and reopened.books[ISBN].completed(2)
+
+def test_closed_library_refuses_changes (tmp_path):
+    library = new_library(tmp_path)
+    library.close()
+    with pytest.raises(db.LibraryClosed):
+        library.complete(ISBN, 1)
@@ -0,0 +1,63 @@
+import random
+
+import db
+from isbn import convert
+from rankings import Rankings
+
+def book (i:int, tags:list) -> dict :
+    isbn = convert(f'{i:09d}')
+    return {'title': f'Book {i}', 'author': 'Someone', 'isbn': isbn, 'tags': tags, 'ratings': {}, 'completions': []}
+
+def expected (library, tag=None) -> tuple :
+    ''' Both rankings worked out from scratch from the books themselves '''
+    books = [isbn for isbn, book in library.books.items() if tag == None or tag in book.tags]
+    popular = sorted(books, key=lambda isbn: (-len(library.books[isbn].completions), isbn))
+    rated = [isbn for isbn in books if len(library.books[isbn].scores) != 0]
+    favorite = sorted(rated, key=lambda isbn: (-sum(library.books[isbn].scores) / len(library.books[isbn].scores), isbn))
+    return popular, favorite
+
+def rankings (library, tag=None) -> tuple :
+    return library.most_popular(100, tag), library.favorites(100, tag)
+
+def test_finish_and_rate_keep_order (tmp_path):
+    library = db.JsonLibrary(str(tmp_path / 'library.json'))
+    library.append_data({b['isbn']: b for b in (book(i, ['odd' if i % 2 else 'even']) for i in range(20))})
+    isbns = list(library.books)
+    rng = random.Random(1)
+    for step in range(300):
+        isbn, user = rng.choice(isbns), rng.randrange(15)
+        if step % 2:
+            library.complete(isbn, user)
+        else:
+            # Rating again changes the rating rather than adding one
+            library.rate(isbn, user, rng.randint(1, 10))
+        assert rankings(library) == expected(library)
+    for tag in ('odd', 'even'):
+        assert rankings(library, tag) == expected(library, tag)
+    # Tags are matched however they're cased
+    assert rankings(library, ' ODD') == expected(library, 'odd')
+
+def test_retagging_removes_from_old_tag (tmp_path):
+    library = db.JsonLibrary(str(tmp_path / 'library.json'))
+    library.append_data({b['isbn']: b for b in (book(i, ['scifi']) for i in range(3))})
+    first = list(library.books)[0]
+    library.complete(first, 1)
+    library.rate(first, 1, 9)
+    library.append_data({first: {**library.books[first].to_dict(), 'tags': ['fantasy']}})
+
+    assert first not in library.most_popular(10, 'scifi') and first not in library.favorites(10, 'scifi')
+    assert library.most_popular(10, 'fantasy') == [first] and library.favorites(10, 'fantasy') == [first]
+    # Still first overall, with its completion and rating carried over
+    assert library.most_popular(1) == [first] and library.favorites(1) == [first]
+    assert rankings(library) == expected(library)
+
+def test_add_many_matches_one_at_a_time ():
+    rows = [(f'isbn{i}', [f'tag{i % 3}'], i % 4, (i * 7) % 30, i % 3) for i in range(50)]
+    bulk, single = Rankings(), Rankings()
+    bulk.add_many(rows)
+    for isbn, tags, completions, rating_sum, rating_count in rows:
+        single.track(isbn, tags, completions, rating_sum, rating_count)
+        single.rank(isbn)
+    assert bulk.popular == single.popular and bulk.favorite == single.favorite
+    # Unrated books stay out of favorites
+    assert len(bulk.favorite[None]) == len([row for row in rows if row[4] != 0])
@@ -0,0 +1,36 @@
+import time
+
+import db
+import sqlite_db
+from isbn import convert
+
+TITLES = ['T0', 'T1', 'T2', 'T3', 'T4']
+BOOKS = {convert(f'{i:09d}'): {'title': title, 'author': 'Author', 'isbn': convert(f'{i:09d}'), 'tags': [], 'ratings': {}, 'completions': []} for i, title in enumerate(TITLES)}
+
+def read (library, monkeypatch) -> list :
+    ''' Finishes books in an order that isn't the order they were added in, a second apart '''
+    library.append_data(BOOKS)
+    isbns = list(BOOKS)
+    for second, title in enumerate(['T3', 'T0', 'T4']):
+        monkeypatch.setattr(time, 'time', lambda: 1_700_000_000 + second)
+        library.complete(isbns[TITLES.index(title)], 1)
+    # Retagging a book carries its finishes along with it
+    library.append_data({isbns[3]: {**library.books[isbns[3]].to_dict(), 'tags': ['new']}})
+    return profile(library)
+
+def profile (library) -> list :
+    return [library.books[isbn].title for isbn, _ in library.recent_reads(1)]
+
+def test_json_recent_reads_survive_reload (tmp_path, monkeypatch):
+    library = db.JsonLibrary(str(tmp_path / 'library.json'))
+    assert read(library, monkeypatch) == ['T4', 'T0', 'T3']
+    library.flush()
+    # From the journal, then from the snapshot once it's compacted
+    assert profile(db.JsonLibrary(library.path)) == ['T4', 'T0', 'T3']
+    library.compact(library.snapshot())
+    assert profile(db.JsonLibrary(library.path)) == ['T4', 'T0', 'T3']
+
+def test_sqlite_recent_reads_survive_reload (tmp_path, monkeypatch):
+    library = sqlite_db.SqliteLibrary(str(tmp_path / 'library.sqlite'))
+    assert read(library, monkeypatch) == ['T4', 'T0', 'T3']
+    assert profile(sqlite_db.SqliteLibrary(library.path)) == ['T4', 'T0', 'T3']
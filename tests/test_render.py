@@ -0,0 +1,53 @@
+import discord
+
+import bot
+import db
+import docs
+from render import RenderCache
+
+ISBN = '9781982158507'
+BOOK = {'title': 'Girls can kiss now : essays', 'author': 'Jill Gutowitz', 'isbn': ISBN, 'tags': ['essays'], 'ratings': {}, 'completions': []}
+
+def fields (embed) -> dict :
+    return {field.name: field.value for field in embed.fields}
+
+def test_cache_hits_until_version_changes ():
+    cache = RenderCache(size=2)
+    renders = []
+    render = lambda: renders.append(1) or len(renders)
+    assert cache.get('a', 1, render) == 1
+    assert cache.get('a', 1, render) == 1
+    assert cache.get('a', 2, render) == 2
+    assert cache.stats['hits'] == 1 and cache.stats['misses'] == 2
+    # Least recently used is dropped past size
+    cache.get('b', 1, render)
+    cache.get('a', 2, render)
+    cache.get('c', 1, render)
+    assert list(cache.entries) == ['a', 'c']
+
+def test_book_edits_invalidate (tmp_path):
+    library = db.JsonLibrary(str(tmp_path / 'library.json'))
+    library.add(BOOK)
+    color = discord.Color.purple()
+    first = bot.render_book(library, ISBN, color)
+    assert bot.render_book(library, ISBN, color) is first
+
+    library.complete(ISBN, 1)
+    finished = bot.render_book(library, ISBN, color)
+    assert fields(finished)['Completions'] == '1'
+    library.rate(ISBN, 1, 8)
+    rated = bot.render_book(library, ISBN, color)
+    assert fields(rated)['Rating'] == '8.0/10'
+    library.append_data({ISBN: {**library.books[ISBN].to_dict(), 'tags': ['essays', 'queer']}})
+    assert fields(bot.render_book(library, ISBN, color))['Tags'] == 'essays, queer'
+
+    # Another color is its own entry, and a library opened again never gets the old one's embeds
+    assert bot.render_book(library, ISBN, discord.Color.red()) is not bot.render_book(library, ISBN, color)
+    library.flush()
+    reopened = db.JsonLibrary(library.path)
+    assert bot.render_book(reopened, ISBN, color) is not bot.render_book(library, ISBN, color)
+
+def test_help_is_rendered_once ():
+    docs.build_help_cache(bot.bot)
+    assert docs.help_embed(bot.bot, 'view') is docs.help_embed(bot.bot, 'view')
+    assert docs.help_embed(bot.bot, '').title == 'Welcome to Librarian!'
@@ -0,0 +1,53 @@
+import json
+import os
+
+import db
+import sqlite_db
+
+ISBN = '9781982158507'
+OTHER = '9780143127550'
+BOOK = {'title': 'Girls can kiss now : essays', 'author': 'Jill Gutowitz', 'isbn': ISBN, 'tags': ['essays'], 'ratings': {}, 'completions': []}
+
+def test_json_replica_leaves_torn_record (tmp_path):
+    library = db.JsonLibrary(str(tmp_path / 'library.json'))
+    library.add(BOOK)
+    library.flush()
+    # The bot is partway through appending a record
+    with open(library.journal_path, 'ab') as journal:
+        journal.write(json.dumps({'op': 'complete', 'isbn': ISBN, 'id': 2})[:20].encode())
+    size = os.path.getsize(library.journal_path)
+
+    db.JsonLibrary(library.path, truncate=False)
+    assert os.path.getsize(library.journal_path) == size
+
+def indexes (library) -> tuple :
+    return library.readers.ratings, library.readers.completed, library.rankings.completions, library.rankings.rating_sums, library.tags.book_tags
+
+def test_sqlite_replica_catches_up_from_changes (tmp_path):
+    path = str(tmp_path / 'library.sqlite')
+    library = sqlite_db.SqliteLibrary(path)
+    library.add(BOOK)
+    replica = sqlite_db.SqliteLibrary(path, truncate=False)
+
+    library.complete(ISBN, 1)
+    library.rate(ISBN, 1, 9)
+    library.rate(ISBN, 1, 7)
+    library.add({**BOOK, 'isbn': OTHER, 'title': 'The Martian'})
+    library.complete(OTHER, 2)
+    library.append_data({ISBN: {**library.books[ISBN].to_dict(), 'tags': ['essays', 'queer']}})
+    library.rate(ISBN, 2, 4)
+
+    assert not replica.changed_on_disk()
+    replica.catch_up()
+    assert indexes(replica) == indexes(sqlite_db.SqliteLibrary(path, truncate=False))
+    assert replica.find_title('The Martian') == OTHER
+
+def test_sqlite_replica_reloads_once_changes_are_trimmed (tmp_path, monkeypatch):
+    monkeypatch.setattr(sqlite_db, 'CHANGES_KEPT', 2)
+    path = str(tmp_path / 'library.sqlite')
+    library = sqlite_db.SqliteLibrary(path)
+    library.add(BOOK)
+    replica = sqlite_db.SqliteLibrary(path, truncate=False)
+    for user in range(1, 6):
+        library.complete(ISBN, user)
+    assert replica.changed_on_disk()
@@ -0,0 +1,16 @@
+import asyncio
+
+from shelves import Shelves
+
+def test_books_added_while_warming_are_shelved ():
+    async def warm ():
+        shelves = Shelves()
+        shelves.warm(lambda: [('1', 'Dune', 'Frank Herbert')])
+        # Added before the build has even started
+        shelves.add('2', 'Emma', 'Jane Austen')
+        await shelves.task
+        return shelves
+
+    shelves = asyncio.run(warm())
+    assert [isbn for _, isbn in shelves.by_title] == ['1', '2']
+    assert shelves.changed == None
@@ -0,0 +1,19 @@
+import db
+import storage
+
+ISBN = '9781982158507'
+BOOK = {'title': 'Girls can kiss now : essays', 'author': 'Jill Gutowitz', 'isbn': ISBN, 'tags': ['essays'], 'ratings': {}, 'completions': []}
+
+def test_stale_update_keeps_other_shards_changes (tmp_path):
+    library = db.JsonLibrary(str(tmp_path / 'library.json'))
+    library.add(BOOK)
+    # Another shard finished and rated it after this shard's copy was last updated
+    library.complete(ISBN, 1)
+    library.rate(ISBN, 1, 9)
+
+    stale = {**BOOK, 'tags': ['essays', 'queer'], 'ratings': {'2': 7}, 'completions': [2]}
+    library.apply(storage.merge(library, {'op': 'update', 'books': {ISBN: stale}}))
+    book = library.books[ISBN]
+    assert book.tags == ['essays', 'queer']
+    assert book.completed(1) and book.completed(2)
+    assert book.rating(1) == 9 and book.rating(2) == 7
@@ -0,0 +1,56 @@
+import pytest
+
+import db
+import importer
+from isbn import convert
+from tags import TagIndex, bracketed, is_expression
+
+BOOKS = {
+    'a': ['scifi', 'space'],
+    'b': ['scifi', 'robots', 'romance'],
+    'c': ['fantasy', 'romance'],
+    'd': ['sci-fi (hard)'],
+}
+
+def index () -> TagIndex :
+    tags = TagIndex()
+    tags.add_many(BOOKS.items())
+    return tags
+
+def books (tags:TagIndex, bits:int) -> set :
+    return {isbn for isbn in tags.isbns if (bits >> tags.ordinals[isbn]) & 1}
+
+def test_is_expression ():
+    assert is_expression('scifi AND space')
+    assert is_expression('NOT romance')
+    assert is_expression('(scifi OR fantasy) AND romance')
+    # Plain lists, brackets and lowercase words included
+    assert not is_expression('scifi,space')
+    assert not is_expression('sci-fi (hard)')
+    assert not is_expression('science and nature, NOTES')
+
+def test_precedence ():
+    tags = index()
+    # AND binds tighter than OR
+    assert books(tags, tags.query('fantasy OR scifi AND robots')) == {'b', 'c'}
+    assert books(tags, tags.query('(fantasy OR scifi) AND romance')) == {'b', 'c'}
+    assert books(tags, tags.query('scifi AND NOT romance')) == {'a'}
+    assert books(tags, tags.query('NOT NOT space')) == {'a'}
+    # Tags are matched however they're cased or spaced
+    assert books(tags, tags.query(' SciFi  AND Space')) == {'a'}
+
+@pytest.mark.parametrize('expression', ['scifi AND', '(scifi OR space', 'scifi OR space)', 'AND scifi', 'scifi () OR space', 'NOT'])
+def test_malformed (expression):
+    with pytest.raises(ValueError):
+        index().query(expression)
+
+def test_bracketed_tags_match_as_a_list (tmp_path):
+    library = db.JsonLibrary(str(tmp_path / 'library.json'))
+    isbn = convert('000000001')
+    library.add({'title': 'Hard', 'author': 'Someone', 'isbn': isbn, 'tags': ['sci-fi (hard)'], 'ratings': {}, 'completions': []})
+    assert library.tags.isbns[library.match_tags('sci-fi (hard)').bit_length() - 1] == isbn
+
+def test_bracketed_tags_are_rejected ():
+    assert bracketed(['scifi', 'sci-fi (hard)', 'x)']) == ['sci-fi (hard)', 'x)']
+    books, rejected = importer.check_batch([(2, {'title': 'Hard', 'author': 'Someone', 'isbn': '0-306-40615-2', 'tags': 'scifi,sci-fi (hard)'})])
+    assert books == [] and rejected == [(2, 'Brackets in tag sci-fi (hard)')]
@@ -0,0 +1,108 @@
+import heapq
+import re
+from collections import Counter
+
+# Stop counting trigram hits once this many postings have been read
+MAX_POSTINGS = 1024
+
+def normalize (title:str) -> str :
+    ''' Casefolds and strips punctuation and extra whitespace so "The Love  Hypothesis!" matches "the love hypothesis" '''
+    return ' '.join(re.sub(r'[^\w\s]', ' ', title.casefold()).split())
+
+def trigrams (title:str) -> frozenset :
+    # Pad so short titles and word starts still get trigrams
+    padded = f'  {title} '
+    return frozenset(padded[i:i+3] for i in range(len(padded) - 2))
+
+class TitleIndex:
+    ''' Exact and fuzzy title lookup, updated a book at a time as titles are added or edited '''
+
+    def __init__ (self):
+        # normalized title -> isbns with that title
+        self.exact:dict = {}
+        # trigram -> isbns whose title contains it
+        self.postings:dict = {}
+        # isbn -> (normalized title, trigrams) so edits can be undone, trigrams are None until posted
+        self.entries:dict = {}
+        # isbns added by add_many whose trigrams haven't been posted yet
+        self.unposted:set = set()
+
+    def add (self, isbn:str, title:str):
+        ''' Indexes a book's title, replacing whatever was indexed for that isbn before '''
+        key = normalize(title)
+        if isbn in self.entries:
+            if self.entries[isbn][0] == key:
+                return
+            self.remove(isbn)
+
+        grams = trigrams(key)
+        self.entries[isbn] = (key, grams)
+        self.exact.setdefault(key, set()).add(isbn)
+        for gram in grams:
+            self.postings.setdefault(gram, set()).add(isbn)
+
+    def add_many (self, books):
+        ''' Indexes (isbn, title) pairs when loading. Only exact lookups are ready straight away, trigrams wait for the first fuzzy lookup '''
+        for isbn, title in books:
+            if isbn in self.entries:
+                self.add(isbn, title)
+                continue
+            key = normalize(title)
+            self.entries[isbn] = (key, None)
+            self.exact.setdefault(key, set()).add(isbn)
+            self.unposted.add(isbn)
+
+    def post (self):
+        ''' Posts the trigrams of everything add_many left unposted '''
+        for isbn in self.unposted:
+            key = self.entries[isbn][0]
+            grams = trigrams(key)
+            self.entries[isbn] = (key, grams)
+            for gram in grams:
+                self.postings.setdefault(gram, set()).add(isbn)
+        self.unposted.clear()
+
+    def remove (self, isbn:str):
+        key, grams = self.entries.pop(isbn)
+
+        self.exact[key].discard(isbn)
+        if len(self.exact[key]) == 0:
+            del self.exact[key]
+        if grams == None:
+            self.unposted.discard(isbn)
+            return
+        for gram in grams:
+            self.postings[gram].discard(isbn)
+            if len(self.postings[gram]) == 0:
+                del self.postings[gram]
+
+    def find (self, title:str) -> str | None :
+        ''' Returns the isbn of a book with exactly this title, ignoring case and punctuation '''
+        isbns = self.exact.get(normalize(title))
+        if not isbns:
+            return None
+        return min(isbns)
+
+    def similar (self, title:str, count:int = 5) -> list :
+        ''' Returns up to count isbns ranked by trigram similarity to title, best first '''
+        self.post()
+        query = trigrams(normalize(title))
+
+        # Rare trigrams narrow things down fastest, so count hits from the smallest posting lists first
+        postings = sorted((self.postings[gram] for gram in query if gram in self.postings), key=len)
+        hits:Counter = Counter()
+        read = 0
+        for posting in postings:
+            if read + len(posting) > MAX_POSTINGS and read != 0:
+                break
+            hits.update(posting)
+            read += len(posting)
+
+        def similarity (isbn):
+            grams = self.entries[isbn][1]
+            shared = len(query & grams)
+            return shared / (len(query) + len(grams) - shared)
+
+        # Only the books sharing the most rare trigrams are worth scoring properly
+        candidates = [isbn for isbn, _ in hits.most_common(count * 8)]
+        return heapq.nlargest(count, candidates, key=similarity)
\ No newline at end of file